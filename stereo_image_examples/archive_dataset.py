@@ -0,0 +1,528 @@
+"""archive_dataset.py
+
+Reads stereo images straight out of tar and zip archives, so the dataset
+doesn't have to be extracted first.
+
+Holopix50k comes as archives, and extracting them means having the data on
+disk twice and creating hundreds of thousands of small files. Instead, image
+pairs can be given as `<archive>::<image_key>`, eg.
+
+  /work/data/holopix50k_val.tar::-LZzVudZ9Opy4fS11OBT
+
+in the image lists for `create_depth_map.py`, and `make_data_split.py` can
+be pointed at an archive instead of a directory. Images in an archive can be
+laid out either the same as the original data
+(`left/<image_key>_left.jpg` and `right/<image_key>_right.jpg`) or the same
+as a split (`<image_key>/left.jpg` and `<image_key>/right.jpg`), under any
+top level directory.
+
+The first time an archive is opened, the offset and length of every image in
+it is found and saved to an index file next to it,
+`<archive>.index.tsv`, with a line for each image of
+`<image_key>\t<name>\t<offset>\t<length>\t<method>`. After that the archive
+is memory mapped and images are decoded straight from their offsets, so
+any pair can be read without going through the rest of the archive. If the
+archive changes, the index is built again.
+
+If the archive is somewhere we can't write to (eg. a read only dataset
+share), the index goes in `~/.cache/archive_index` instead. It can also be
+put somewhere else by setting `ARCHIVE_INDEX_DIR`, or with
+`--archive_index_dir` for `create_depth_map.py` and `make_data_split.py`,
+and building it once with
+  python archive_dataset.py index <archive> --index_dir <dir>
+means no job has to walk the archive itself. Indexes kept in a directory
+like this are named with a hash of the archive's full path as well, so
+archives with the same name in different places don't share one.
+
+Uncompressed tars and zips (with images stored or deflated) can be read this
+way. Compressed tars can't be seeked into, so need to be recompressed as one
+of those first.
+
+Can also be run as a script,
+  index: build the index for an archive
+  list: print `<archive>::<image_key>` for every pair, to use as an image list
+  verify: decode every pair, to check an archive before running jobs on it
+"""
+import numpy as np
+import cv2
+import argparse
+import hashlib
+import mmap
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# separates the archive from the image key in an image pair
+ARCHIVE_SEPARATOR = '::'
+# methods images can be stored with in an archive
+STORED = 'stored'
+DEFLATED = 'deflated'
+# environment variable with the directory to keep indexes in
+INDEX_DIR_ENV = 'ARCHIVE_INDEX_DIR'
+# archives that are open in this process, refer to `open_archive`
+_open_archives = {}
+_open_lock = threading.Lock()
+
+
+def is_archive_pair(image_pair):
+  """whether an image pair is in an archive, ie. `<archive>::<image_key>`"""
+  return ARCHIVE_SEPARATOR in image_pair
+
+
+def split_archive_pair(image_pair):
+  """split an image pair into its archive and image key
+
+  Returns:
+    tuple of (archive path, image key)
+  """
+  archive_path, image_key = image_pair.rsplit(ARCHIVE_SEPARATOR, 1)
+  return archive_path, image_key
+
+
+def member_entry(member_name):
+  """work out which image a member of an archive is
+
+  Args:
+    member_name (str):
+      path of the member within the archive
+
+  Returns:
+    tuple of (image key, name) where name is `left` or `right`, or None if
+    it isn't one of the images
+  """
+  parts = member_name.rstrip('/').split('/')
+  for name in ['left', 'right']:
+    suffix = '_{}.jpg'.format(name)
+    if parts[-1].endswith(suffix) and len(parts[-1]) > len(suffix):
+      # original layout, `left/<image_key>_left.jpg`
+      return parts[-1][:-len(suffix)], name
+    if (parts[-1] == '{}.jpg'.format(name)) and (len(parts) > 1):
+      # split layout, `<image_key>/left.jpg`
+      return parts[-2], name
+  return None
+
+
+def index_tar(archive_path):
+  """find where every image is in an uncompressed tar
+
+  Only the headers are read, tarfile seeks past the data for each member.
+
+  Returns:
+    dict mapping (image key, name) to (offset, length, method)
+
+  Raises:
+    IOError if the tar is compressed
+  """
+  index = {}
+  try:
+    with tarfile.open(archive_path, 'r:') as tar:
+      for member in tar:
+        entry = member_entry(member.name) if member.isfile() else None
+        if entry is not None:
+          index[entry] = (member.offset_data, member.size, STORED)
+  except tarfile.ReadError:
+    raise IOError(
+      'unable to read tar, compressed tars need to be recompressed as a zip or uncompressed tar: {}'.format(
+        archive_path))
+  return index
+
+
+def index_zip(archive_path):
+  """find where every image is in a zip
+
+  The central directory only says where each member's local header is, so
+  read the local headers to find where the data actually starts.
+
+  Returns:
+    dict mapping (image key, name) to (offset, length, method)
+
+  Raises:
+    IOError if any images are compressed with something other than deflate
+  """
+  methods = {zipfile.ZIP_STORED: STORED, zipfile.ZIP_DEFLATED: DEFLATED}
+  index = {}
+  with zipfile.ZipFile(archive_path) as archive, \
+       open(archive_path, 'rb') as f:
+    for info in archive.infolist():
+      entry = member_entry(info.filename)
+      if (entry is None) or info.is_dir():
+        continue
+      if info.compress_type not in methods:
+        raise IOError('unsupported compression for {} in {}'.format(
+          info.filename, archive_path))
+      f.seek(info.header_offset)
+      header = f.read(30)
+      name_length = int.from_bytes(header[26:28], 'little')
+      extra_length = int.from_bytes(header[28:30], 'little')
+      offset = info.header_offset + 30 + name_length + extra_length
+      index[entry] = (offset, info.compress_size, methods[info.compress_type])
+  return index
+
+
+def index_path_for(archive_path, index_dir=None):
+  """path to the index file for an archive
+
+  In `index_dir` the name has a hash of the full path of the archive as
+  well, as archives from different directories often have the same name
+  (eg. `train/shard_000.tar` and `val/shard_000.tar`), and can easily have
+  the same size and mtime too.
+  """
+  if index_dir is None:
+    return archive_path + '.index.tsv'
+  path_hash = hashlib.sha1(
+    os.path.realpath(archive_path).encode()).hexdigest()[:16]
+  return os.path.join(index_dir, '{}.{}.index.tsv'.format(
+    os.path.basename(archive_path), path_hash))
+
+
+def user_index_dir():
+  """directory for indexes of archives we can't write next to"""
+  cache_dir = os.environ.get('XDG_CACHE_HOME',
+                             os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(cache_dir, 'archive_index')
+
+
+def index_paths_for(archive_path, index_dir=None):
+  """paths the index for an archive can be at, in the order they are used
+
+  If `index_dir` isn't given, it is next to the archive, or in the user's
+  cache if it can't be saved there
+  """
+  if index_dir is not None:
+    return [index_path_for(archive_path, index_dir)]
+  return [index_path_for(archive_path),
+          index_path_for(archive_path, user_index_dir())]
+
+
+def archive_signature(archive_path):
+  """size and mtime of an archive, to tell if its index is out of date"""
+  stat = os.stat(archive_path)
+  return '{}\t{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def read_index(index_path, signature):
+  """read an index file for an archive
+
+  Args:
+    index_path (str):
+      path to the index file
+    signature (str):
+      signature of the archive, from `archive_signature`
+
+  Returns:
+    dict mapping (image key, name) to (offset, length, method), or None if
+    there is no index or it is for a different version of the archive
+  """
+  try:
+    f = open(index_path)
+  except OSError:
+    return None
+  index = {}
+  with f:
+    if f.readline().rstrip('\n') != '#\t' + signature:
+      return None
+    for line in f:
+      fields = line.rstrip('\n').split('\t')
+      if len(fields) != 5:
+        # only partly written, the whole index can't be trusted
+        return None
+      key, name, offset, length, method = fields
+      index[(key, name)] = (int(offset), int(length), method)
+  return index
+
+
+def write_index(index_path, signature, index):
+  """write an index file for an archive
+
+  Is written to a temp file and renamed into place, so other jobs never see
+  half an index.
+
+  Returns:
+    True if it was saved, False if the directory can't be written to
+  """
+  tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+  try:
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(tmp_path, 'w') as f:
+      f.write('#\t{}\n'.format(signature))
+      for (key, name), (offset, length, method) in sorted(
+          index.items(), key=lambda x: x[1][0]):
+        f.write('{}\t{}\t{}\t{}\t{}\n'.format(key, name, offset, length,
+                                              method))
+    os.replace(tmp_path, index_path)
+  except OSError:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    return False
+  return True
+
+
+def load_index(archive_path, index_dir=None):
+  """read the index for an archive, building it if needed
+
+  Args:
+    archive_path (str):
+      path to the tar or zip
+    index_dir (str):
+      directory for the index file. If None it is next to the archive, or
+      in `user_index_dir()` if it can't be saved there
+
+  Returns:
+    dict mapping (image key, name) to (offset, length, method)
+
+  Raises:
+    IOError if the archive isn't a tar or zip we can read
+  """
+  signature = archive_signature(archive_path)
+  index_paths = index_paths_for(archive_path, index_dir)
+  for index_path in index_paths:
+    index = read_index(index_path, signature)
+    if index is not None:
+      return index
+  if zipfile.is_zipfile(archive_path):
+    index = index_zip(archive_path)
+  elif tarfile.is_tarfile(archive_path):
+    index = index_tar(archive_path)
+  else:
+    raise IOError('not a tar or zip archive: {}'.format(archive_path))
+  if not any(write_index(x, signature, index) for x in index_paths):
+    # still works, but every process will have to build it again
+    print('unable to save archive index for {} in: {}'.format(
+      archive_path, ', '.join(os.path.dirname(x) for x in index_paths)),
+          file=sys.stderr)
+  return index
+
+
+class ArchiveDataset(object):
+  """read only view of the images in an archive
+
+  Has the same interface for reading images as `PackedDataset` in
+  `pack_dataset.py`. The archive is memory mapped, so only the pages for
+  the images we actually read get pulled in.
+  """
+
+  def __init__(self, archive_path, index_dir=None):
+    """load the index for an archive, building it if needed
+
+    Args:
+      archive_path (str):
+        path to the tar or zip
+      index_dir (str):
+        directory for the index file, refer to `load_index`
+
+    Raises:
+      IOError if the archive can't be read
+    """
+    self.archive_path = archive_path
+    self.index = load_index(archive_path, index_dir)
+    with open(archive_path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # pairs are usually read in the order they are in the archive, so let
+    # the kernel read ahead
+    if hasattr(self._map, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+      self._map.madvise(mmap.MADV_SEQUENTIAL)
+
+  def keys(self):
+    """list of image keys with both images, in the order they are stored"""
+    return [key for key, name in sorted(self.index, key=self.index.get)
+            if (name == 'left') and ((key, 'right') in self.index)]
+
+  def has(self, key, name):
+    """whether the archive has an image for this key and name"""
+    return (key, name) in self.index
+
+  def read_bytes(self, key, name):
+    """get the encoded bytes for an image
+
+    Args:
+      key (str):
+        image key
+      name (str):
+        `left` or `right`
+
+    Returns:
+      uint8 array, which is a read only view onto the memory mapped archive
+      unless the image had to be decompressed
+
+    Raises:
+      KeyError if the image isn't in the archive
+    """
+    offset, length, method = self.index[(key, name)]
+    data = np.frombuffer(self._map, dtype=np.uint8, count=length,
+                         offset=offset)
+    if method == DEFLATED:
+      # raw deflate stream, without the zlib header
+      data = np.frombuffer(zlib.decompress(data, -15), dtype=np.uint8)
+    return data
+
+  def read_image(self, key, name, flags=cv2.IMREAD_COLOR):
+    """decode an image straight from the archive
+
+    Args:
+      key (str):
+        image key
+      name (str):
+        `left` or `right`
+      flags (int):
+        flags for `cv2.imdecode`
+
+    Returns:
+      decoded image
+
+    Raises:
+      KeyError if the image isn't in the archive
+      IOError if the image couldn't be decoded
+    """
+    image = cv2.imdecode(self.read_bytes(key, name), flags)
+    if image is None:
+      raise IOError('unable to decode {} image for key: {}'.format(name, key))
+    return image
+
+  def signature(self, key, name):
+    """signature of an image for the manifest, or None if it is missing"""
+    entry = self.index.get((key, name))
+    if entry is None:
+      return None
+    return [self._map.size()] + list(entry[:2])
+
+  def close(self):
+    """close the memory mapped archive"""
+    self._map.close()
+
+
+def open_archive(archive_path, index_dir=None):
+  """get an archive, opening it if this process hasn't already
+
+  Archives are kept open for the life of the process, so each image pair
+  doesn't have to load the index again.
+
+  Args:
+    archive_path (str):
+      path to the tar or zip
+    index_dir (str):
+      directory for the index file. If None it is taken from
+      `ARCHIVE_INDEX_DIR` if that is set, refer to `load_index` otherwise
+
+  Returns:
+    ArchiveDataset for the archive
+  """
+  archive_path = os.path.abspath(archive_path)
+  if index_dir is None:
+    index_dir = os.environ.get(INDEX_DIR_ENV) or None
+  with _open_lock:
+    if archive_path not in _open_archives:
+      _open_archives[archive_path] = ArchiveDataset(archive_path, index_dir)
+    return _open_archives[archive_path]
+
+
+def decode_pairs(archive, keys, threads=4, depth=16, flags=cv2.IMREAD_COLOR):
+  """decode image pairs in order, decoding ahead on a pool of threads
+
+  Reading is sequential through the archive in the order of `keys`, while
+  decoding (which releases the GIL) is spread across the threads. No more
+  than `depth` pairs are decoded ahead of what has been used.
+
+  Args:
+    archive (ArchiveDataset):
+      archive to read from
+    keys (iterable):
+      image keys to decode
+    threads (int):
+      number of threads to decode with
+    depth (int):
+      max number of pairs decoded ahead
+    flags (int):
+      flags for `cv2.imdecode`
+
+  Returns:
+    generator of (image key, left image, right image, error), where the
+    images are None and error is a string if the pair couldn't be decoded
+  """
+  def decode(key, left_data, right_data):
+    images = [cv2.imdecode(x, flags) for x in [left_data, right_data]]
+    if any(x is None for x in images):
+      return key, None, None, 'unable to decode image'
+    return key, images[0], images[1], None
+
+  pending = deque()
+  with ThreadPoolExecutor(threads) as executor:
+    for key in keys:
+      try:
+        # touch the bytes here, so the reading happens in order
+        left_data, right_data = [np.array(archive.read_bytes(key, x))
+                                 for x in ['left', 'right']]
+      except (KeyError, zlib.error) as e:
+        # still goes through the pool so it comes out in order
+        error = '{}: {}'.format(type(e).__name__, e)
+        pending.append(executor.submit(lambda x: x,
+                                       (key, None, None, error)))
+      else:
+        pending.append(executor.submit(decode, key, left_data, right_data))
+      while len(pending) > depth:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+
+def main(args):
+  """index, list or verify an archive"""
+  start = time.time()
+  archive = ArchiveDataset(args.archive, args.index_dir)
+  if args.command == 'index':
+    print('indexed {} pairs in {:.2f}s: {}'.format(
+      len(archive.keys()), time.time() - start,
+      next((x for x in index_paths_for(args.archive, args.index_dir)
+            if read_index(x, archive_signature(args.archive)) is not None),
+           'not saved')))
+  elif args.command == 'list':
+    archive_path = os.path.abspath(args.archive)
+    for key in archive.keys():
+      print('{}{}{}'.format(archive_path, ARCHIVE_SEPARATOR, key))
+  elif args.command == 'verify':
+    failed = 0
+    count = 0
+    for count, (key, _, _, error) in enumerate(
+        decode_pairs(archive, archive.keys(), args.threads), 1):
+      if error is not None:
+        failed += 1
+        print('FAILED: {}: {}'.format(key, error))
+    print('decoded {} pairs in {:.2f}s, {} failed'.format(
+      count, time.time() - start, failed))
+    return 1 if failed else 0
+  return 0
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='archive_dataset',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  index_parser = subparsers.add_parser('index', help='index an archive')
+  list_parser = subparsers.add_parser('list',
+                                      help='print the pairs in an archive')
+  verify_parser = subparsers.add_parser('verify',
+                                        help='decode every pair in an archive')
+  verify_parser.add_argument('--threads', type=int, default=4,
+                             help='number of threads to decode with')
+  for sub_parser in [index_parser, list_parser, verify_parser]:
+    sub_parser.add_argument('archive', type=str,
+                            help='path to the tar or zip')
+    sub_parser.add_argument('--index_dir', type=str,
+                            default=os.environ.get(INDEX_DIR_ENV) or None,
+                            help='directory for the index, default is ARCHIVE_INDEX_DIR or next to the archive')
+  args = parser.parse_args(sys.argv[1:])
+  if not os.path.isfile(args.archive):
+    raise IOError('Value for archive does not exist: {}'.format(args.archive))
+  if (args.command == 'verify') and (args.threads < 1):
+    raise ValueError('Invalid value for threads, must be >= 1: {}'.format(
+      args.threads))
+  sys.exit(main(args))
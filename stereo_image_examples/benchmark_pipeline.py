@@ -0,0 +1,1000 @@
+"""benchmark_pipeline.py
+
+Benchmark for `create_depth_map.py` that doesn't need the cluster or the
+dataset, so changes to things like `create_matchers()`,
+`read_resize_images()` or `save_disparity_map()` can be checked on a laptop.
+
+Synthetic rectified stereo pairs are made for a few resolutions and
+disparity ranges. Each scene is a slanted background with a few
+rectangles in front of it, each covered in random texture. The right image
+is made by shifting each layer by its disparity, nearest layers last so
+they occlude the ones behind, so we know the true disparity of every pixel
+in the left image.
+
+`run` then, for each case,
+  - times each stage for every pair, using the same functions
+    `create_depth_map.py` does (creating the matchers, decode, resize, left
+    and right match, WLS filter, uint8 conversion, encode and write)
+  - checks the filtered disparity against the ground truth, as the end
+    point error (mean absolute error in pixels) and the fraction of pixels
+    out by more than one pixel (bad1)
+  - runs `create_depth_map.py` end to end with 1..N workers and measures
+    throughput in pairs per second
+
+and writes it all to a JSON file. `compare` lines up two of these files
+and flags any stage or throughput that got slower by more than a threshold,
+eg.
+
+  python benchmark_pipeline.py run before.json
+  ... make a change ...
+  python benchmark_pipeline.py run after.json
+  python benchmark_pipeline.py compare before.json after.json
+
+Timings are only comparable between runs on the same machine, so the host,
+CPU count and library versions are saved with the results as well.
+
+`sequence` instead makes a synthetic sequence of frames, where the
+rectangles move across a still background and change depth a little each
+frame, with a cut to a new scene part way through. Each frame has a bit of
+sensor noise. It is run through both the normal per-pair `sgbm` engine and
+the `temporal` engine that reuses the previous frame, and prints the
+throughput and accuracy of each, eg.
+
+  python benchmark_pipeline.py sequence --frames 60 --resolution 540x960
+
+The temporal engine is only run from here until it beats `sgbm` on these,
+so it isn't one of the `--engine` choices for `create_depth_map.py`.
+
+`gated` runs synthetic pairs (saved and loaded back as JPEGs, so they have
+the same artefacts as real ones) through the full path and the `gated`
+engine with a few thresholds, and prints the throughput and accuracy of
+each along with the fraction of rows the gated engine didn't refine, eg.
+
+  python benchmark_pipeline.py gated --thresholds 0.01 0.02 0.05 0.1
+
+`decode` writes synthetic pairs as JPEGs at a source resolution and times
+loading them at a few smaller sizes, with `cv2.imread` and then a resize
+(how `read_resize_images()` used to do it) against decoding at a reduced
+scale, in colour and grayscale, one image after the other and with the left
+and right decoded at the same time on a thread pool. It prints the time
+for each pair, the peak memory allocated for arrays while loading a pair,
+and the mean absolute difference to the full decode shrunk with area
+averaging, eg.
+
+  python benchmark_pipeline.py decode --source 1080x1920 --targets 540x960 270x480
+"""
+import numpy as np
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+import create_depth_map
+
+
+# version of the results format, bump if it changes
+RESULTS_VERSION = 1
+
+
+def make_texture(rng, height, width, scale):
+  """random texture for a layer of the scene
+
+  Noise at a few scales so there is detail for the matcher at any
+  resolution, blurred a little so it survives JPEG compression.
+  """
+  texture = np.zeros((height, width), dtype=np.float32)
+  for cell in [scale, max(1, scale // 4)]:
+    coarse = rng.uniform(0, 255, size=(height // cell + 1, width // cell + 1))
+    texture += cv2.resize(coarse.astype(np.float32),
+                          (width // cell * cell + cell,
+                           height // cell * cell + cell),
+                          interpolation=cv2.INTER_NEAREST)[:height, :width]
+  texture = cv2.GaussianBlur(texture / 2.0, (3, 3), 0)
+  # colour it a bit, as the real images are BGR
+  tint = rng.uniform(0.6, 1.0, size=3).astype(np.float32)
+  return np.clip(texture[:, :, None] * tint, 0, 255).astype(np.uint8)
+
+
+def make_synthetic_pair(rng, height, width, max_disparity, num_objects=4):
+  """make a rectified stereo pair with known disparity
+
+  Args:
+    rng (np.random.RandomState):
+      random state to make the scene from
+    height (int):
+      height of the images
+    width (int):
+      width of the images
+    max_disparity (int):
+      disparities in the scene are kept below this
+    num_objects (int):
+      number of rectangles in front of the background
+
+  Returns:
+    tuple of (left image, right image, disparity of each pixel in the left
+    image as float32)
+  """
+  rows = np.arange(height)[:, None]
+  cols = np.arange(width)[None, :]
+  pad = max_disparity
+  # background is slanted, like the ground, so is closer at the bottom
+  near = max(1, int(0.4 * max_disparity))
+  far = max(1, int(0.1 * max_disparity))
+  background_disp = np.round(
+    far + (near - far) * rows / max(height - 1, 1)).astype(np.int32)
+  texture = make_texture(rng, height, width + pad, max(4, width // 64))
+  # a pixel at x in the left image is at x - disparity in the right image
+  left = texture[rows, cols]
+  right = texture[rows, cols + background_disp]
+  gt_disp = np.broadcast_to(background_disp, (height, width)).astype(
+    np.float32)
+  # objects in front, furthest first so nearer ones cover them
+  objects = []
+  for _ in range(num_objects):
+    disp = int(rng.randint(near + 1, max(near + 2, int(0.9 * max_disparity))))
+    obj_height = int(rng.randint(height // 8, height // 3))
+    obj_width = int(rng.randint(width // 8, width // 3))
+    top = int(rng.randint(0, height - obj_height))
+    left_edge = int(rng.randint(disp, width - obj_width))
+    objects.append((disp, top, left_edge, obj_height, obj_width))
+  for disp, top, left_edge, obj_height, obj_width in sorted(objects):
+    obj_texture = make_texture(rng, obj_height, obj_width,
+                               max(4, width // 96))
+    rows_slice = slice(top, top + obj_height)
+    left[rows_slice, left_edge:left_edge + obj_width] = obj_texture
+    right[rows_slice, left_edge - disp:left_edge - disp + obj_width] = (
+      obj_texture)
+    gt_disp[rows_slice, left_edge:left_edge + obj_width] = disp
+  return left, right, gt_disp
+
+
+def make_synthetic_sequence(rng, height, width, max_disparity, num_frames,
+                            num_objects=4, max_speed=4, noise=2.0):
+  """make a sequence of rectified stereo pairs of a moving scene
+
+  Like `make_synthetic_pair`, but the rectangles move a few pixels each
+  frame and drift nearer or further away, bouncing off the edges. Half way
+  through there is a cut to a whole new scene.
+
+  Args:
+    rng (np.random.RandomState):
+      random state to make the scenes from
+    height (int):
+      height of the images
+    width (int):
+      width of the images
+    max_disparity (int):
+      disparities in the scene are kept below this
+    num_frames (int):
+      number of frames in the sequence
+    num_objects (int):
+      number of rectangles in front of the background
+    max_speed (int):
+      max pixels a rectangle moves each frame
+    noise (float):
+      standard deviation of the noise added to every frame
+
+  Returns:
+    generator of (left image, right image, true disparity) for each frame
+  """
+  rows = np.arange(height)[:, None]
+  cols = np.arange(width)[None, :]
+  near = max(1, int(0.4 * max_disparity))
+  far = max(1, int(0.1 * max_disparity))
+  background_disp = np.round(
+    far + (near - far) * rows / max(height - 1, 1)).astype(np.int32)
+  for frame in range(num_frames):
+    if frame in [0, num_frames // 2]:
+      # new scene
+      texture = make_texture(rng, height, width + max_disparity,
+                             max(4, width // 64))
+      left_bg = texture[rows, cols]
+      right_bg = texture[rows, cols + background_disp]
+      objects = []
+      for _ in range(num_objects):
+        obj_height = int(rng.randint(height // 8, height // 3))
+        obj_width = int(rng.randint(width // 8, width // 3))
+        objects.append({
+          'disp': float(rng.randint(near + 1,
+                                    max(near + 2, int(0.9 * max_disparity)))),
+          'top': float(rng.randint(0, height - obj_height)),
+          'left': float(rng.randint(max_disparity, width - obj_width)),
+          'velocity': rng.uniform(-max_speed, max_speed, size=3) * [1, 1, 0.1],
+          'texture': make_texture(rng, obj_height, obj_width,
+                                  max(4, width // 96))})
+    left = left_bg.copy()
+    right = right_bg.copy()
+    gt_disp = np.broadcast_to(background_disp, (height, width)).astype(
+      np.float32)
+    for obj in sorted(objects, key=lambda x: x['disp']):
+      obj_height, obj_width = obj['texture'].shape[:2]
+      disp = int(round(obj['disp']))
+      top = int(round(obj['top']))
+      left_edge = int(round(obj['left']))
+      rows_slice = slice(top, top + obj_height)
+      left[rows_slice, left_edge:left_edge + obj_width] = obj['texture']
+      right[rows_slice, left_edge - disp:left_edge - disp + obj_width] = (
+        obj['texture'])
+      gt_disp[rows_slice, left_edge:left_edge + obj_width] = disp
+      # move for the next frame, bouncing off the edges
+      limits = [(0, height - obj_height),
+                (max_disparity, width - obj_width),
+                (near + 1, 0.9 * max_disparity)]
+      for i, name in enumerate(['top', 'left', 'disp']):
+        low, high = limits[i]
+        value = obj[name] + obj['velocity'][i]
+        if not (low <= value <= high):
+          obj['velocity'][i] = -obj['velocity'][i]
+          value = min(max(value, low), high)
+        obj[name] = value
+    yield (np.clip(left + rng.normal(0, noise, left.shape), 0,
+                   255).astype(np.uint8),
+           np.clip(right + rng.normal(0, noise, right.shape), 0,
+                   255).astype(np.uint8),
+           gt_disp)
+
+
+def make_case_data(case_dir, rng, height, width, max_disparity, num_pairs):
+  """write synthetic pairs for a case in the same layout as the dataset
+
+  Each pair gets a directory with `left.jpg` and `right.jpg`, and the
+  ground truth is kept in `gt_disp.npy` next to them.
+
+  Returns:
+    path to a text file listing the pair directories
+  """
+  image_pair_paths = []
+  for i in range(num_pairs):
+    pair_dir = os.path.join(case_dir, '-synthetic{:04d}'.format(i))
+    os.makedirs(pair_dir, exist_ok=True)
+    left, right, gt_disp = make_synthetic_pair(rng, height, width,
+                                               max_disparity)
+    cv2.imwrite(os.path.join(pair_dir, 'left.jpg'), left)
+    cv2.imwrite(os.path.join(pair_dir, 'right.jpg'), right)
+    np.save(os.path.join(pair_dir, 'gt_disp.npy'), gt_disp)
+    image_pair_paths.append(os.path.abspath(pair_dir))
+  image_path_list = os.path.join(case_dir, 'image_paths.txt')
+  with open(image_path_list, 'w') as f:
+    f.write('\n'.join(image_pair_paths) + '\n')
+  return image_path_list
+
+
+def disparity_error(filtered_disp, gt_disp, max_disparity):
+  """compare a filtered disparity map to the ground truth
+
+  Pixels near the left edge can't be matched (their match is off the edge
+  of the right image), so are left out.
+
+  Args:
+    filtered_disp (array):
+      filtered disparity in the 16x fixed point format from the WLS filter
+    gt_disp (array):
+      true disparity in pixels
+    max_disparity (int):
+      max disparity the matcher searched over
+
+  Returns:
+    tuple of (end point error in pixels, fraction of pixels out by more
+    than one pixel)
+  """
+  diff = np.abs(filtered_disp.astype(np.float32) / 16.0 - gt_disp)
+  diff = diff[:, max_disparity:]
+  return float(np.mean(diff)), float(np.mean(diff > 1.0))
+
+
+def summarise_stages(stage_times):
+  """mean, median and min for each stage over every pair and repeat"""
+  return {stage: {'mean': float(np.mean(times)),
+                  'p50': float(np.median(times)),
+                  'min': float(np.min(times))}
+          for stage, times in stage_times.items()}
+
+
+def benchmark_stages(image_pair_paths, args, max_disparity, height, width):
+  """time each stage for every pair in a case, and check accuracy
+
+  Args:
+    image_pair_paths (list(str)):
+      paths to the synthetic pairs
+    args (argparse.Namespace):
+      benchmark args, for the matcher params and number of repeats
+    max_disparity (int):
+      max disparity for this case
+    height (int):
+      height of the images in this case
+    width (int):
+      width of the images in this case
+
+  Returns:
+    dict of results for the stages and accuracy
+  """
+  stage_times = {}
+
+  def add_times(timings):
+    for stage, seconds in timings.items():
+      stage_times.setdefault(stage, []).append(seconds)
+
+  # make sure the suggested p1 and p2 are for this case
+  matcher_args = argparse.Namespace(max_disparity=max_disparity,
+                                    block_size=args.block_size,
+                                    p1=None, p2=None, lmbda=args.lmbda,
+                                    sigma=args.sigma)
+  create_depth_map.check_matcher_args(matcher_args)
+  for _ in range(args.repeats):
+    start = time.perf_counter()
+    left_matcher, right_matcher = create_depth_map.create_matchers(
+      max_disparity, args.block_size, matcher_args.p1, matcher_args.p2)
+    wls_filter = create_depth_map.create_wls_filter(left_matcher, args.lmbda,
+                                                    args.sigma)
+    add_times({'create_matchers': time.perf_counter() - start})
+  pair_seconds = []
+  errors = []
+  bad_fractions = []
+  for image_pair in image_pair_paths:
+    for _ in range(args.repeats):
+      timings = {}
+      start = time.perf_counter()
+      left_im, right_im = create_depth_map.read_resize_images(
+        image_pair, height, width, timings)
+      filtered_disp = create_depth_map.compute_disparity_from_images(
+        left_matcher, right_matcher, wls_filter, left_im, right_im, timings)
+      create_depth_map.save_disparity_map(filtered_disp, image_pair, timings)
+      pair_seconds.append(time.perf_counter() - start)
+      # the disparity ranges are kept with the timings, but aren't one
+      timings.pop('disp_range', None)
+      add_times(timings)
+    # accuracy needs the filtered disparity before it is cast to uint8, so
+    # is an extra untimed pass with the same matchers
+    displ = left_matcher.compute(left_im, right_im)
+    dispr = right_matcher.compute(right_im, left_im)
+    filtered = wls_filter.filter(displ, left_im, disparity_map_right=dispr)
+    gt_disp = np.load(os.path.join(image_pair, 'gt_disp.npy'))
+    error, bad_fraction = disparity_error(filtered, gt_disp, max_disparity)
+    errors.append(error)
+    bad_fractions.append(bad_fraction)
+  return {'stages': summarise_stages(stage_times),
+          'pair_seconds': {'mean': float(np.mean(pair_seconds)),
+                           'p50': float(np.median(pair_seconds)),
+                           'min': float(np.min(pair_seconds))},
+          'epe': float(np.mean(errors)),
+          'bad1': float(np.mean(bad_fractions))}
+
+
+def benchmark_throughput(image_path_list, num_pairs, args, max_disparity,
+                         height, width, workers):
+  """run `create_depth_map.py` end to end and measure throughput
+
+  Is run as a separate process each time, the same as on the cluster, so
+  includes starting up the interpreter and the worker pool.
+
+  Returns:
+    dict with the wall time and pairs per second
+
+  Raises:
+    RuntimeError if the run failed
+  """
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'create_depth_map.py')
+  command = [sys.executable, script, image_path_list,
+             '--im_height', str(height), '--im_width', str(width),
+             '--max_disparity', str(max_disparity),
+             '--block_size', str(args.block_size),
+             '--lmbda', str(args.lmbda), '--sigma', str(args.sigma),
+             '--workers', str(workers)]
+  start = time.perf_counter()
+  result = subprocess.run(command, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE)
+  seconds = time.perf_counter() - start
+  if result.returncode != 0:
+    raise RuntimeError('create_depth_map.py failed:\n{}'.format(
+      result.stderr.decode(errors='replace')))
+  return {'workers': workers,
+          'seconds': seconds,
+          'pairs_per_second': num_pairs / seconds}
+
+
+def benchmark_sequence(args):
+  """compare the per-pair and temporal engines on a synthetic sequence
+
+  Only the matching and filtering is timed, as reading and writing is the
+  same for both engines.
+
+  Returns:
+    dict of results for each engine
+  """
+  height, width = parse_resolution(args.resolution)
+  rng = np.random.RandomState(args.seed)
+  frames = list(make_synthetic_sequence(rng, height, width,
+                                        args.max_disparity, args.frames))
+  matcher_args = argparse.Namespace(max_disparity=args.max_disparity,
+                                    block_size=args.block_size,
+                                    p1=None, p2=None, lmbda=args.lmbda,
+                                    sigma=args.sigma)
+  create_depth_map.check_matcher_args(matcher_args)
+  left_matcher, right_matcher = create_depth_map.create_matchers(
+    args.max_disparity, args.block_size, matcher_args.p1, matcher_args.p2)
+  wls_filter = create_depth_map.create_wls_filter(left_matcher, args.lmbda,
+                                                  args.sigma)
+  temporal_state = {}
+
+  def run_sgbm(left_im, right_im, timings):
+    return create_depth_map.compute_disparity_from_images(
+      left_matcher, right_matcher, wls_filter, left_im, right_im, timings,
+      to_uint8=False)
+
+  def run_temporal(left_im, right_im, timings):
+    return create_depth_map.compute_temporal_disparity_from_images(
+      left_matcher, right_matcher, wls_filter, left_im, right_im,
+      temporal_state, args.max_disparity, args.block_size, matcher_args.p1,
+      matcher_args.p2, args.temporal_band, args.scene_cut,
+      args.stable_change, args.keyframe_interval, timings, to_uint8=False)
+
+  results = {}
+  for engine, engine_fn in [('sgbm', run_sgbm), ('temporal', run_temporal)]:
+    seconds = 0.0
+    errors = []
+    bad_fractions = []
+    modes = {}
+    for left_im, right_im, gt_disp in frames:
+      timings = {}
+      start = time.perf_counter()
+      filtered = engine_fn(left_im, right_im, timings)
+      seconds += time.perf_counter() - start
+      mode = timings.get('temporal_mode', 'full')
+      modes[mode] = modes.get(mode, 0) + 1
+      error, bad_fraction = disparity_error(filtered, gt_disp,
+                                            args.max_disparity)
+      errors.append(error)
+      bad_fractions.append(bad_fraction)
+    results[engine] = {'seconds': seconds,
+                       'frames_per_second': len(frames) / seconds,
+                       'epe': float(np.mean(errors)),
+                       'bad1': float(np.mean(bad_fractions)),
+                       'modes': modes}
+  return results
+
+
+def print_sequence(results):
+  """print the results from `benchmark_sequence`"""
+  for engine, result in sorted(results.items()):
+    print('{:<9s} {:8.3f} frames/s  epe {:.3f}px  bad1 {:6.2%}  frames {}'.format(
+      engine, result['frames_per_second'], result['epe'], result['bad1'],
+      ', '.join('{} {}'.format(k, v)
+                for k, v in sorted(result['modes'].items()))))
+  sgbm = results['sgbm']
+  temporal = results['temporal']
+  speedup = temporal['frames_per_second'] / sgbm['frames_per_second']
+  print('temporal speedup: {:.2f}x  epe {:+.1%}  bad1 {:+.2%}'.format(
+    speedup, temporal['epe'] / max(sgbm['epe'], 1e-9) - 1.0,
+    temporal['bad1'] - sgbm['bad1']))
+  if speedup <= 1.0:
+    print('temporal is slower than sgbm here, so is a net loss')
+  elif temporal['epe'] > sgbm['epe']:
+    print('temporal is faster than sgbm here, but less accurate')
+
+
+def benchmark_gated(args):
+  """compare the full path to the gated engine at a few thresholds
+
+  Only the matching and filtering is timed, as reading and writing is the
+  same for both.
+
+  Returns:
+    dict of results for the full path and each threshold
+  """
+  height, width = parse_resolution(args.resolution)
+  rng = np.random.RandomState(args.seed)
+  pairs = []
+  for _ in range(args.pairs):
+    left, right, gt_disp = make_synthetic_pair(rng, height, width,
+                                               args.max_disparity)
+    left, right = [cv2.imdecode(cv2.imencode('.jpg', x)[1], cv2.IMREAD_COLOR)
+                   for x in [left, right]]
+    pairs.append((left, right, gt_disp))
+  matcher_args = argparse.Namespace(max_disparity=args.max_disparity,
+                                    block_size=args.block_size,
+                                    p1=None, p2=None, lmbda=args.lmbda,
+                                    sigma=args.sigma)
+  create_depth_map.check_matcher_args(matcher_args)
+  left_matcher, right_matcher = create_depth_map.create_matchers(
+    args.max_disparity, args.block_size, matcher_args.p1, matcher_args.p2)
+  wls_filter = create_depth_map.create_wls_filter(left_matcher, args.lmbda,
+                                                  args.sigma)
+
+  def run_full(left_im, right_im, timings):
+    return create_depth_map.compute_disparity_from_images(
+      left_matcher, right_matcher, wls_filter, left_im, right_im, timings,
+      to_uint8=False)
+
+  def gated_fn(threshold):
+    def run_gated(left_im, right_im, timings):
+      return create_depth_map.compute_gated_disparity_from_images(
+        left_matcher, right_matcher, wls_filter, left_im, right_im,
+        args.max_disparity, threshold, timings=timings, to_uint8=False)
+    return run_gated
+
+  engines = [('full', run_full)] + [
+    ('gated {:g}'.format(x), gated_fn(x)) for x in args.thresholds]
+  results = {}
+  for engine, engine_fn in engines:
+    seconds = 0.0
+    errors = []
+    bad_fractions = []
+    skipped = []
+    for left_im, right_im, gt_disp in pairs:
+      timings = {}
+      start = time.perf_counter()
+      filtered = engine_fn(left_im, right_im, timings)
+      seconds += time.perf_counter() - start
+      skipped.append(timings.get('gate_skipped', 0.0))
+      error, bad_fraction = disparity_error(filtered, gt_disp,
+                                            args.max_disparity)
+      errors.append(error)
+      bad_fractions.append(bad_fraction)
+    results[engine] = {'seconds': seconds,
+                       'pairs_per_second': len(pairs) / seconds,
+                       'epe': float(np.mean(errors)),
+                       'bad1': float(np.mean(bad_fractions)),
+                       'skipped': float(np.mean(skipped))}
+  return results
+
+
+def print_gated(results):
+  """print the results from `benchmark_gated`"""
+  full = results['full']
+  print('{:<12s} {:>8s} {:>8s} {:>8s} {:>8s} {:>8s}'.format(
+    'engine', 'pairs/s', 'speedup', 'epe', 'bad1', 'skipped'))
+  for engine, result in sorted(results.items(),
+                               key=lambda x: (x[0] != 'full', x[0])):
+    print('{:<12s} {:8.3f} {:7.2f}x {:7.3f}px {:7.2%} {:7.1%}'.format(
+      engine, result['pairs_per_second'],
+      result['pairs_per_second'] / full['pairs_per_second'], result['epe'],
+      result['bad1'], result['skipped']))
+
+
+def imread_resize_images(image_pair_path, im_height, im_width,
+                         interpolation=cv2.INTER_LINEAR):
+  """load a pair with `cv2.imread` and then resize, to compare against"""
+  images = []
+  for orientation in ['left', 'right']:
+    image = cv2.imread(os.path.join(image_pair_path,
+                                    '{}.jpg'.format(orientation)))
+    images.append(cv2.resize(image, (im_width, im_height),
+                             interpolation=interpolation))
+  return images
+
+
+def benchmark_decode(args):
+  """compare loading JPEGs with imread and resize to reduced scale decodes
+
+  Returns:
+    dict with results for each target size and way of loading
+  """
+  height, width = parse_resolution(args.source)
+  rng = np.random.RandomState(args.seed)
+  data_dir = tempfile.mkdtemp(prefix='decode_benchmark_')
+  decode_pool = ThreadPoolExecutor(args.threads)
+  try:
+    image_pair_paths = []
+    for index in range(args.pairs):
+      image_pair_path = os.path.join(data_dir, 'pair_{:0>3d}'.format(index))
+      os.makedirs(image_pair_path)
+      left, right, _ = make_synthetic_pair(rng, height, width,
+                                           min(128, width // 4 // 16 * 16))
+      cv2.imwrite(os.path.join(image_pair_path, 'left.jpg'), left)
+      cv2.imwrite(os.path.join(image_pair_path, 'right.jpg'), right)
+      image_pair_paths.append(image_pair_path)
+
+    def reduced_fn(grayscale, pool):
+      def load(image_pair_path, im_height, im_width):
+        return create_depth_map.read_resize_images(
+          image_pair_path, im_height, im_width, grayscale=grayscale,
+          decode_pool=pool)
+      return load
+
+    loaders = [('imread', imread_resize_images),
+               ('reduced', reduced_fn(False, None)),
+               ('reduced threads', reduced_fn(False, decode_pool)),
+               ('reduced gray', reduced_fn(True, None)),
+               ('reduced gray threads', reduced_fn(True, decode_pool))]
+    results = {}
+    for target in args.targets:
+      im_height, im_width = parse_resolution(target)
+      # area averaging from the full decode is as close as we can get to
+      # the original, plain resize aliases when shrinking by a lot
+      reference = [imread_resize_images(x, im_height, im_width,
+                                        cv2.INTER_AREA)
+                   for x in image_pair_paths]
+      target_results = {}
+      for loader, load_fn in loaders:
+        # warm up the page cache and the thread pool
+        load_fn(image_pair_paths[0], im_height, im_width)
+        seconds = []
+        peaks = []
+        diffs = []
+        for _ in range(args.repeats):
+          for image_pair_path, ref_images in zip(image_pair_paths, reference):
+            tracemalloc.start()
+            start = time.perf_counter()
+            images = load_fn(image_pair_path, im_height, im_width)
+            seconds.append(time.perf_counter() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            for image, ref_image in zip(images, ref_images):
+              if image.ndim == 2:
+                ref_image = cv2.cvtColor(ref_image, cv2.COLOR_BGR2GRAY)
+              diffs.append(np.mean(cv2.absdiff(image, ref_image)))
+        target_results[loader] = {'ms_per_pair': 1000.0 * np.mean(seconds),
+                                  'peak_mb': max(peaks) / 1024.0**2,
+                                  'mean_abs_diff': float(np.mean(diffs))}
+      results[target] = target_results
+  finally:
+    decode_pool.shutdown()
+    shutil.rmtree(data_dir)
+  return results
+
+
+def print_decode(results):
+  """print the results from `benchmark_decode`"""
+  print('{:<10s} {:<22s} {:>10s} {:>8s} {:>9s} {:>6s}'.format(
+    'target', 'decode', 'ms/pair', 'speedup', 'peak MB', 'diff'))
+  for target, target_results in results.items():
+    base = target_results['imread']
+    for loader, result in target_results.items():
+      print('{:<10s} {:<22s} {:10.2f} {:7.2f}x {:9.2f} {:6.2f}'.format(
+        target, loader, result['ms_per_pair'],
+        base['ms_per_pair'] / result['ms_per_pair'], result['peak_mb'],
+        result['mean_abs_diff']))
+
+
+def environment_info():
+  """info about where the benchmark was run, to check results compare"""
+  return {'host': socket.gethostname(),
+          'platform': platform.platform(),
+          'python': platform.python_version(),
+          'numpy': np.__version__,
+          'opencv': cv2.__version__,
+          'cpu_count': os.cpu_count(),
+          'created': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def case_name(height, width, max_disparity):
+  """name of a benchmark case, eg. `540x960_md128`"""
+  return '{}x{}_md{}'.format(height, width, max_disparity)
+
+
+def run_benchmark(args):
+  """make the synthetic data, run every case and save the results"""
+  data_dir = args.data_dir
+  if data_dir is None:
+    data_dir = tempfile.mkdtemp(prefix='stereo_benchmark_')
+  rng = np.random.RandomState(args.seed)
+  results = {'version': RESULTS_VERSION,
+             'environment': environment_info(),
+             'config': {'resolutions': args.resolutions,
+                        'max_disparities': args.max_disparities,
+                        'pairs': args.pairs, 'repeats': args.repeats,
+                        'workers': args.workers, 'seed': args.seed,
+                        'block_size': args.block_size, 'lmbda': args.lmbda,
+                        'sigma': args.sigma},
+             'cases': {}}
+  try:
+    for resolution in args.resolutions:
+      height, width = parse_resolution(resolution)
+      for max_disparity in args.max_disparities:
+        name = case_name(height, width, max_disparity)
+        print('case {}'.format(name))
+        image_path_list = make_case_data(os.path.join(data_dir, name), rng,
+                                         height, width, max_disparity,
+                                         args.pairs)
+        image_pair_paths = create_depth_map.read_image_path_list(
+          image_path_list)
+        case = benchmark_stages(image_pair_paths, args, max_disparity,
+                                height, width)
+        case['throughput'] = [
+          benchmark_throughput(image_path_list, len(image_pair_paths), args,
+                               max_disparity, height, width, workers)
+          for workers in args.workers]
+        results['cases'][name] = case
+        print_case(case)
+  finally:
+    if args.data_dir is None:
+      shutil.rmtree(data_dir, ignore_errors=True)
+  with open(args.results, 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+  print('results saved to {}'.format(args.results))
+
+
+def print_case(case):
+  """print the results for a single case"""
+  for stage, times in sorted(case['stages'].items(),
+                             key=lambda x: -x[1]['mean']):
+    print('  {:<16s} mean {:8.4f}s  min {:8.4f}s'.format(
+      stage, times['mean'], times['min']))
+  print('  {:<16s} mean {:8.4f}s'.format('pair total',
+                                          case['pair_seconds']['mean']))
+  print('  accuracy         epe {:.3f}px  bad1 {:.2%}'.format(
+    case['epe'], case['bad1']))
+  for throughput in case['throughput']:
+    print('  workers {:<3d}      {:.3f} pairs/s'.format(
+      throughput['workers'], throughput['pairs_per_second']))
+
+
+def compare_results(baseline, candidate, threshold):
+  """compare two sets of benchmark results
+
+  Args:
+    baseline (dict):
+      results from before a change
+    candidate (dict):
+      results from after the change
+    threshold (float):
+      relative slow down (eg. 0.1 for 10%) to count as a regression
+
+  Returns:
+    list of (case, metric, baseline value, candidate value, is regression)
+    for every metric in both
+  """
+  rows = []
+  for name in sorted(set(baseline['cases']) & set(candidate['cases'])):
+    base_case = baseline['cases'][name]
+    cand_case = candidate['cases'][name]
+    # for times bigger is worse
+    for stage in sorted(set(base_case['stages']) & set(cand_case['stages'])):
+      base_value = base_case['stages'][stage]['mean']
+      cand_value = cand_case['stages'][stage]['mean']
+      rows.append((name, stage, base_value, cand_value,
+                   cand_value > base_value * (1.0 + threshold)))
+    rows.append((name, 'pair total', base_case['pair_seconds']['mean'],
+                 cand_case['pair_seconds']['mean'],
+                 cand_case['pair_seconds']['mean'] >
+                 base_case['pair_seconds']['mean'] * (1.0 + threshold)))
+    # for throughput smaller is worse
+    base_throughput = {x['workers']: x['pairs_per_second']
+                       for x in base_case['throughput']}
+    for throughput in cand_case['throughput']:
+      base_value = base_throughput.get(throughput['workers'])
+      if base_value is None:
+        continue
+      cand_value = throughput['pairs_per_second']
+      rows.append((name, 'pairs/s x{}'.format(throughput['workers']),
+                   base_value, cand_value,
+                   cand_value < base_value / (1.0 + threshold)))
+    # accuracy shouldn't change unless the matcher has, flag if it got worse
+    rows.append((name, 'bad1', base_case['bad1'], cand_case['bad1'],
+                 cand_case['bad1'] > base_case['bad1'] + 0.01))
+  return rows
+
+
+def compare_benchmark(args):
+  """print a comparison of two result files
+
+  Returns:
+    number of regressions
+  """
+  with open(args.baseline) as f:
+    baseline = json.load(f)
+  with open(args.candidate) as f:
+    candidate = json.load(f)
+  if baseline['environment']['host'] != candidate['environment']['host']:
+    print('WARNING: results are from different hosts ({} and {}), timings '
+          'may not be comparable'.format(baseline['environment']['host'],
+                                         candidate['environment']['host']))
+  rows = compare_results(baseline, candidate, args.threshold)
+  print('{:<18s} {:<18s} {:>12s} {:>12s} {:>8s}'.format(
+    'case', 'metric', 'baseline', 'candidate', 'change'))
+  num_regressions = 0
+  for name, metric, base_value, cand_value, is_regression in rows:
+    change = (cand_value - base_value) / base_value if base_value else 0.0
+    num_regressions += is_regression
+    print('{:<18s} {:<18s} {:>12.4f} {:>12.4f} {:>+7.1%}{}'.format(
+      name, metric, base_value, cand_value, change,
+      '  REGRESSION' if is_regression else ''))
+  print('{} regressions'.format(num_regressions))
+  return num_regressions
+
+
+def parse_resolution(resolution):
+  """parse a resolution like `540x960` into (height, width)
+
+  Raises:
+    ValueError if it isn't valid
+  """
+  try:
+    height, width = [int(x) for x in resolution.lower().split('x')]
+  except ValueError:
+    raise ValueError(
+      'Invalid resolution, must be HEIGHTxWIDTH: {}'.format(resolution))
+  if (height < 32) or (width < 32):
+    raise ValueError(
+      'Invalid resolution, must be at least 32x32: {}'.format(resolution))
+  return height, width
+
+
+def check_cmdline_args(args):
+  """check the args for `run` are valid
+
+  Raises:
+    ValueError if any of them aren't
+  """
+  for resolution in args.resolutions:
+    height, width = parse_resolution(resolution)
+    for max_disparity in args.max_disparities:
+      if (max_disparity <= 0) or (max_disparity % 16 != 0):
+        raise ValueError(
+          'Invalid value for max disparity, must be > 0 and divisible by '
+          '16: {}'.format(max_disparity))
+      if max_disparity * 2 >= width:
+        raise ValueError(
+          'Max disparity {} is too big for width {}'.format(max_disparity,
+                                                            width))
+  for name in ['pairs', 'repeats']:
+    if getattr(args, name) < 1:
+      raise ValueError('Invalid value for {}, must be >= 1: {}'.format(
+        name, getattr(args, name)))
+  if min(args.workers) < 1:
+    raise ValueError(
+      'Invalid value for workers, must be >= 1: {}'.format(args.workers))
+
+
+if __name__ == '__main__':
+  """Loading in command line arguments.
+
+  Has five commands,
+    run: run the benchmark and save the results
+    compare: compare two sets of results
+    sequence: compare the per-pair and temporal engines on a sequence
+    gated: compare the full path and gated engine on synthetic pairs
+    decode: compare imread and resize to reduced scale JPEG decodes
+  """
+  parser = argparse.ArgumentParser(prog='benchmark_pipeline',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  run_parser = subparsers.add_parser('run', help='run the benchmark')
+  run_parser.add_argument('results', type=str,
+                          help='JSON file to save the results to')
+  run_parser.add_argument('--resolutions', type=str, nargs='+',
+                          default=['270x480', '540x960'],
+                          help='HEIGHTxWIDTH of the synthetic pairs')
+  run_parser.add_argument('--max_disparities', type=int, nargs='+',
+                          default=[64, 128],
+                          help='max disparities to run each resolution with')
+  run_parser.add_argument('--pairs', type=int, default=8,
+                          help='number of synthetic pairs for each case')
+  run_parser.add_argument('--repeats', type=int, default=1,
+                          help='times to run the stages on each pair')
+  run_parser.add_argument('--workers', type=int, nargs='+',
+                          default=sorted(set([1, 2, os.cpu_count() or 1])),
+                          help='numbers of workers to measure throughput with')
+  run_parser.add_argument('--block_size', type=int, default=5,
+                          help='block size for disparity matcher')
+  run_parser.add_argument('--lmbda', type=int, default=8000,
+                          help='parameter for regularisation when postprocessing')
+  run_parser.add_argument('--sigma', type=float, default=1.2,
+                          help='sensitivity parameter for postprocessing')
+  run_parser.add_argument('--seed', type=int, default=0,
+                          help='random seed for making the synthetic pairs')
+  run_parser.add_argument('--data_dir', type=str, default=None,
+                          help='keep the synthetic pairs here, default is a temp dir that is removed')
+  compare_parser = subparsers.add_parser('compare',
+                                         help='compare two sets of results')
+  compare_parser.add_argument('baseline', type=str,
+                              help='results from before a change')
+  compare_parser.add_argument('candidate', type=str,
+                              help='results from after a change')
+  compare_parser.add_argument('--threshold', type=float, default=0.1,
+                              help='relative slow down to flag as a regression')
+  sequence_parser = subparsers.add_parser(
+    'sequence', help='compare the temporal engine on a synthetic sequence')
+  sequence_parser.add_argument('--frames', type=int, default=60,
+                               help='number of frames in the sequence')
+  sequence_parser.add_argument('--resolution', type=str, default='540x960',
+                               help='HEIGHTxWIDTH of the frames')
+  sequence_parser.add_argument('--max_disparity', type=int, default=64,
+                               help='max disparity for the matcher')
+  sequence_parser.add_argument('--block_size', type=int, default=5,
+                               help='block size for disparity matcher')
+  sequence_parser.add_argument('--lmbda', type=int, default=8000,
+                               help='parameter for regularisation when postprocessing')
+  sequence_parser.add_argument('--sigma', type=float, default=1.2,
+                               help='sensitivity parameter for postprocessing')
+  sequence_parser.add_argument('--temporal_band', type=int, default=4,
+                               help='pixels either side of the previous frame to search')
+  sequence_parser.add_argument('--scene_cut', type=float, default=0.1,
+                               help='mean image change that forces a full search')
+  sequence_parser.add_argument('--stable_change', type=float, default=0.005,
+                               help='pixel change below which tiles reuse the previous frame')
+  sequence_parser.add_argument('--keyframe_interval', type=int, default=30,
+                               help='max frames between full searches')
+  sequence_parser.add_argument('--seed', type=int, default=0,
+                               help='random seed for making the sequence')
+  sequence_parser.add_argument('--json', type=str, default=None,
+                               help='also save the results to this JSON file')
+  gated_parser = subparsers.add_parser(
+    'gated', help='compare the gated engine on synthetic pairs')
+  gated_parser.add_argument('--pairs', type=int, default=8,
+                            help='number of synthetic pairs')
+  gated_parser.add_argument('--resolution', type=str, default='540x960',
+                            help='HEIGHTxWIDTH of the pairs')
+  gated_parser.add_argument('--max_disparity', type=int, default=128,
+                            help='max disparity for the matcher')
+  gated_parser.add_argument('--block_size', type=int, default=5,
+                            help='block size for disparity matcher')
+  gated_parser.add_argument('--lmbda', type=int, default=8000,
+                            help='parameter for regularisation when postprocessing')
+  gated_parser.add_argument('--sigma', type=float, default=1.2,
+                            help='sensitivity parameter for postprocessing')
+  gated_parser.add_argument('--thresholds', type=float, nargs='+',
+                            default=[0.01, 0.02, 0.05, 0.1],
+                            help='gate thresholds to try')
+  gated_parser.add_argument('--seed', type=int, default=0,
+                            help='random seed for making the pairs')
+  gated_parser.add_argument('--json', type=str, default=None,
+                            help='also save the results to this JSON file')
+  decode_parser = subparsers.add_parser(
+    'decode', help='compare imread and resize to reduced scale decodes')
+  decode_parser.add_argument('--pairs', type=int, default=8,
+                             help='number of synthetic pairs')
+  decode_parser.add_argument('--source', type=str, default='1080x1920',
+                             help='HEIGHTxWIDTH the JPEGs are saved at')
+  decode_parser.add_argument('--targets', type=str, nargs='+',
+                             default=['1080x1920', '540x960', '270x480',
+                                      '135x240'],
+                             help='HEIGHTxWIDTH to load the JPEGs at')
+  decode_parser.add_argument('--threads', type=int, default=2,
+                             help='threads to decode on in the threaded runs')
+  decode_parser.add_argument('--repeats', type=int, default=3,
+                             help='times to load each pair')
+  decode_parser.add_argument('--seed', type=int, default=0,
+                             help='random seed for making the pairs')
+  decode_parser.add_argument('--json', type=str, default=None,
+                             help='also save the results to this JSON file')
+  args = parser.parse_args(sys.argv[1:])
+  if args.command == 'run':
+    check_cmdline_args(args)
+    run_benchmark(args)
+  elif args.command == 'compare':
+    if compare_benchmark(args):
+      sys.exit(1)
+  elif args.command == 'sequence':
+    results = benchmark_sequence(args)
+    print_sequence(results)
+    if args.json is not None:
+      with open(args.json, 'w') as f:
+        json.dump({'environment': environment_info(),
+                   'config': vars(args), 'engines': results}, f, indent=2,
+                  sort_keys=True)
+  elif args.command == 'gated':
+    results = benchmark_gated(args)
+    print_gated(results)
+    if args.json is not None:
+      with open(args.json, 'w') as f:
+        json.dump({'environment': environment_info(),
+                   'config': vars(args), 'engines': results}, f, indent=2,
+                  sort_keys=True)
+  elif args.command == 'decode':
+    for name in ['pairs', 'threads', 'repeats']:
+      if getattr(args, name) < 1:
+        raise ValueError('Invalid value for {}, must be >= 1: {}'.format(
+          name, getattr(args, name)))
+    results = benchmark_decode(args)
+    print_decode(results)
+    if args.json is not None:
+      with open(args.json, 'w') as f:
+        json.dump({'environment': environment_info(),
+                   'config': vars(args), 'targets': results}, f, indent=2,
+                  sort_keys=True)
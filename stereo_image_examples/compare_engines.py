@@ -0,0 +1,156 @@
+"""compare_engines.py
+
+Compares the coarse-to-fine pyramid engine against the normal full range
+SGBM engine from `create_depth_map.py` on a sample of image pairs.
+
+For each pair will time both engines (matching plus WLS filtering) and then
+compare the filtered disparity maps from the pyramid engine against the full
+range ones, which we treat as the reference. Quality is reported as the mean
+absolute difference in pixels and the percentage of pixels that are out by
+more than one pixel.
+"""
+import numpy as np
+import argparse
+import random
+import sys
+import time
+
+import create_depth_map
+
+
+def time_engine(engine_fn, num_repeats):
+  """run an engine a few times and return the best time and its output
+
+  Args:
+    engine_fn (callable):
+      function with no args that returns the filtered disparity map
+    num_repeats (int):
+      number of times to run the engine
+
+  Returns:
+    tuple of (best time in seconds, filtered disparity map)
+  """
+  best_time = float('inf')
+  filtered = None
+  for _ in range(num_repeats):
+    start = time.perf_counter()
+    filtered = engine_fn()
+    best_time = min(best_time, time.perf_counter() - start)
+  return best_time, filtered
+
+
+def compare_disparity(reference, candidate):
+  """compare two filtered disparity maps
+
+  Both are in the 16x fixed point format the filter returns, so will scale
+  them back to pixels first.
+
+  Args:
+    reference (array):
+      filtered disparity from the full range engine
+    candidate (array):
+      filtered disparity from the pyramid engine
+
+  Returns:
+    tuple of (mean absolute difference in pixels,
+              fraction of pixels that differ by more than one pixel)
+  """
+  diff = np.abs(reference.astype(np.float32) -
+                candidate.astype(np.float32)) / 16.0
+  return float(np.mean(diff)), float(np.mean(diff > 1.0))
+
+
+def main(args):
+  """compare the pyramid engine to full range SGBM on a sample of pairs"""
+  with open(args.image_path_list) as f:
+    image_pair_paths = [x.rstrip() for x in f.readlines() if x.strip()]
+  random.seed(args.seed)
+  if args.num_samples < len(image_pair_paths):
+    image_pair_paths = random.sample(image_pair_paths, args.num_samples)
+  left_matcher, right_matcher = create_depth_map.create_matchers(
+    args.max_disparity, args.block_size, args.p1, args.p2)
+  wls_filter = create_depth_map.create_wls_filter(left_matcher, args.lmbda,
+                                                  args.sigma)
+
+  def run_sgbm():
+    displ = left_matcher.compute(left_im, right_im)
+    dispr = right_matcher.compute(right_im, left_im)
+    return wls_filter.filter(displ, left_im, disparity_map_right=dispr)
+
+  def run_pyramid():
+    displ, dispr = create_depth_map.compute_pyramid_disparity(
+      left_im, right_im, args.max_disparity, args.block_size, args.p1,
+      args.p2, args.pyramid_levels, args.pyramid_band)
+    return wls_filter.filter(displ, left_im, disparity_map_right=dispr)
+
+  sgbm_times, pyramid_times, mean_diffs, bad_fractions = [], [], [], []
+  print('{:<40s} {:>9s} {:>9s} {:>8s} {:>8s}'.format(
+    'pair', 'sgbm (s)', 'pyr (s)', 'mad (px)', 'bad1'))
+  for image_pair in image_pair_paths:
+    left_im, right_im = create_depth_map.read_resize_images(
+      image_pair, args.im_height, args.im_width)
+    sgbm_time, reference = time_engine(run_sgbm, args.repeats)
+    pyramid_time, candidate = time_engine(run_pyramid, args.repeats)
+    mean_diff, bad_fraction = compare_disparity(reference, candidate)
+    sgbm_times.append(sgbm_time)
+    pyramid_times.append(pyramid_time)
+    mean_diffs.append(mean_diff)
+    bad_fractions.append(bad_fraction)
+    print('{:<40s} {:>9.3f} {:>9.3f} {:>8.3f} {:>8.2%}'.format(
+      image_pair[-40:], sgbm_time, pyramid_time, mean_diff, bad_fraction))
+  print('')
+  print('pairs compared:         {}'.format(len(image_pair_paths)))
+  print('mean sgbm time (s):     {:.3f}'.format(np.mean(sgbm_times)))
+  print('mean pyramid time (s):  {:.3f}'.format(np.mean(pyramid_times)))
+  print('speedup:                {:.2f}x'.format(
+    np.sum(sgbm_times) / np.sum(pyramid_times)))
+  print('mean abs diff (px):     {:.3f}'.format(np.mean(mean_diffs)))
+  print('mean bad1 pixels:       {:.2%}'.format(np.mean(bad_fractions)))
+
+
+if __name__ == '__main__':
+  """Loading in command line arguments.
+
+  Matcher params are the same as for `create_depth_map.py`, and are checked
+  the same way.
+  """
+  parser = argparse.ArgumentParser(prog='compare_engines',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('image_path_list',
+                      type=str,
+                      help='text file with path to images')
+  parser.add_argument('--num_samples', type=int, default=10,
+                      help='number of pairs to compare on')
+  parser.add_argument('--seed', type=int, default=1189998819991197253,
+                      help='random seed for choosing pairs')
+  parser.add_argument('--repeats', type=int, default=1,
+                      help='times to run each engine per pair, best is kept')
+  parser.add_argument('--im_height', type=int, default=1080,
+                      help='height of image to be reshaped to')
+  parser.add_argument('--im_width', type=int, default=1920,
+                      help='width of image to be reshaped to')
+  parser.add_argument('--max_disparity', type=int, default=160,
+                      help='maximum disparity for matcher to search to')
+  parser.add_argument('--block_size', type=int, default=15,
+                      help='block size for disparity matcher')
+  parser.add_argument('--p1', type=int, default=None,
+                      help='smoothness param')
+  parser.add_argument('--p2', type=int, default=None,
+                      help='smoothness param')
+  parser.add_argument('--lmbda', type=int, default=8000,
+                      help='parameter for regularisation when postprocessing')
+  parser.add_argument('--sigma', type=float, default=1.2,
+                      help='sensitivity parameter for postprocessing')
+  parser.add_argument('--pyramid_levels', type=int, default=2,
+                      help='number of times to halve resolution for pyramid')
+  parser.add_argument('--pyramid_band', type=int, default=4,
+                      help='pixels either side of coarse estimate to search')
+  args = parser.parse_args(sys.argv[1:])
+  create_depth_map.check_matcher_args(args)
+  if (args.pyramid_levels < 1) or (args.pyramid_band < 1):
+    raise ValueError(
+      'Invalid pyramid params, must be >= 1: {} {}'.format(
+        args.pyramid_levels, args.pyramid_band))
+  main(args)
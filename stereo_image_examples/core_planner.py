@@ -0,0 +1,350 @@
+"""core_planner.py
+
+Works out how many cores we have actually been given, and how to split them
+between worker processes and OpenCV's own threads.
+
+OpenCV runs parts of SGBM and the WLS filter across its own pool of threads,
+which by default is as big as the whole node, not what PBS gave the job. So
+with a few worker processes each running a full size OpenCV pool, there are
+far more threads than cores and they all get in each other's way. The
+number of cores we can use is the smallest of
+  - the CPU quota of our cgroup (v1 or v2), if there is one
+  - the cores in our affinity mask
+  - the cores PBS gave us on this node, from `NCPUS` or the number of times
+    this host is in `PBS_NODEFILE`
+
+and those are split up between the workers, with each worker's OpenCV
+threads set to its share and (optionally) each worker pinned to its own set
+of cores so they don't move around and thrash each others caches.
+
+Can also be run as a script,
+  show: print the cores found from each source and the plan for them
+  calibrate: time a few splits of workers and threads on synthetic pairs
+             on this node, and save the best one for
+             `create_depth_map.py --core_plan`, eg.
+
+  python core_planner.py calibrate --out core_plan.json
+  python create_depth_map.py image_00.txt --core_plan core_plan.json
+"""
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+import cv2
+
+
+# workers to run, OpenCV threads for each of them, and cores each is pinned
+# to (or None to not pin)
+CorePlan = collections.namedtuple('CorePlan',
+                                  ['workers', 'cv_threads', 'cpu_sets'])
+
+
+def cgroup_cpu_quota():
+  """CPU quota from our cgroup, in cores
+
+  Checks our own cgroup and all its parents, as a limit on any of them
+  applies to us.
+
+  Returns:
+    number of cores the quota allows (can be a fraction), or None if there
+    is no quota
+  """
+  try:
+    with open('/proc/self/cgroup') as f:
+      lines = [x.rstrip('\n').split(':', 2) for x in f]
+  except IOError:
+    return None
+  quotas = []
+  for _, controllers, path in lines:
+    if controllers == '':
+      # cgroup v2, quota and period are both in cpu.max
+      base, names = '/sys/fs/cgroup', ['cpu.max']
+    elif 'cpu' in controllers.split(','):
+      base = '/sys/fs/cgroup/{}'.format(controllers)
+      names = ['cpu.cfs_quota_us', 'cpu.cfs_period_us']
+    else:
+      continue
+    parts = path.strip('/').split('/') if path.strip('/') else []
+    for depth in range(len(parts) + 1):
+      cgroup_dir = os.path.join(base, *parts[:depth])
+      try:
+        values = []
+        for name in names:
+          with open(os.path.join(cgroup_dir, name)) as f:
+            values.extend(f.read().split())
+      except IOError:
+        continue
+      if values[0] not in ['max', '-1']:
+        quotas.append(float(values[0]) / float(values[1]))
+  return min(quotas) if quotas else None
+
+
+def affinity_cpus():
+  """cores this process is allowed to run on, sorted"""
+  if hasattr(os, 'sched_getaffinity'):
+    return sorted(os.sched_getaffinity(0))
+  return list(range(os.cpu_count() or 1))
+
+
+def pbs_cpus():
+  """cores PBS gave this job on this node, or None if not in a PBS job"""
+  if os.environ.get('NCPUS', '').isdigit():
+    return int(os.environ['NCPUS'])
+  node_file = os.environ.get('PBS_NODEFILE')
+  if not node_file or not os.path.isfile(node_file):
+    return None
+  # the node file lists a host once for each core we have on it
+  host = socket.gethostname().split('.')[0]
+  with open(node_file) as f:
+    count = sum(1 for x in f if x.strip().split('.')[0] == host)
+  return count if count > 0 else None
+
+
+def cpu_allowance():
+  """the cores we can actually use, and where each limit came from
+
+  Returns:
+    dict with `cores` we can use, `cpus` in our affinity mask, and the
+    limit from each of `cgroup`, `affinity` and `pbs` (None if not set)
+  """
+  cpus = affinity_cpus()
+  quota = cgroup_cpu_quota()
+  allowance = {'cpus': cpus,
+               'affinity': len(cpus),
+               'cgroup': quota,
+               'pbs': pbs_cpus()}
+  limits = [len(cpus)]
+  if quota is not None:
+    # a fraction of a core still gets a whole one to run on
+    limits.append(max(1, int(math.floor(quota))))
+  if allowance['pbs'] is not None:
+    limits.append(allowance['pbs'])
+  allowance['cores'] = min(limits)
+  return allowance
+
+
+def split_cpus(cpus, num_sets):
+  """split cores into contiguous sets, one for each worker
+
+  If there are more workers than cores, they share cores in turn.
+  """
+  if num_sets >= len(cpus):
+    return [[cpus[i % len(cpus)]] for i in range(num_sets)]
+  sets = []
+  for i in range(num_sets):
+    start = i * len(cpus) // num_sets
+    stop = (i + 1) * len(cpus) // num_sets
+    sets.append(cpus[start:stop])
+  return sets
+
+
+def plan_cores(workers=None, cv_threads=None, pin=False, allowance=None):
+  """work out how to split the cores we have between workers and threads
+
+  Args:
+    workers (int):
+      number of worker processes, if None uses one for each core, as
+      separate pairs in separate processes scale better than OpenCV's
+      threads within a pair
+    cv_threads (int):
+      OpenCV threads for each worker, if None the cores are shared out
+      between the workers
+    pin (bool):
+      whether to pin each worker to its own set of cores
+    allowance (dict):
+      from `cpu_allowance`, is looked up if None
+
+  Returns:
+    CorePlan
+  """
+  if allowance is None:
+    allowance = cpu_allowance()
+  cores = allowance['cores']
+  if workers is None:
+    workers = cores
+  if cv_threads is None:
+    cv_threads = max(1, cores // workers)
+  cpu_sets = None
+  if pin:
+    # only pin to as many of the allowed cpus as we have cores for
+    cpu_sets = split_cpus(allowance['cpus'][:cores], workers)
+  return CorePlan(workers, cv_threads, cpu_sets)
+
+
+def read_core_plan(plan_path):
+  """read the workers and threads saved by `calibrate`
+
+  Returns:
+    tuple of (workers, cv_threads)
+  """
+  with open(plan_path) as f:
+    plan = json.load(f)
+  return plan['workers'], plan['cv_threads']
+
+
+def configure_worker(cv_threads, cpu_sets=None):
+  """set the OpenCV threads for this process, and pin it if needed
+
+  Is called from each worker when it starts, pool workers are numbered from
+  1 in the order they are started so each one picks its own set of cores.
+
+  Args:
+    cv_threads (int):
+      number of threads for OpenCV to use
+    cpu_sets (list(list(int))):
+      cores for each worker, or None to not pin
+  """
+  cv2.setNumThreads(cv_threads)
+  if cpu_sets and hasattr(os, 'sched_setaffinity'):
+    identity = multiprocessing.current_process()._identity
+    index = (identity[0] - 1) if identity else 0
+    os.sched_setaffinity(0, cpu_sets[index % len(cpu_sets)])
+
+
+def describe_plan(plan, allowance):
+  """one line description of a plan, for the logs"""
+  return ('{} workers with {} OpenCV threads each on {} cores '
+          '(cgroup {}, affinity {}, pbs {}){}'.format(
+            plan.workers, plan.cv_threads, allowance['cores'],
+            allowance['cgroup'], allowance['affinity'], allowance['pbs'],
+            ', pinned' if plan.cpu_sets else ''))
+
+
+# engine and pair for each calibration worker
+_calibration_state = {}
+
+
+def init_calibration_worker(cv_threads, cpu_sets, im_height, im_width,
+                            max_disparity, block_size):
+  """make an engine and a synthetic pair for calibrating, and warm it up"""
+  # imported here, as these import `create_depth_map` which imports us
+  import benchmark_pipeline
+  import depth_map_engine
+  configure_worker(cv_threads, cpu_sets)
+  engine = depth_map_engine.DepthMapEngine(im_height, im_width,
+                                           max_disparity, block_size)
+  rng = np.random.RandomState(0)
+  left, right, _ = benchmark_pipeline.make_synthetic_pair(
+    rng, im_height, im_width, max_disparity)
+  _calibration_state['engine'] = engine
+  _calibration_state['pair'] = (left, right)
+  engine.compute(left, right)
+
+
+def calibration_task(_):
+  """compute the disparity for the synthetic pair once"""
+  _calibration_state['engine'].compute(*_calibration_state['pair'])
+
+
+def candidate_splits(cores):
+  """splits of workers and threads to try, using all the cores"""
+  workers = set([cores])
+  num_workers = 1
+  while num_workers < cores:
+    workers.add(num_workers)
+    num_workers *= 2
+  return [(x, max(1, cores // x)) for x in sorted(workers)]
+
+
+def calibrate(args):
+  """time each split of workers and threads, and save the quickest
+
+  Returns:
+    list of results for each split, quickest first
+  """
+  allowance = cpu_allowance()
+  print('found {} cores (cgroup {}, affinity {}, pbs {})'.format(
+    allowance['cores'], allowance['cgroup'], allowance['affinity'],
+    allowance['pbs']))
+  results = []
+  for workers, cv_threads in candidate_splits(allowance['cores']):
+    plan = plan_cores(workers, cv_threads, args.pin, allowance)
+    init_args = (plan.cv_threads, plan.cpu_sets, args.im_height,
+                 args.im_width, args.max_disparity, args.block_size)
+    pool = multiprocessing.Pool(workers, initializer=init_calibration_worker,
+                                initargs=init_args)
+    # make sure every worker has started and warmed up before timing
+    pool.map(time.sleep, [0.1] * workers, chunksize=1)
+    num_pairs = workers * args.pairs_per_worker
+    start_time = time.perf_counter()
+    pool.map(calibration_task, range(num_pairs), chunksize=1)
+    seconds = time.perf_counter() - start_time
+    pool.close()
+    pool.join()
+    results.append({'workers': workers, 'cv_threads': cv_threads,
+                    'pin': args.pin, 'pairs': num_pairs, 'seconds': seconds,
+                    'pairs_per_second': num_pairs / seconds})
+    print('{:>3d} workers x {:>3d} threads: {:8.3f} pairs/s'.format(
+      workers, cv_threads, results[-1]['pairs_per_second']))
+  results.sort(key=lambda x: -x['pairs_per_second'])
+  best = dict(results[0])
+  best.update({'cores': allowance['cores'], 'host': socket.gethostname(),
+               'im_height': args.im_height, 'im_width': args.im_width,
+               'max_disparity': args.max_disparity,
+               'block_size': args.block_size})
+  print('best: {} workers with {} OpenCV threads each'.format(
+    best['workers'], best['cv_threads']))
+  if args.out is not None:
+    with open(args.out, 'w') as f:
+      json.dump(best, f, indent=2, sort_keys=True)
+  return results
+
+
+def main(args):
+  """show the cores we have, or calibrate the best way to use them"""
+  if args.command == 'show':
+    allowance = cpu_allowance()
+    plan = plan_cores(args.workers, args.cv_threads, args.pin, allowance)
+    print(describe_plan(plan, allowance))
+    if plan.cpu_sets:
+      for i, cpu_set in enumerate(plan.cpu_sets):
+        print('  worker {}: cores {}'.format(i, cpu_set))
+  elif args.command == 'calibrate':
+    calibrate(args)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='core_planner',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  show_parser = subparsers.add_parser('show',
+                                      help='show the cores found and the plan')
+  show_parser.add_argument('--workers', type=int, default=None,
+                           help='number of workers, default is one per core')
+  show_parser.add_argument('--cv_threads', type=int, default=None,
+                           help='OpenCV threads per worker, default shares out the cores')
+  show_parser.add_argument('--pin', action='store_true',
+                           help='pin each worker to its own cores')
+  calibrate_parser = subparsers.add_parser(
+    'calibrate', help='time splits of workers and threads on this node')
+  calibrate_parser.add_argument('--im_height', type=int, default=540,
+                                help='height of the synthetic pairs')
+  calibrate_parser.add_argument('--im_width', type=int, default=960,
+                                help='width of the synthetic pairs')
+  calibrate_parser.add_argument('--max_disparity', type=int, default=64,
+                                help='max disparity for the matcher')
+  calibrate_parser.add_argument('--block_size', type=int, default=5,
+                                help='block size for the matcher')
+  calibrate_parser.add_argument('--pairs_per_worker', type=int, default=4,
+                                help='pairs each worker computes for the timing')
+  calibrate_parser.add_argument('--pin', action='store_true',
+                                help='pin each worker to its own cores')
+  calibrate_parser.add_argument('--out', type=str, default=None,
+                                help='save the best split here, for create_depth_map.py --core_plan')
+  args = parser.parse_args(sys.argv[1:])
+  for name in ['workers', 'cv_threads', 'pairs_per_worker']:
+    value = getattr(args, name, None)
+    if (value is not None) and (value < 1):
+      raise ValueError('Invalid value for {}, must be >= 1: {}'.format(
+        name, value))
+  main(args)
@@ -5,11 +5,37 @@ taken largely from
 https://timosam.com/python_opencv_depthimage/#
 """
 import numpy as np
-from sklearn.preprocessing import normalize
 import cv2
 import argparse
 import sys
 import os
+import json
+import resource
+import socket
+import functools
+import multiprocessing
+import multiprocessing.util
+import traceback
+import threading
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import archive_dataset
+import core_planner
+import disparity_store
+import image_cache
+import pack_dataset
+import run_manifest
+import shard_planner
+import work_queue
+
+
+# matchers and WLS filter used by this process. These are built once per
+# worker process in `init_worker`, so they never have to be pickled and sent
+# across along with every image pair
+_worker_state = {}
+
 
 def create_matchers(max_disparity, block_size, p1, p2):
   """create left and right stereo matchers.
@@ -42,10 +68,10 @@ def create_matchers(max_disparity, block_size, p1, p2):
   # create left matcher
   left_matcher = cv2.StereoSGBM_create(
     minDisparity=0,
-    numDisparities=args.max_disparity,
-    blockSize=args.block_size,
-    P1=args.p1,    
-    P2=args.p2,
+    numDisparities=max_disparity,
+    blockSize=block_size,
+    P1=p1,
+    P2=p2,
     disp12MaxDiff=1,
     uniquenessRatio=15,
     speckleWindowSize=1000,
@@ -108,169 +134,2226 @@ def compute_disparity_and_filter(left_matcher, right_matcher,
   """
   # read images in and resize if needed
   left_im, right_im = read_resize_images(image_pair_path, im_height, im_width)
+  return compute_disparity_from_images(left_matcher, right_matcher,
+                                       wls_filter, left_im, right_im)
+
+
+def compute_disparity_from_images(left_matcher, right_matcher,
+                                  wls_filter, left_im, right_im,
+                                  timings=None, to_uint8=True):
+  """compute disparity map and then apply wls filter to images already loaded
+
+  Same as `compute_disparity_and_filter`, but for when the images have
+  already been read and resized somewhere else (such as by the reader
+  threads when running as a pipeline).
+
+  Args:
+    left_matcher (SGBM matcher object):
+      matcher for left image in stereo pair
+    right_matcher (SGBM matcher object):
+      matcher for right image in stereo pair
+    wls_filter (WLS Filter Object):
+      filter to post-process the disparity map
+    left_im (array):
+      left image of the stereo pair, already resized
+    right_im (array):
+      right image of the stereo pair, already resized
+    timings (dict):
+      if not None, time spent in each stage is added to this, along with
+      the range of the disparity maps. Refer to `new_timings`
+    to_uint8 (bool):
+      if False, the filtered disparity is returned as the raw int16 16x
+      fixed point values rather than being cast to uint8
+
+  Returns:
+    disparity map computed on the images that was then filtered
+
+  Raises:
+    NA
+  """
   # compute disparity maps for left and right images
+  start = time.perf_counter()
   displ = left_matcher.compute(left_im, right_im)  # .astype(np.float32)/16
+  start = record_time(timings, 'left_match', start)
   dispr = right_matcher.compute(right_im, left_im)  # .astype(np.float32)/16
+  start = record_time(timings, 'right_match', start)
   #displ = np.int16(displ)
   #dispr = np.int16(dispr)
   filtered_im = wls_filter.filter(displ, left_im, disparity_map_right=dispr)
+  start = record_time(timings, 'wls_filter', start)
   #  filtered_im = cv2.normalize(src=filtered_im, dst=filtered_im,
   #                              beta=0.0, alpha=1.0, norm_type=cv2.NORM_MINMAX);
-  print(np.max(displ))
-  print(np.min(dispr))
-  print(np.max(filtered_im))
-  print(np.min(filtered_im))
-  filtered_im = np.uint8(filtered_im)
+  if timings is not None:
+    # these used to just be printed, keeping them with the timings so they
+    # are still around for checking on things
+    timings['disp_range'] = [int(np.max(displ)), int(np.min(dispr)),
+                             int(np.max(filtered_im)), int(np.min(filtered_im))]
+    start = time.perf_counter()
+  if to_uint8:
+    filtered_im = np.uint8(filtered_im)
+    record_time(timings, 'to_uint8', start)
   return filtered_im
   
   
-def read_resize_images(image_pair_path, im_height, im_width):
-  """read image pair from supplied path and resize if needed
+def _round_up_16(value):
+  """round a disparity range up to the next multiple of 16, as SGBM needs"""
+  return max(16, int(16 * np.ceil(value / 16.0)))
+
+
+def compute_band_disparity(left_im, right_im, coarse_disp, max_disparity,
+                           block_size, p1, p2, band, strip_height=64,
+                           compute_right=False):
+  """compute disparity, only searching a narrow band around a coarse estimate
+
+  SGBM can't search a different range for every pixel, so instead the image
+  is split into horizontal strips, and each strip is searched from the
+  smallest to the largest coarse disparity within it, plus `band` pixels
+  either side. Strips are padded with a few extra rows so the matching
+  window has context at the edges.
 
   Args:
-    image_pair_path (str):
-      path to the image pair
-    im_height (int):
-      height of image to be resized to
-    im_width (int):
-      width of image to be resized to
+    left_im (array):
+      left image at this level of the pyramid
+    right_im (array):
+      right image at this level of the pyramid
+    coarse_disp (array):
+      float32 disparity in pixels at this level, upsampled from the
+      previous level. Negative values are treated as invalid.
+    max_disparity (int):
+      max disparity at this level
+    block_size (int):
+      size of the window for matcher
+    p1 (float):
+      smoothing param
+    p2 (float):
+      smoothing param
+    band (int):
+      number of pixels either side of the coarse estimate to search
+    strip_height (int):
+      number of rows in each strip
+    compute_right (bool):
+      whether to also compute the disparity for the right image, which is
+      needed for WLS filtering at the final level
 
   Returns:
-    left and right images of correct size
+    left and right disparity maps as int16 with 4 fractional bits, the same
+    as from the full range matchers. Right disparity is None if
+    `compute_right` is False. Invalid pixels are set to the same value the
+    full range matchers would give them.
+  """
+  im_height = left_im.shape[0]
+  pad = block_size
+  displ = np.full(left_im.shape[:2], -16, dtype=np.int16)
+  dispr = None
+  if compute_right:
+    # right matcher for the full range has minDisparity = 1 - max_disparity
+    # so invalid pixels are one less than that
+    dispr = np.full(left_im.shape[:2], -16 * max_disparity, dtype=np.int16)
+  for y0 in range(0, im_height, strip_height):
+    y1 = min(y0 + strip_height, im_height)
+    coarse_strip = coarse_disp[y0:y1]
+    valid = coarse_strip[coarse_strip >= 0]
+    if valid.size == 0:
+      # nothing to go off here, so search the full range
+      low, high = 0, max_disparity
+    else:
+      low = int(max(0, np.floor(valid.min() - band)))
+      high = int(min(max_disparity, np.ceil(valid.max() + band)))
+    num_disparities = _round_up_16(high - low)
+    # make sure the search doesn't go past what the full range would do
+    low = max(0, min(low, max_disparity - num_disparities))
+    left_matcher, right_matcher = create_matchers(num_disparities, block_size,
+                                                  p1, p2)
+    left_matcher.setMinDisparity(low)
+    # pad the strip with some extra rows
+    pad_y0 = max(0, y0 - pad)
+    pad_y1 = min(im_height, y1 + pad)
+    strip_l = left_matcher.compute(left_im[pad_y0:pad_y1],
+                                   right_im[pad_y0:pad_y1])
+    strip_l = strip_l[y0 - pad_y0:y1 - pad_y0]
+    # set invalid pixels to what the full range matcher would use
+    strip_l[strip_l < low * 16] = -16
+    displ[y0:y1] = strip_l
+    if compute_right:
+      right_matcher = cv2.ximgproc.createRightMatcher(left_matcher)
+      strip_r = right_matcher.compute(right_im[pad_y0:pad_y1],
+                                      left_im[pad_y0:pad_y1])
+      strip_r = strip_r[y0 - pad_y0:y1 - pad_y0]
+      strip_r[strip_r < (right_matcher.getMinDisparity() * 16)] = (
+        -16 * max_disparity)
+      dispr[y0:y1] = strip_r
+  return displ, dispr
+
+
+def compute_pyramid_disparity(left_im, right_im, max_disparity, block_size,
+                              p1, p2, levels, band):
+  """compute raw left and right disparity maps coarse-to-fine
+
+  Will first compute disparity over the full search range on images that
+  have been downscaled by 2**levels. This estimate is then upsampled to the
+  next finer level, where only a narrow band around it is searched. Is
+  repeated until back at full resolution.
+
+  The cost of SGBM grows with width x height x disparity range, so is only
+  doing the expensive full range search on the smallest image.
+
+  Args:
+    left_im (array):
+      left image of the stereo pair, already resized
+    right_im (array):
+      right image of the stereo pair, already resized
+    max_disparity (int):
+      max disparity for matcher to search to at full resolution
+    block_size (int):
+      size of the window for matcher
+    p1 (float):
+      smoothing param
+    p2 (float):
+      smoothing param
+    levels (int):
+      number of times to halve the resolution for the coarse estimate
+    band (int):
+      number of pixels either side of the upsampled estimate to search at
+      each finer level
+
+  Returns:
+    left and right disparity maps at full resolution, in the same format as
+    from `left_matcher.compute` and `right_matcher.compute`
 
   Raises:
-    IOError if the path of an image is invalid
+    NA
   """
-  left_im = cv2.resize(cv2.imread(os.path.join(image_pair_path, 'left.jpg')),
-                       (im_width, im_height))
-  right_im = cv2.resize(cv2.imread(os.path.join(image_pair_path, 'right.jpg')),
-                        (im_width, im_height))
-  return left_im, right_im
+  # build the image pyramids, finest level first
+  left_pyramid = [left_im]
+  right_pyramid = [right_im]
+  for _ in range(levels):
+    left_pyramid.append(cv2.pyrDown(left_pyramid[-1]))
+    right_pyramid.append(cv2.pyrDown(right_pyramid[-1]))
+  # full range search on the coarsest level
+  coarse_matcher, _ = create_matchers(
+    _round_up_16(max_disparity / 2.0**levels), block_size, p1, p2)
+  disp = coarse_matcher.compute(left_pyramid[-1],
+                                right_pyramid[-1]).astype(np.float32) / 16.0
+  displ, dispr = None, None
+  for level in range(levels - 1, -1, -1):
+    # upsample the estimate from the coarser level, making sure to scale up
+    # the disparity values as well
+    level_height, level_width = left_pyramid[level].shape[:2]
+    coarse_disp = cv2.resize(disp, (level_width, level_height),
+                             interpolation=cv2.INTER_NEAREST) * 2.0
+    level_max_disparity = _round_up_16(max_disparity / 2.0**level)
+    displ, dispr = compute_band_disparity(
+      left_pyramid[level], right_pyramid[level], coarse_disp,
+      level_max_disparity, block_size, p1, p2, band,
+      compute_right=(level == 0))
+    disp = displ.astype(np.float32) / 16.0
+    # where the refined search didn't find anything, keep the coarse estimate
+    # so the next level still has something to go off
+    disp[displ < 0] = coarse_disp[displ < 0]
+  return displ, dispr
 
 
-def save_disparity_map(filtered_disp, image_pair):
-  """save disparity map
-  
-  Will save it such that it is stored as,
-  └── image_key
-      ├── disp.jpg
-      ├── left.jpg
-      └── right.jpg
-  
-  where `image_key` is given as the base directory in the
-  `image_pair` path.
+def compute_pyramid_disparity_from_images(wls_filter, left_im, right_im,
+                                          max_disparity, block_size, p1, p2,
+                                          levels, band, timings=None,
+                                          to_uint8=True):
+  """compute disparity coarse-to-fine and then apply wls filter
+
+  Pyramid engine alternative to `compute_disparity_from_images`. Refer to
+  `compute_pyramid_disparity` for how the disparity is found.
 
   Args:
-    filtered_disp (array):
-      final disparity map
-    image_pair (str):
-      path to directory containing the two original images, which is where
-      we will save this disparity map
+    wls_filter (WLS Filter Object):
+      filter to post-process the disparity map
+    left_im (array):
+      left image of the stereo pair, already resized
+    right_im (array):
+      right image of the stereo pair, already resized
+    max_disparity (int):
+      max disparity for matcher to search to
+    block_size (int):
+      size of the window for matcher
+    p1 (float):
+      smoothing param
+    p2 (float):
+      smoothing param
+    levels (int):
+      number of pyramid levels below full resolution
+    band (int):
+      number of pixels either side of the coarse estimate to search
+    timings (dict):
+      if not None, time spent in each stage is added to this
+    to_uint8 (bool):
+      if False, the raw int16 filtered disparity is returned
 
   Returns:
+    disparity map computed on the images that was then filtered
+
+  Raises:
     NA
   """
-  cv2.imwrite(os.path.join(image_pair, 'disp.jpg'), filtered_disp)
-  
+  start = time.perf_counter()
+  displ, dispr = compute_pyramid_disparity(left_im, right_im, max_disparity,
+                                           block_size, p1, p2, levels, band)
+  start = record_time(timings, 'pyramid_match', start)
+  filtered_im = wls_filter.filter(displ, left_im, disparity_map_right=dispr)
+  start = record_time(timings, 'wls_filter', start)
+  if to_uint8:
+    filtered_im = np.uint8(filtered_im)
+    record_time(timings, 'to_uint8', start)
+  return filtered_im
 
-def main(args):
-  """Program for performing stereo matching and filtering
-  to create depth maps from a stereo pair.
-  Will first perform stereo matching using the SGBM
-  method [1]. Will then apply the Weigted Least Squared postprocessing
-  to tidy it up [2].
 
-  Please refer to documenetion within these references for info. on what these
-  params are which values are suitable for them.
+def _search_range(prior_disp, band, max_disparity):
+  """disparity range to search around a prior, as (min, number) for SGBM"""
+  valid = prior_disp[prior_disp >= 0]
+  if valid.size == 0:
+    # nothing to go off here, so search the full range
+    low, high = 0, max_disparity
+  else:
+    low = int(max(0, np.floor(valid.min() - band)))
+    high = int(min(max_disparity, np.ceil(valid.max() + band)))
+  num_disparities = min(max_disparity, _round_up_16(high - low))
+  # make sure the search doesn't go past what the full range would do
+  low = max(0, min(low, max_disparity - num_disparities))
+  return low, num_disparities
 
-  # REFERENCES
-  [1] https://docs.opencv.org/3.4/d2/d85/classcv_1_1StereoSGBM.html
-  [2] https://docs.opencv.org/3.4/d9/d51/classcv_1_1ximgproc_1_1DisparityWLSFilter.html
+
+def compute_tile_band_disparity(left_im, right_im, prior_disp, max_disparity,
+                                block_size, p1, p2, band, tile_height=64,
+                                tile_width=128, margin=16, context=16,
+                                max_invalid=0.1, prev_displ=None,
+                                prev_dispr=None, stable=None):
+  """compute left and right disparity, searching a narrow band in each tile
+
+  Like `compute_band_disparity`, but the image is split into tiles rather
+  than full width strips, so a near object on one side of the image doesn't
+  widen the search for the background everywhere else in that strip. Each
+  tile is matched on a crop of the images that is only as wide as the tile
+  plus the furthest it can match, with some extra rows and columns around
+  it so the matcher has context at the edges.
+
+  If the band doesn't have the right answer in it (eg. something nearer
+  has come into view), SGBM can't find a match for the pixels that are
+  outside it rather than picking a wrong disparity inside it. Even a small
+  object coming in is a miss, so a tile with more than `max_invalid` of
+  the pixels it could match invalid is matched again over the full range.
+
+  Args:
+    left_im (array):
+      left image of the stereo pair
+    right_im (array):
+      right image of the stereo pair
+    prior_disp (array):
+      float32 disparity in pixels to search around, eg. from the previous
+      frame. Negative values are treated as invalid
+    max_disparity (int):
+      max disparity for the full range matcher
+    block_size (int):
+      size of the window for matcher
+    p1 (float):
+      smoothing param
+    p2 (float):
+      smoothing param
+    band (int):
+      number of pixels either side of the prior to search
+    tile_height (int):
+      number of rows in each tile
+    tile_width (int):
+      number of columns in each tile
+    margin (int):
+      pixels around each tile to include when working out its search range
+    context (int):
+      extra rows and columns matched around each tile
+    max_invalid (float):
+      fraction of invalid pixels in a tile above which the band counts as
+      having missed, and it is matched again over the full range. Columns
+      too close to the left edge to match anything aren't counted
+    prev_displ (array):
+      left disparity from the previous frame
+    prev_dispr (array):
+      right disparity from the previous frame. If these are given along with
+      `stable`, tiles that are stable reuse them rather than matching again
+    stable (array):
+      bool for each pixel, whether the image hasn't changed there since the
+      previous frame
+
+  Returns:
+    left and right disparity maps as int16 with 4 fractional bits, the same
+    as from the full range matchers, with invalid pixels set to the same
+    values the full range matchers would give them
   """
-  # first create the matchers
-  left_matcher, right_matcher = create_matchers(args.max_disparity,
-                                                args.block_size,
-                                                args.p1, args.p2)
-  # create WLS filter
-  # note here I am only sending parameters needed to this method, when before
-  # in the create_matchers method I sennt all the cmdline args.
-  # in general, the bottom 
-  wls_filter = create_wls_filter(left_matcher, args.lmbda, args.sigma)
-  # open the list of paths to image pairs to iterate over
-  with open(args.image_path_list) as f:
-    image_pair_paths = f.readlines()
-  # going to strip and newline characters that might be hiding in there
-  image_pair_paths = [x.rstrip() for x in image_pair_paths]
-  # now want to iterate over these and compute disparity maps and then save them
-  for image_pair in image_pair_paths:
-    # compute disparity map and apply wls filter
-    filtered_disp = compute_disparity_and_filter(left_matcher,
-                                                 right_matcher,
-                                                 wls_filter,
-                                                 image_pair,
-                                                 args.im_height,
-                                                 args.im_width)
-    # now save it
-    save_disparity_map(filtered_disp, image_pair)
-    
+  im_height, im_width = left_im.shape[:2]
+  displ = np.full((im_height, im_width), -16, dtype=np.int16)
+  dispr = np.full((im_height, im_width), -16 * max_disparity, dtype=np.int16)
+  # matchers for each size of search, the min disparity is set for each tile
+  matchers = {}
+
+  def get_matcher(low, num_disparities):
+    if num_disparities not in matchers:
+      matchers[num_disparities] = create_matchers(num_disparities,
+                                                  block_size, p1, p2)[0]
+    matchers[num_disparities].setMinDisparity(low)
+    return matchers[num_disparities]
+
+  for y0 in range(0, im_height, tile_height):
+    y1 = min(y0 + tile_height, im_height)
+    pad_y0 = max(0, y0 - context)
+    pad_y1 = min(im_height, y1 + context)
+    for x0 in range(0, im_width, tile_width):
+      x1 = min(x0 + tile_width, im_width)
+      if ((prev_displ is not None) and (stable is not None) and
+          stable[y0:y1, x0:x1].all()):
+        # nothing has moved here, so neither has the disparity
+        displ[y0:y1, x0:x1] = prev_displ[y0:y1, x0:x1]
+        dispr[y0:y1, x0:x1] = prev_dispr[y0:y1, x0:x1]
+        continue
+      # things may have moved into the tile from around it, or uncovered
+      # what was behind them, so look a bit past the tile for the range.
+      # Right pixels match left pixels to their right, so the range for them
+      # comes from the prior over there
+      left_range = _search_range(
+        prior_disp[max(0, y0 - margin):y1 + margin,
+                   max(0, x0 - margin):x1 + margin], band, max_disparity)
+      right_range = _search_range(
+        prior_disp[max(0, y0 - margin):y1 + margin,
+                   max(0, x0 - margin):x1 + max_disparity + margin], band,
+        max_disparity)
+      for attempt in range(2):
+        low, num_disparities = left_range
+        # left pixels match right pixels up to low + num_disparities to
+        # their left, so the crop needs to start that far back. If it is too
+        # close to the left edge nothing in the tile can match, and it is
+        # left as invalid
+        crop_x0 = max(0, x0 - low - num_disparities - context)
+        if x1 - crop_x0 <= low + num_disparities:
+          break
+        crop_x1 = min(im_width, x1 + context)
+        tile_l = get_matcher(low, num_disparities).compute(
+          left_im[pad_y0:pad_y1, crop_x0:crop_x1],
+          right_im[pad_y0:pad_y1, crop_x0:crop_x1])
+        tile_l = tile_l[y0 - pad_y0:y1 - pad_y0, x0 - crop_x0:x1 - crop_x0]
+        tile_l[tile_l < low * 16] = -16
+        # columns closer to the left edge than the search can't match
+        # whatever the band is, so leave them out when checking for a miss
+        matchable = tile_l[:, max(0, low + num_disparities - x0):]
+        if (attempt == 0) and (np.mean(matchable < 0) > max_invalid):
+          # the band missed, search everything
+          left_range = right_range = (0, max_disparity)
+          continue
+        displ[y0:y1, x0:x1] = tile_l
+        low, num_disparities = right_range
+        right_matcher = cv2.ximgproc.createRightMatcher(
+          get_matcher(low, num_disparities))
+        crop_x0 = max(0, x0 - context)
+        crop_x1 = min(im_width, x1 + low + num_disparities + context)
+        if crop_x1 - crop_x0 > low + num_disparities:
+          tile_r = right_matcher.compute(
+            right_im[pad_y0:pad_y1, crop_x0:crop_x1],
+            left_im[pad_y0:pad_y1, crop_x0:crop_x1])
+          tile_r = tile_r[y0 - pad_y0:y1 - pad_y0, x0 - crop_x0:x1 - crop_x0]
+          tile_r[tile_r < (right_matcher.getMinDisparity() * 16)] = (
+            -16 * max_disparity)
+          dispr[y0:y1, x0:x1] = tile_r
+        break
+  return displ, dispr
+
+
+def scene_change(left_im, prev_thumb):
+  """cheap check of how much the scene has changed since the previous frame
+
+  Compares small grayscale thumbnails of the left images, so costs next to
+  nothing next to the matching.
 
-def check_cmdline_args(args):
-  """check values for cmdline args are good
-  
-  Our params for the stereo matcher and filtering have some certain constraints.
-  Want to check them all to make sure they are all valid before running any of
-  them.
-  
   Args:
-    args (object):
-      essentially a struct/struct with all our parsed cmdline args
-  
+    left_im (array):
+      left image of this frame
+    prev_thumb (array):
+      thumbnail of the previous frame from this function, or None for the
+      first frame
+
+  Returns:
+    tuple of (thumbnail of this frame, mean absolute difference over the
+    whole image as a fraction of the full range, and the difference at each
+    pixel of the image), the differences are None for the first frame or if
+    the size has changed
+  """
+  gray = left_im
+  if left_im.ndim == 3:
+    gray = cv2.cvtColor(left_im, cv2.COLOR_BGR2GRAY)
+  thumb = cv2.resize(gray, (max(1, gray.shape[1] // 8),
+                            max(1, gray.shape[0] // 8)),
+                     interpolation=cv2.INTER_AREA)
+  if (prev_thumb is None) or (prev_thumb.shape != thumb.shape):
+    return thumb, None, None
+  diff = cv2.absdiff(thumb, prev_thumb).astype(np.float32) / 255.0
+  # spread the change for each thumbnail pixel over the pixels it covers
+  pixel_change = cv2.resize(diff, (gray.shape[1], gray.shape[0]),
+                            interpolation=cv2.INTER_NEAREST)
+  return thumb, float(np.mean(diff)), pixel_change
+
+
+def compute_temporal_disparity_from_images(left_matcher, right_matcher,
+                                           wls_filter, left_im, right_im,
+                                           state, max_disparity, block_size,
+                                           p1, p2, band, scene_cut,
+                                           stable_change, keyframe_interval,
+                                           timings=None, to_uint8=True):
+  """compute disparity for a frame of a sequence using the previous frame
+
+  Alternative to `compute_disparity_from_images` for when the pairs are
+  consecutive frames from a stereo rig. Things don't move far
+  between frames, so rather than searching the full disparity range, each
+  tile of the image only searches `band` pixels either side of the
+  previous frame's filtered disparity there (refer to
+  `compute_tile_band_disparity`). Tiles where the image hasn't changed at
+  all just reuse the previous frame's left and right disparity, skipping
+  both matchers.
+
+  A full range search is done for the first frame, whenever the scene
+  changes by more than `scene_cut` (eg. a cut, or pairs that aren't from a
+  sequence at all), and every `keyframe_interval` frames so any errors
+  can't keep building up.
+
+  This isn't always a win. SGBM costs about the same for each pixel and
+  disparity searched, so cutting the range only pays off when the full
+  range is wide, and the tiles add overhead of their own. It is also less
+  accurate: regions next to near objects that are hidden from the right
+  camera are left invalid by the band search, where a full search finds a
+  (wrong) match, and the WLS filter leaves some of the bigger ones as holes.
+  On the synthetic sequences from `benchmark_pipeline.py sequence` it is no
+  faster than full range SGBM at the default size and disparity range, and
+  a lot less accurate, so it isn't one of the `--engine` choices and is
+  only run from there until it is a win.
+
+  Args:
+    left_matcher (SGBM matcher object):
+      matcher for left image, for full range searches
+    right_matcher (SGBM matcher object):
+      matcher for right image, for full range searches
+    wls_filter (WLS Filter Object):
+      filter to post-process the disparity map
+    left_im (array):
+      left image of the stereo pair, already resized
+    right_im (array):
+      right image of the stereo pair, already resized
+    state (dict):
+      what is kept from the previous frame, is updated for the next one.
+      Should start out empty
+    max_disparity (int):
+      max disparity for matcher to search to
+    block_size (int):
+      size of the window for matcher
+    p1 (float):
+      smoothing param
+    p2 (float):
+      smoothing param
+    band (int):
+      number of pixels either side of the previous disparity to search
+    scene_cut (float):
+      mean change in the image above which a full search is done
+    stable_change (float):
+      change in a pixel below which it counts as not having changed. Tiles
+      where none of the pixels have changed reuse the previous disparity
+    keyframe_interval (int):
+      max number of frames in a row to use the previous frame for
+    timings (dict):
+      if not None, time spent in each stage is added to this, along with
+      `temporal_mode`, which is `full` or `band`
+    to_uint8 (bool):
+      if False, the raw int16 filtered disparity is returned
+
+  Returns:
+    disparity map computed on the images that was then filtered
+  """
+  start = time.perf_counter()
+  thumb, change, pixel_change = scene_change(left_im, state.get('thumb'))
+  state['thumb'] = thumb
+  full_search = ((change is None) or (change > scene_cut) or
+                 (state.get('prev_disp') is None) or
+                 (state['prev_disp'].shape != left_im.shape[:2]) or
+                 (state['since_keyframe'] >= keyframe_interval))
+  start = record_time(timings, 'scene_check', start)
+  if full_search:
+    displ = left_matcher.compute(left_im, right_im)
+    start = record_time(timings, 'left_match', start)
+    dispr = right_matcher.compute(right_im, left_im)
+    start = record_time(timings, 'right_match', start)
+    state['since_keyframe'] = 0
+  else:
+    displ, dispr = compute_tile_band_disparity(
+      left_im, right_im, state['prev_disp'], max_disparity, block_size, p1,
+      p2, band, prev_displ=state['prev_displ'],
+      prev_dispr=state['prev_dispr'], stable=pixel_change <= stable_change)
+    start = record_time(timings, 'temporal_match', start)
+    state['since_keyframe'] += 1
+  filtered_im = wls_filter.filter(displ, left_im, disparity_map_right=dispr)
+  start = record_time(timings, 'wls_filter', start)
+  # the filtered disparity fills in the holes, so is a better guess for the
+  # next frame than the raw left disparity
+  state['prev_disp'] = filtered_im.astype(np.float32) / 16.0
+  state['prev_displ'] = displ
+  state['prev_dispr'] = dispr
+  if timings is not None:
+    timings['temporal_mode'] = 'full' if full_search else 'band'
+    start = time.perf_counter()
+  if to_uint8:
+    filtered_im = np.uint8(filtered_im)
+    record_time(timings, 'to_uint8', start)
+  return filtered_im
+
+
+def low_confidence(displ, window=5, max_deviation=1.0):
+  """find the pixels of a left disparity map we aren't confident in
+
+  Is meant to be cheap compared to the right matcher, so is only based on
+  the left disparity itself. A pixel isn't trusted if the matcher couldn't
+  find a match for it, or if it is out by more than `max_deviation` pixels
+  from the mean of the disparity around it, which is where there are edges,
+  speckles or streaks that the WLS filter would clean up.
+
+  Args:
+    displ (array):
+      left disparity as int16 with 4 fractional bits
+    window (int):
+      size of the window to take the mean over
+    max_deviation (float):
+      pixels a pixel can be from the mean around it and still be trusted
+
+  Returns:
+    bool array, True for pixels with low confidence
+  """
+  disp = displ.astype(np.float32) / 16.0
+  local_mean = cv2.blur(disp, (window, window))
+  return (displ < 0) | (np.abs(disp - local_mean) > max_deviation)
+
+
+def fill_invalid_disparity(disp):
+  """fill in pixels without a match from the nearest valid pixel to the left
+
+  Pixels that can't be matched are mostly occluded in the right image, which
+  in the left image is background just to the left of something closer, so
+  the valid pixel to their left is the best guess. Pixels with nothing valid
+  to their left (eg. along the left edge) take the nearest one to their
+  right instead. Rows with nothing valid are set to zero.
+
+  Args:
+    disp (array):
+      disparity as int16 with 4 fractional bits, is filled in place
+
   Returns:
     NA
+  """
+  invalid = disp < 0
+  if not invalid.any():
+    return
+  cols = np.arange(disp.shape[1])[None, :]
+  # column of the nearest valid pixel to the left, or -1 if there isn't one
+  left_cols = np.maximum.accumulate(np.where(invalid, -1, cols), axis=1)
+  # and to the right, or the width if there isn't one
+  right_cols = np.minimum.accumulate(
+    np.where(invalid, disp.shape[1], cols)[:, ::-1], axis=1)[:, ::-1]
+  fill_cols = np.where(left_cols >= 0, left_cols, right_cols)
+  rows = np.arange(disp.shape[0])[:, None]
+  has_fill = fill_cols < disp.shape[1]
+  filled = np.where(has_fill, disp[rows, np.minimum(fill_cols,
+                                                    disp.shape[1] - 1)], 0)
+  disp[invalid] = filled[invalid]
+
+
+def compute_gated_disparity_from_images(left_matcher, right_matcher,
+                                        wls_filter, left_im, right_im,
+                                        max_disparity, gate_threshold,
+                                        strip_rows=64, context=16,
+                                        timings=None, to_uint8=True):
+  """compute disparity, only refining the parts we aren't confident in
+
+  Gated engine alternative to `compute_disparity_from_images`. The right
+  matcher and WLS filter are only there to clean up the left disparity, but
+  cost as much again as the left matcher. Where the left disparity is
+  already clean there is nothing for them to do, so instead
+
+    - compute the left disparity over the whole image
+    - work out which pixels have low confidence (refer to `low_confidence`)
+    - split the rows into strips, and only run the right matcher and WLS
+      filter on strips with more than `gate_threshold` of their pixels low
+      confidence, with `context` extra rows either side
+    - the rest keep the left disparity, with any pixels that don't have a
+      match filled in from their neighbours
+
+  The columns along the left edge that can never be matched aren't counted
+  towards the confidence of a strip. If every strip needs refining, the
+  whole image is done in one go, the same as the full path. A threshold of
+  zero refines any strip with a single low confidence pixel.
+
+  Args:
+    left_matcher (SGBM matcher object):
+      matcher for left image in stereo pair
+    right_matcher (SGBM matcher object):
+      matcher for right image in stereo pair
+    wls_filter (WLS Filter Object):
+      filter to post-process the disparity map
+    left_im (array):
+      left image of the stereo pair, already resized
+    right_im (array):
+      right image of the stereo pair, already resized
+    max_disparity (int):
+      max disparity the matchers search to
+    gate_threshold (float):
+      fraction of low confidence pixels in a strip above which it is
+      refined
+    strip_rows (int):
+      number of rows in each strip
+    context (int):
+      extra rows matched and filtered either side of the strips that are
+      refined
+    timings (dict):
+      if not None, time spent in each stage is added to this, along with
+      the fraction of rows that weren't refined as `gate_skipped`
+    to_uint8 (bool):
+      if False, the disparity is returned as the raw int16 16x fixed point
+      values rather than being cast to uint8
+
+  Returns:
+    disparity map computed on the images, filtered where it needed it
+  """
+  start = time.perf_counter()
+  displ = left_matcher.compute(left_im, right_im)
+  start = record_time(timings, 'left_match', start)
+  low = low_confidence(displ)
+  im_height = displ.shape[0]
+  # consecutive strips that need refining are done together, so the context
+  # rows are only matched once
+  runs = []
+  for y0 in range(0, im_height, strip_rows):
+    y1 = min(y0 + strip_rows, im_height)
+    if np.mean(low[y0:y1, max_disparity:]) > gate_threshold:
+      if runs and (runs[-1][1] == y0):
+        runs[-1][1] = y1
+      else:
+        runs.append([y0, y1])
+  start = record_time(timings, 'confidence', start)
+  if runs == [[0, im_height]]:
+    dispr = right_matcher.compute(right_im, left_im)
+    start = record_time(timings, 'right_match', start)
+    filtered_im = wls_filter.filter(displ, left_im, disparity_map_right=dispr)
+    start = record_time(timings, 'wls_filter', start)
+  else:
+    # the filter needs the left disparity as it came from the matcher,
+    # invalid pixels and all, so fill in a copy. Only the rows that aren't
+    # refined need filling
+    filtered_im = displ.copy()
+    skipped_y0 = 0
+    for y0, y1 in runs + [[im_height, im_height]]:
+      if y0 > skipped_y0:
+        fill_invalid_disparity(filtered_im[skipped_y0:y0])
+      skipped_y0 = y1
+    start = record_time(timings, 'fill', start)
+    for y0, y1 in runs:
+      pad_y0 = max(0, y0 - context)
+      pad_y1 = min(im_height, y1 + context)
+      dispr = right_matcher.compute(right_im[pad_y0:pad_y1],
+                                    left_im[pad_y0:pad_y1])
+      start = record_time(timings, 'right_match', start)
+      strip = wls_filter.filter(displ[pad_y0:pad_y1], left_im[pad_y0:pad_y1],
+                                disparity_map_right=dispr)
+      filtered_im[y0:y1] = strip[y0 - pad_y0:y1 - pad_y0]
+      start = record_time(timings, 'wls_filter', start)
+  if timings is not None:
+    timings['gate_skipped'] = 1.0 - sum(y1 - y0 for y0, y1 in runs) / float(
+      im_height)
+  if to_uint8:
+    filtered_im = np.uint8(filtered_im)
+    record_time(timings, 'to_uint8', start)
+  return filtered_im
+
+
+def estimate_strip_memory(strip_rows, im_width, max_disparity):
+  """rough estimate of the peak memory in bytes to match and filter a strip
+
+  SGBM keeps a cost for every pixel and disparity as int16, plus the
+  aggregated costs, so most of the memory is
+  rows x width x disparities x 2 bytes x 2. On top of that the WLS filter
+  keeps a handful of float buffers the size of the strip, which I am
+  allowing 64 bytes per pixel for. Is on the conservative side.
+
+  Args:
+    strip_rows (int):
+      number of rows in the strip, including any overlap
+    im_width (int):
+      width of the image
+    max_disparity (int):
+      max disparity for matcher to search to
+
+  Returns:
+    estimated peak memory in bytes
+  """
+  return strip_rows * im_width * (4 * max_disparity + 64)
+
+
+def plan_strips(im_height, im_width, max_disparity, block_size,
+                max_memory_mb, tile_threads):
+  """split the image rows into strips that fit within a memory budget
+
+  Each strip is padded with overlap rows above and below, so the matching
+  window and the filter have context at the edges. Only the rows in the
+  middle of each strip are kept when stitching it back together.
+
+  Args:
+    im_height (int):
+      height of the image
+    im_width (int):
+      width of the image
+    max_disparity (int):
+      max disparity for matcher to search to
+    block_size (int):
+      size of the window for matcher
+    max_memory_mb (int):
+      memory budget in MB for all the strips being worked on at once
+    tile_threads (int):
+      number of strips that will be worked on at once
+
+  Returns:
+    list of (pad_y0, y0, y1, pad_y1) tuples, where rows y0 to y1 are kept
+    from the strip that was computed over rows pad_y0 to pad_y1
 
   Raises:
-    IOError if path for file list doesnt exist
-    ValueError if a param is supplied is invalid
+    ValueError if the budget is too small to fit a useful strip
   """
-  if not os.path.isfile(args.image_path_list):
-    raise IOError(
-      'Value for image paths does not exist: {}'.format(args.image_path_list))
-  if (args.max_disparity <= 0) or ((args.max_disparity % 16) != 0):
-    raise ValueError(
-      'Invalid value for max disparity, must be integer > 0 that is divisible by 16: {}'.format(
-        args.max_disparity))
-  if (args.block_size < 3) or ((args.block_size % 2) == 0):
-    raise ValueError(
-      'Invalid value for block_size, must be odd integer >= 3: {}'.format(
-        args.block_size))
-  if args.p1 is None:
-    # set to suggested value, which is
-    # 8*number_of_image_channels*blockSize*blockSize
-    args.p1 = int(8 * 3 * args.block_size**2.0)
-  elif args.p1 < 0:
-    raise ValueError(
-      'Invalid value for p1, must be positive. If unsure leave as default. {}'.format(
-        args.p1))
-  if args.p2 is None:
-    # set to suggested value, which is
-    # 32*number_of_image_channels*blockSize*blockSize
-    args.p2 = int(32 * 3 * args.block_size**2.0)
-  elif args.p2 < 0:
-    raise ValueError(
-      'Invalid value for p2, must be positive. If unsure leave as default. {}'.format(
-        args.p2))
-  if args.p1 > args.p2:
-    raise ValueError(
-      'Invalid value for p1 and p2, p1 must be < p2: {} {}'.format(
-        args.p1, args.p2))
-  if (args.lmbda < 0):
-    raise ValueError(
-      'Invalid value for lmbda, must be > 0: {}'.format(
-        args.lmbda))    
-  if (args.sigma < 0):
+  # half the block for the matching window, plus some extra for the
+  # aggregation and WLS filter to settle down
+  overlap = block_size + 16
+  budget = max_memory_mb * 1024 * 1024 / float(tile_threads)
+  bytes_per_row = estimate_strip_memory(1, im_width, max_disparity)
+  strip_rows = int(budget // bytes_per_row) - 2 * overlap
+  if strip_rows < overlap:
     raise ValueError(
-      'Invalid value for sigma, must be > 0: {}'.format(
-        args.sigma))    
+      'Memory budget of {}MB too small for strips at this size, need at least {}MB'.format(
+        max_memory_mb,
+        int(np.ceil(3 * overlap * bytes_per_row * tile_threads / 1024.0**2))))
+  strips = []
+  for y0 in range(0, im_height, strip_rows):
+    y1 = min(y0 + strip_rows, im_height)
+    strips.append((max(0, y0 - overlap), y0, y1,
+                   min(im_height, y1 + overlap)))
+  return strips
+
+
+def compute_tiled_disparity_from_images(left_im, right_im, max_memory_mb,
+                                        tile_threads, timings=None,
+                                        to_uint8=True):
+  """compute and filter disparity in horizontal strips to bound memory
+
+  Matching the whole image at once needs a cost volume for every pixel and
+  disparity, which is way bigger than the output. Instead will split the
+  pair into horizontal strips that fit within `max_memory_mb`, compute and
+  filter each one, then stitch them back together. Disparity is only
+  searched horizontally, so each strip only needs a few rows of overlap.
+
+  The strips can be worked on in parallel by a pool of threads, each with
+  their own matchers and filter, as OpenCV releases the GIL while it works.
+  The budget is shared between the threads.
+
+  Uses the matcher params and thread pool set up by `init_worker`.
+
+  Args:
+    left_im (array):
+      left image of the stereo pair, already resized
+    right_im (array):
+      right image of the stereo pair, already resized
+    max_memory_mb (int):
+      memory budget in MB for matching and filtering
+    tile_threads (int):
+      number of strips to work on at once
+    timings (dict):
+      if not None, time spent in each stage is added to this. Strips are
+      matched and filtered together, so is all counted as `tiled_match`
+    to_uint8 (bool):
+      if False, the raw int16 filtered disparity is returned
+
+  Returns:
+    disparity map computed on the images that was then filtered
+
+  Raises:
+    ValueError if the memory budget is too small
+  """
+  start = time.perf_counter()
+  max_disparity, block_size = _worker_state['matcher_args'][0:2]
+  im_height, im_width = left_im.shape[:2]
+  strips = plan_strips(im_height, im_width, max_disparity, block_size,
+                       max_memory_mb, tile_threads)
+  filtered_im = np.zeros((im_height, im_width), dtype=np.int16)
+
+  def compute_strip(strip):
+    pad_y0, y0, y1, pad_y1 = strip
+    left_matcher, right_matcher, wls_filter = _tile_matchers()
+    strip_l = left_im[pad_y0:pad_y1]
+    strip_r = right_im[pad_y0:pad_y1]
+    displ = left_matcher.compute(strip_l, strip_r)
+    dispr = right_matcher.compute(strip_r, strip_l)
+    filtered = wls_filter.filter(displ, strip_l, disparity_map_right=dispr)
+    # only keep the rows in the middle of the strip
+    filtered_im[y0:y1] = filtered[y0 - pad_y0:y1 - pad_y0]
+
+  if tile_threads > 1:
+    # list forces any errors from the strips to be raised here
+    list(_worker_state['tile_pool'].map(compute_strip, strips))
+  else:
+    for strip in strips:
+      compute_strip(strip)
+  start = record_time(timings, 'tiled_match', start)
+  if to_uint8:
+    filtered_im = np.uint8(filtered_im)
+    record_time(timings, 'to_uint8', start)
+  return filtered_im
+
+
+def _tile_matchers():
+  """get the matchers and filter for the current tile thread
+
+  Matcher objects keep internal buffers and aren't safe to share across
+  threads, so each tile thread creates its own the first time it is used.
+  """
+  tile_local = _worker_state['tile_local']
+  if not hasattr(tile_local, 'matchers'):
+    left_matcher, right_matcher = create_matchers(
+      *_worker_state['matcher_args'])
+    wls_filter = create_wls_filter(left_matcher,
+                                   *_worker_state['filter_args'])
+    tile_local.matchers = (left_matcher, right_matcher, wls_filter)
+  return tile_local.matchers
+
+
+def compute_worker_disparity(left_im, right_im, timings=None):
+  """compute the filtered disparity with the engine set up for this process
+
+  Args:
+    left_im (array):
+      left image of the stereo pair, already resized
+    right_im (array):
+      right image of the stereo pair, already resized
+    timings (dict):
+      if not None, time spent in each stage is added to this
+
+  Returns:
+    disparity map computed on the images that was then filtered. If we are
+    writing to a disparity store this is the raw int16 disparity, otherwise
+    is uint8
+  """
+  # store keeps the full precision, so don't throw it away here
+  to_uint8 = _worker_state.get('disp_store') is None
+  if _worker_state['engine'] == 'pyramid':
+    return compute_pyramid_disparity_from_images(
+      _worker_state['wls_filter'], left_im, right_im,
+      *_worker_state['pyramid_args'], timings=timings, to_uint8=to_uint8)
+  if _worker_state['engine'] == 'gated':
+    return compute_gated_disparity_from_images(
+      _worker_state['left_matcher'], _worker_state['right_matcher'],
+      _worker_state['wls_filter'], left_im, right_im,
+      *_worker_state['gated_args'], timings=timings, to_uint8=to_uint8)
+  if _worker_state['engine'] == 'tiled':
+    return compute_tiled_disparity_from_images(left_im, right_im,
+                                               *_worker_state['tiled_args'],
+                                               timings=timings,
+                                               to_uint8=to_uint8)
+  return compute_disparity_from_images(_worker_state['left_matcher'],
+                                       _worker_state['right_matcher'],
+                                       _worker_state['wls_filter'],
+                                       left_im, right_im, timings, to_uint8)
+
+
+# reduced scale decodes libjpeg can do straight from the DCT, for colour and
+# grayscale, biggest reduction first
+REDUCED_DECODES = [
+  (8, cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+  (4, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+  (2, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+  (1, cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE)]
+
+
+def decode_flags(data, im_height, im_width, grayscale=False, reduced=True):
+  """flags for `cv2.imdecode` that do the least work for an image
+
+  JPEGs can be decoded at 1/2, 1/4 or 1/8 scale for a lot less than a full
+  decode, so use the biggest reduction that still leaves the image at least
+  as big as we are resizing to. The sizes are compared smallest to smallest
+  and largest to largest, so an image that is rotated by its EXIF
+  orientation still gets a safe reduction.
+
+  Args:
+    data (array):
+      encoded bytes as uint8
+    im_height (int):
+      height the image will be resized to
+    im_width (int):
+      width the image will be resized to
+    grayscale (bool):
+      whether to decode to a single channel
+    reduced (bool):
+      if False, always decode at full size, the same as `cv2.imread`
+
+  Returns:
+    flags for `cv2.imdecode`
+  """
+  size = shard_planner.parse_jpeg_size(data) if reduced else None
+  for scale, color_flags, gray_flags in REDUCED_DECODES:
+    if (scale == 1) or ((size is not None) and all(
+        x >= y for x, y in zip(sorted(-(-z // scale) for z in size),
+                               sorted([im_height, im_width])))):
+      return gray_flags if grayscale else color_flags
+
+
+def decode_resize_image(data, im_height, im_width, timings=None,
+                        grayscale=False, reduced=True, name='image'):
+  """decode an image and resize it, decoding at a reduced scale if we can
+
+  Args:
+    data (array):
+      encoded bytes as uint8
+    im_height (int):
+      height of image to be resized to
+    im_width (int):
+      width of image to be resized to
+    timings (dict):
+      if not None, time spent decoding and resizing is added to this
+    grayscale (bool):
+      whether to decode to a single channel
+    reduced (bool):
+      whether to decode at a reduced scale when the image is big enough,
+      refer to `decode_flags`
+    name (str):
+      what the image is, for the error message
+
+  Returns:
+    image of correct size
+
+  Raises:
+    IOError if the image can't be decoded
+  """
+  start = time.perf_counter()
+  image = None
+  if len(data) > 0:
+    image = cv2.imdecode(data, decode_flags(data, im_height, im_width,
+                                            grayscale, reduced))
+  if image is None:
+    raise IOError('unable to read image: {}'.format(name))
+  start = record_time(timings, 'decode', start)
+  # whatever the reduced decode didn't take care of
+  if image.shape[:2] != (im_height, im_width):
+    image = cv2.resize(image, (im_width, im_height))
+  record_time(timings, 'resize', start)
+  return image
+
+
+def decode_pair(load_fn, sources, timings=None, decode_pool=None):
+  """load the left and right images, at the same time if given a pool
+
+  Args:
+    load_fn (callable):
+      called as `load_fn(source, timings)` to load and resize each image
+    sources (list):
+      what to load for the left and right images
+    timings (dict):
+      if not None, time spent in each stage is added to this. When decoding
+      on a pool this is the total over both images, not the wall time
+    decode_pool (ThreadPoolExecutor):
+      pool to decode on, or None to decode one after the other
+
+  Returns:
+    left and right images
+  """
+  if decode_pool is None:
+    left_im, right_im = [load_fn(x, timings) for x in sources]
+    return left_im, right_im
+  # each image gets its own timings, as they are decoded at the same time
+  image_timings = [None if timings is None else {} for _ in sources]
+  left_im, right_im = decode_pool.map(load_fn, sources, image_timings)
+  if timings is not None:
+    for x in image_timings:
+      for stage, seconds in x.items():
+        timings[stage] = timings.get(stage, 0.0) + seconds
+  return left_im, right_im
+
+
+def read_resize_images(image_pair_path, im_height, im_width, timings=None,
+                       grayscale=False, reduced=True, decode_pool=None):
+  """read image pair from supplied path and resize if needed
+
+  Args:
+    image_pair_path (str):
+      path to the image pair
+    im_height (int):
+      height of image to be resized to
+    im_width (int):
+      width of image to be resized to
+    timings (dict):
+      if not None, time spent decoding and resizing is added to this
+    grayscale (bool):
+      whether to decode to a single channel
+    reduced (bool):
+      whether to decode at a reduced scale when the image is big enough
+    decode_pool (ThreadPoolExecutor):
+      if not None, the left and right images are decoded at the same time
+      on this pool
+
+  Returns:
+    left and right images of correct size
+
+  Raises:
+    IOError if the path of an image is invalid
+  """
+  load_fn = functools.partial(read_resize_image, im_height=im_height,
+                              im_width=im_width, grayscale=grayscale,
+                              reduced=reduced)
+  return decode_pair(lambda x, y: load_fn(x, timings=y),
+                     [os.path.join(image_pair_path, 'left.jpg'),
+                      os.path.join(image_pair_path, 'right.jpg')],
+                     timings, decode_pool)
+
+
+def read_resize_image(image_path, im_height, im_width, timings=None,
+                      grayscale=False, reduced=True):
+  """read a single image and resize it
+
+  Args:
+    image_path (str):
+      path to the image
+    im_height (int):
+      height of image to be resized to
+    im_width (int):
+      width of image to be resized to
+    timings (dict):
+      if not None, time spent decoding and resizing is added to this.
+      Reading the file counts as decoding, the same as for `cv2.imread`
+    grayscale (bool):
+      whether to decode to a single channel
+    reduced (bool):
+      whether to decode at a reduced scale when the image is big enough
+
+  Returns:
+    image of correct size
+
+  Raises:
+    IOError if the image can't be read
+  """
+  start = time.perf_counter()
+  try:
+    data = np.fromfile(image_path, dtype=np.uint8)
+  except (IOError, OSError):
+    raise IOError('unable to read image: {}'.format(image_path))
+  record_time(timings, 'decode', start)
+  return decode_resize_image(data, im_height, im_width, timings, grayscale,
+                             reduced, name=image_path)
+
+
+def read_resize_packed_images(pack, image_key, im_height, im_width,
+                              timings=None, grayscale=False, reduced=True,
+                              decode_pool=None):
+  """read image pair from a packed dataset and resize if needed
+
+  Images are decoded straight from the memory mapped shard, refer to
+  `pack_dataset.py` for how they are stored. Also works for archives, refer
+  to `archive_dataset.py`.
+
+  Args:
+    pack (PackedDataset):
+      packed dataset to read from
+    image_key (str):
+      key of the image pair in the pack
+    im_height (int):
+      height of image to be resized to
+    im_width (int):
+      width of image to be resized to
+    timings (dict):
+      if not None, time spent decoding and resizing is added to this
+    grayscale (bool):
+      whether to decode to a single channel
+    reduced (bool):
+      whether to decode at a reduced scale when the image is big enough
+    decode_pool (ThreadPoolExecutor):
+      if not None, the left and right images are decoded at the same time
+      on this pool
+
+  Returns:
+    left and right images of correct size
+
+  Raises:
+    KeyError if the key isn't in the pack
+    IOError if one of the images couldn't be decoded
+  """
+  def load_fn(orientation, image_timings):
+    return decode_resize_image(
+      pack.read_bytes(image_key, orientation), im_height, im_width,
+      image_timings, grayscale, reduced,
+      name='{} image for key: {}'.format(orientation, image_key))
+
+  return decode_pair(load_fn, ['left', 'right'], timings, decode_pool)
+
+
+def load_image_pair(image_pair, im_height, im_width, timings=None):
+  """read and resize an image pair from wherever this process is reading from
+
+  If a pack was given to `init_worker`, `image_pair` is a key in that pack.
+  If it is `<archive>::<image_key>` the images are read straight from the
+  archive, refer to `archive_dataset.py`. Otherwise it is the path to the
+  directory with the images. If a cache was given, images read from
+  directories are taken from the cache where we can, refer to
+  `image_cache.py`.
+
+  Args:
+    image_pair (str):
+      key or path for the image pair
+    im_height (int):
+      height of image to be resized to
+    im_width (int):
+      width of image to be resized to
+    timings (dict):
+      if not None, time spent in each stage is added to this. Loading from
+      the cache is counted as `cache_read`, and any misses as usual
+
+  Returns:
+    left and right images of correct size
+  """
+  decode_args = _worker_state.get('decode_args', {})
+  if archive_dataset.is_archive_pair(image_pair):
+    archive_path, image_key = archive_dataset.split_archive_pair(image_pair)
+    return read_resize_packed_images(archive_dataset.open_archive(archive_path),
+                                     image_key, im_height, im_width, timings,
+                                     **decode_args)
+  if _worker_state.get('pack') is not None:
+    return read_resize_packed_images(_worker_state['pack'], image_pair,
+                                     im_height, im_width, timings,
+                                     **decode_args)
+  cache = _worker_state.get('cache')
+  if cache is not None:
+    grayscale = decode_args.get('grayscale', False)
+    reduced = decode_args.get('reduced', True)
+    load_fn = functools.partial(read_resize_image, timings=timings,
+                                grayscale=grayscale, reduced=reduced)
+    start = time.perf_counter()
+    left_im = cache.get(os.path.join(image_pair, 'left.jpg'),
+                        im_height, im_width, load_fn, grayscale, reduced)
+    right_im = cache.get(os.path.join(image_pair, 'right.jpg'),
+                         im_height, im_width, load_fn, grayscale, reduced)
+    if timings is not None:
+      # whatever wasn't spent decoding or resizing misses was reading
+      elapsed = time.perf_counter() - start
+      timings['cache_read'] = timings.get('cache_read', 0.0) + max(
+        0.0, elapsed - timings.get('decode', 0.0) - timings.get('resize', 0.0))
+    return left_im, right_im
+  return read_resize_images(image_pair, im_height, im_width, timings,
+                            **decode_args)
+
+
+def store_disparity_map(filtered_disp, image_pair, timings=None):
+  """save disparity map to wherever this process is writing to
+
+  If a disparity store was given in `init_worker`, the raw disparity is
+  added to the store under the image key, and a JPEG preview is only saved
+  as well if asked for. Otherwise, if a pack was given for the disparity
+  maps the encoded map is appended to the pack under the image key, or it is
+  saved as `disp.jpg` next to the original images.
+
+  Args:
+    filtered_disp (array):
+      final disparity map, raw int16 if writing to a disparity store
+    image_pair (str):
+      key or path for the image pair
+    timings (dict):
+      if not None, time spent encoding and writing is added to this
+
+  Returns:
+    NA
+
+  Raises:
+    IOError if the disparity map couldn't be encoded
+  """
+  disp_store = _worker_state.get('disp_store')
+  if disp_store is not None:
+    start = time.perf_counter()
+    image_key = pair_key(image_pair)
+    disp_store.append(image_key, filtered_disp)
+    start = record_time(timings, 'store', start)
+    if not _worker_state['disp_preview']:
+      return
+    filtered_disp = np.uint8(filtered_disp)
+    record_time(timings, 'to_uint8', start)
+  disp_writer = _worker_state.get('disp_writer')
+  if disp_writer is None:
+    save_disparity_map(filtered_disp, image_pair, timings)
+    return
+  start = time.perf_counter()
+  success, encoded = cv2.imencode('.jpg', filtered_disp)
+  if not success:
+    raise IOError('unable to encode disparity map for: {}'.format(image_pair))
+  start = record_time(timings, 'encode', start)
+  image_key = pair_key(image_pair)
+  disp_writer.append(image_key, 'disp', encoded)
+  record_time(timings, 'write', start)
+
+
+def pair_key(image_pair):
+  """image key for a pair, from its directory, pack key or archive pair"""
+  if archive_dataset.is_archive_pair(image_pair):
+    return archive_dataset.split_archive_pair(image_pair)[1]
+  return os.path.basename(os.path.normpath(image_pair))
+
+
+def pair_output_dir(image_pair):
+  """directory the disparity map for a pair is saved in as `disp.jpg`
+
+  This is the pair's own directory, except for pairs in an archive, which
+  go in `<archive>_disp/<image_key>`.
+  """
+  if archive_dataset.is_archive_pair(image_pair):
+    archive_path, image_key = archive_dataset.split_archive_pair(image_pair)
+    return os.path.join(archive_path + '_disp', image_key)
+  return image_pair
+
+
+def save_disparity_map(filtered_disp, image_pair, timings=None):
+  """save disparity map
+  
+  Will save it such that it is stored as,
+  └── image_key
+      ├── disp.jpg
+      ├── left.jpg
+      └── right.jpg
+  
+  where `image_key` is given as the base directory in the
+  `image_pair` path. Pairs read from an archive can't have anything added
+  next to them, so are saved in a directory next to the archive instead,
+  refer to `pair_output_dir`.
+
+  Args:
+    filtered_disp (array):
+      final disparity map
+    image_pair (str):
+      path to directory containing the two original images, which is where
+      we will save this disparity map, or a pair in an archive
+    timings (dict):
+      if not None, time spent encoding and writing is added to this
+
+  Returns:
+    NA
+
+  Raises:
+    IOError if the disparity map couldn't be encoded
+  """
+  start = time.perf_counter()
+  success, encoded = cv2.imencode('.jpg', filtered_disp)
+  if not success:
+    raise IOError('unable to encode disparity map for: {}'.format(image_pair))
+  start = record_time(timings, 'encode', start)
+  # write to a temp file and then rename it into place, so if we are killed
+  # part way through there is never a truncated `disp.jpg` left behind
+  disp_dir = pair_output_dir(image_pair)
+  if disp_dir != image_pair:
+    os.makedirs(disp_dir, exist_ok=True)
+  disp_path = os.path.join(disp_dir, 'disp.jpg')
+  tmp_path = '{}.{}.tmp'.format(disp_path, os.getpid())
+  with open(tmp_path, 'wb') as f:
+    f.write(encoded.tobytes())
+  os.replace(tmp_path, disp_path)
+  record_time(timings, 'write', start)
+
+
+def record_time(timings, stage, start):
+  """add the time since `start` to a stage, if we are keeping timings
+
+  Args:
+    timings (dict):
+      time spent in each stage so far, or None if we aren't timing
+    stage (str):
+      name of the stage
+    start (float):
+      value of `time.perf_counter()` when the stage started
+
+  Returns:
+    value of `time.perf_counter()` now, so can be used as the start of the
+    next stage
+  """
+  now = time.perf_counter()
+  if timings is not None:
+    timings[stage] = timings.get(stage, 0.0) + now - start
+  return now
+
+
+def new_timings():
+  """start a new set of timings for a pair, if stage timings are turned on
+
+  Returns:
+    empty dict to add stage timings to, or None if timings are turned off
+  """
+  if not _worker_state.get('stage_timings'):
+    return None
+  return {'start_time': time.time()}
+
+
+def emit_timings(image_pair, timings):
+  """print the timings for a pair as a single JSON line
+
+  Each record has the pair, when it started and finished, the total
+  seconds, the seconds spent in each stage, and the peak RSS of this
+  process so far. The params for the run are included as well so the
+  timings can be fed back into `create_pbs.py --timings`. Refer to
+  `summarise_timings.py` for pulling these out of the job logs.
+
+  Args:
+    image_pair (str):
+      key or path for the image pair
+    timings (dict):
+      timings from `new_timings` that the stages have been added to
+
+  Returns:
+    NA
+  """
+  if timings is None:
+    return
+  start_time = timings.pop('start_time')
+  disp_range = timings.pop('disp_range', None)
+  gate_skipped = timings.pop('gate_skipped', None)
+  end_time = time.time()
+  # ru_maxrss is in kilobytes on linux
+  max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  record = {'pair': image_pair,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'start_time': start_time,
+            'end_time': end_time,
+            'seconds': end_time - start_time,
+            'stages': timings,
+            'max_rss_mb': max_rss_mb}
+  if disp_range is not None:
+    record['disp_range'] = disp_range
+  if gate_skipped is not None:
+    record['gate_skipped'] = gate_skipped
+  record.update(_worker_state['timing_params'])
+  # write the whole line at once so lines from different workers don't get
+  # mixed up
+  sys.stdout.write(json.dumps(record) + '\n')
+  sys.stdout.flush()
+
+
+def init_worker(max_disparity, block_size, p1, p2, lmbda, sigma,
+                engine='sgbm', pyramid_levels=2, pyramid_band=4,
+                max_memory_mb=512, tile_threads=1, pack_dir=None,
+                disp_pack_dir=None, cache_dir=None, cache_size_mb=10240,
+                stage_timings=False, im_height=None, im_width=None,
+                disp_store_dir=None, disp_dtype='int16', disp_codec='zlib',
+                disp_batch=16, disp_preview=False, cv_threads=None,
+                cpu_sets=None, gate_threshold=0.02, grayscale=False,
+                full_decode=False, decode_threads=1):
+  """create the matchers and WLS filter for this process
+
+  Is used as the initializer for each process in the pool, so each worker
+  builds its own matchers and filter once, and then reuses them for every
+  image pair it is given. Is also called directly when running serially.
+
+  Args:
+    max_disparity (int):
+      max disparity for matcher to search to
+    block_size (int):
+      size of the window for matcher
+    p1 (float):
+      smoothing param
+    p2 (float):
+      smoothing param
+    lmbda (float):
+      parameter for regularisation when postprocessing
+    sigma (float):
+      sensitivity parameter for postprocessing
+    engine (str):
+      either `sgbm` for full range matching, `pyramid` for coarse-to-fine,
+      `tiled` for matching in strips or `gated` to only refine where the
+      left disparity isn't confident
+    pyramid_levels (int):
+      number of pyramid levels below full resolution for pyramid engine
+    pyramid_band (int):
+      search band either side of the coarse estimate for pyramid engine
+    max_memory_mb (int):
+      memory budget for matching and filtering for tiled engine
+    tile_threads (int):
+      number of strips to work on at once for tiled engine
+    pack_dir (str):
+      packed dataset to read image pairs from. If None, image pairs are
+      read from their own directories
+    disp_pack_dir (str):
+      pack to append disparity maps to. If None, they are saved as
+      `disp.jpg` next to the original images
+    cache_dir (str):
+      directory for the cache of resized images. If None, no cache is used
+    cache_size_mb (int):
+      size limit for the cache of resized images
+    stage_timings (bool):
+      whether to print a JSON line of stage timings for every pair
+    im_height (int):
+      height images are resized to, only used to label the timings
+    im_width (int):
+      width images are resized to, only used to label the timings
+    disp_store_dir (str):
+      if not None, raw disparity maps are added to a disparity store here,
+      refer to `disparity_store.py`
+    disp_dtype (str):
+      `int16` or `float16`, dtype to keep in the disparity store
+    disp_codec (str):
+      `zlib`, `zstd` or `none`, how to compress the disparity store
+    disp_batch (int):
+      number of disparity maps to buffer before writing to the store
+    disp_preview (bool):
+      whether to save a JPEG preview as well as adding to the store
+    cv_threads (int):
+      number of threads OpenCV uses in this process. If None it is left as
+      it is
+    cpu_sets (list(list(int))):
+      cores for each worker to be pinned to, refer to `core_planner.py`. If
+      None the worker isn't pinned
+    gate_threshold (float):
+      fraction of low confidence pixels in a strip above which it is
+      refined for gated engine
+    grayscale (bool):
+      whether to decode images to a single channel for matching
+    full_decode (bool):
+      whether to always decode JPEGs at full size before resizing, rather
+      than at a reduced scale when they are big enough
+    decode_threads (int):
+      if more than 1, the left and right images are decoded at the same
+      time on a pool of this many threads
+
+  Returns:
+    NA
+  """
+  if cv_threads is not None:
+    core_planner.configure_worker(cv_threads, cpu_sets)
+  left_matcher, right_matcher = create_matchers(max_disparity, block_size,
+                                                p1, p2)
+  _worker_state['left_matcher'] = left_matcher
+  _worker_state['right_matcher'] = right_matcher
+  _worker_state['wls_filter'] = create_wls_filter(left_matcher, lmbda, sigma)
+  _worker_state['engine'] = engine
+  _worker_state['matcher_args'] = (max_disparity, block_size, p1, p2)
+  _worker_state['filter_args'] = (lmbda, sigma)
+  _worker_state['pyramid_args'] = (max_disparity, block_size, p1, p2,
+                                   pyramid_levels, pyramid_band)
+  _worker_state['tiled_args'] = (max_memory_mb, tile_threads)
+  _worker_state['gated_args'] = (max_disparity, gate_threshold)
+  _worker_state['tile_local'] = threading.local()
+  _worker_state['decode_args'] = {'grayscale': grayscale,
+                                  'reduced': not full_decode}
+  if decode_threads > 1:
+    _worker_state['decode_args']['decode_pool'] = ThreadPoolExecutor(
+      decode_threads)
+  if (engine == 'tiled') and (tile_threads > 1):
+    _worker_state['tile_pool'] = ThreadPoolExecutor(tile_threads)
+  # open the packs here rather than in the parent, as memory maps and open
+  # files shouldn't be shared across processes
+  if pack_dir is not None:
+    _worker_state['pack'] = pack_dataset.PackedDataset(pack_dir)
+  if disp_pack_dir is not None:
+    _worker_state['disp_writer'] = pack_dataset.PackWriter(disp_pack_dir)
+  if cache_dir is not None:
+    _worker_state['cache'] = image_cache.ImageCache(cache_dir, cache_size_mb)
+  if disp_store_dir is not None:
+    _worker_state['disp_store'] = disparity_store.DisparityStoreWriter(
+      disp_store_dir, disp_dtype, disp_codec, batch_size=disp_batch)
+  # pool workers exit once the pool is closed, make sure whatever is left
+  # in the last batch is written out and the thread pools are shut down
+  # when they do
+  multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+  _worker_state['disp_preview'] = disp_preview
+  _worker_state['stage_timings'] = stage_timings
+  _worker_state['timing_params'] = {'im_height': im_height,
+                                    'im_width': im_width,
+                                    'max_disparity': max_disparity,
+                                    'block_size': block_size,
+                                    'engine': engine}
+
+
+def close_worker():
+  """write out anything the worker still has buffered, and stop its threads"""
+  disp_store = _worker_state.pop('disp_store', None)
+  if disp_store is not None:
+    disp_store.close()
+  tile_pool = _worker_state.pop('tile_pool', None)
+  if tile_pool is not None:
+    tile_pool.shutdown()
+  decode_pool = _worker_state.get('decode_args', {}).pop('decode_pool', None)
+  if decode_pool is not None:
+    decode_pool.shutdown()
+
+
+def process_image_pair(image_pair, im_height, im_width):
+  """compute and save the disparity map for a single image pair
+
+  Uses the matchers and filter created by `init_worker` for this process.
+  Any error for this pair is caught and handed back rather than raised, so a
+  single corrupt pair won't take down the whole run.
+
+  Args:
+    image_pair (str):
+      path to directory containing the two original images, or key of the
+      pair if reading from a pack
+    im_height (int):
+      height of image to be resized to
+    im_width (int):
+      width of image to be resized to
+
+  Returns:
+    tuple of (image_pair, error), where error is None if everything went
+    fine, otherwise is a string with the traceback for this pair
+  """
+  try:
+    timings = new_timings()
+    left_im, right_im = load_image_pair(image_pair, im_height, im_width,
+                                        timings)
+    filtered_disp = compute_worker_disparity(left_im, right_im, timings)
+    store_disparity_map(filtered_disp, image_pair, timings)
+    emit_timings(image_pair, timings)
+  except Exception:
+    return image_pair, traceback.format_exc()
+  return image_pair, None
+
+
+def pipeline_image_pairs(image_pair_paths, im_height, im_width,
+                         read_threads, write_threads, read_depth, write_depth):
+  """compute and save disparity maps as a read -> compute -> write pipeline
+
+  Reading/resizing and writing are mostly waiting on the filesystem, so
+  rather than doing them one after the other with the compute, a pool of
+  reader threads decodes and resizes pairs ahead of the compute stage, and a
+  pool of writer threads saves the results behind it. The compute stage runs
+  in the calling thread using the matchers and filter from `init_worker`,
+  so that needs to be called first.
+
+  The number of pairs read ahead and the number of results waiting to be
+  written are both bounded, so memory use stays fixed no matter how long
+  the list is. At 1080p each pair read ahead holds about 12MB and each
+  result waiting to be written about 2MB.
+
+  Once everything is done, will print how busy each stage was, which tells
+  us which one is the bottleneck.
+
+  Args:
+    image_pair_paths (list(str)):
+      paths to directories containing the image pairs
+    im_height (int):
+      height of image to be resized to
+    im_width (int):
+      width of image to be resized to
+    read_threads (int):
+      number of threads reading and resizing images
+    write_threads (int):
+      number of threads saving disparity maps
+    read_depth (int):
+      max number of pairs read ahead of the compute stage
+    write_depth (int):
+      max number of results waiting to be written
+
+  Returns:
+    generator of (image_pair, error) tuples the same as `process_image_pair`,
+    in the order they finish
+
+  Raises:
+    NA, errors for each pair are handed back in the results
+  """
+  # total time spent working in each stage, summed across all the threads
+  # in that stage
+  stage_busy = {'read': 0.0, 'compute': 0.0, 'write': 0.0}
+  stage_threads = {'read': read_threads, 'compute': 1, 'write': write_threads}
+  stage_lock = threading.Lock()
+
+  def timed(stage, fn, *fn_args):
+    start = time.perf_counter()
+    try:
+      return fn(*fn_args)
+    finally:
+      with stage_lock:
+        stage_busy[stage] += time.perf_counter() - start
+
+  def finished_writes(wait):
+    # hand back any writes that have finished, or all of them if we are
+    # waiting on them
+    while pending_writes and (wait or pending_writes[0][2].done()):
+      image_pair, timings, write_future = pending_writes.popleft()
+      try:
+        write_future.result()
+      except Exception:
+        yield image_pair, traceback.format_exc()
+      else:
+        emit_timings(image_pair, timings)
+        yield image_pair, None
+
+  reader = ThreadPoolExecutor(read_threads)
+  writer = ThreadPoolExecutor(write_threads)
+  write_slots = threading.BoundedSemaphore(write_depth)
+  pending_reads = collections.deque()
+  pending_writes = collections.deque()
+  pair_iter = iter(image_pair_paths)
+
+  def submit_read():
+    for image_pair in pair_iter:
+      timings = new_timings()
+      pending_reads.append(
+        (image_pair, timings,
+         reader.submit(timed, 'read', load_image_pair,
+                       image_pair, im_height, im_width, timings)))
+      return
+
+  start = time.perf_counter()
+  try:
+    # fill up the read ahead queue
+    for _ in range(read_depth):
+      submit_read()
+    while pending_reads:
+      image_pair, timings, read_future = pending_reads.popleft()
+      # top up the read ahead queue now that a slot is free
+      submit_read()
+      try:
+        left_im, right_im = read_future.result()
+        filtered_disp = timed('compute', compute_worker_disparity,
+                              left_im, right_im, timings)
+      except Exception:
+        yield image_pair, traceback.format_exc()
+        continue
+      # will block here if the writers have fallen too far behind
+      write_slots.acquire()
+      write_future = writer.submit(timed, 'write', store_disparity_map,
+                                   filtered_disp, image_pair, timings)
+      write_future.add_done_callback(lambda f: write_slots.release())
+      pending_writes.append((image_pair, timings, write_future))
+      for result in finished_writes(wait=False):
+        yield result
+    for result in finished_writes(wait=True):
+      yield result
+  finally:
+    reader.shutdown()
+    writer.shutdown()
+  # now report how busy each stage was. Occupancy is the fraction of the
+  # total time the threads in that stage were actually working; the stage
+  # closest to 100% is the one holding everything else up
+  elapsed = time.perf_counter() - start
+  print('pipeline stage occupancy over {:.2f}s:'.format(elapsed))
+  for stage in ['read', 'compute', 'write']:
+    occupancy = stage_busy[stage] / max(elapsed * stage_threads[stage], 1e-9)
+    print('  {:<8s} threads: {:d}  busy: {:.2f}s  occupancy: {:.1%}'.format(
+      stage, stage_threads[stage], stage_busy[stage], occupancy))
+
+
+def main(args):
+  """Program for performing stereo matching and filtering
+  to create depth maps from a stereo pair.
+  Will first perform stereo matching using the SGBM
+  method [1]. Will then apply the Weigted Least Squared postprocessing
+  to tidy it up [2].
+
+  Please refer to documenetion within these references for info. on what these
+  params are which values are suitable for them.
+
+  # REFERENCES
+  [1] https://docs.opencv.org/3.4/d2/d85/classcv_1_1StereoSGBM.html
+  [2] https://docs.opencv.org/3.4/d9/d51/classcv_1_1ximgproc_1_1DisparityWLSFilter.html
+  """
+  # share the cores we have actually been given between the workers and
+  # OpenCV's threads, rather than each worker's OpenCV using the whole node
+  allowance = core_planner.cpu_allowance()
+  core_plan = core_planner.plan_cores(args.workers, args.cv_threads,
+                                      args.pin_cpus, allowance)
+  print(core_planner.describe_plan(core_plan, allowance))
+  # arguments needed to create the matchers and WLS filter.
+  # note here I am only sending parameters needed to these methods, rather than
+  # all the cmdline args.
+  init_args = (args.max_disparity, args.block_size, args.p1, args.p2,
+               args.lmbda, args.sigma, args.engine, args.pyramid_levels,
+               args.pyramid_band, args.max_memory_mb, args.tile_threads,
+               args.pack_dir, args.disp_pack_dir, args.cache_dir,
+               args.cache_size_mb, args.stage_timings, args.im_height,
+               args.im_width, args.disp_store, args.disp_dtype,
+               args.disp_codec, args.disp_batch, args.disp_preview,
+               core_plan.cv_threads, core_plan.cpu_sets, args.gate_threshold,
+               args.grayscale, args.full_decode, args.decode_threads)
+  process_fn = functools.partial(process_image_pair,
+                                 im_height=args.im_height,
+                                 im_width=args.im_width)
+  # If we have more than one worker, will fan the pairs out across a
+  # pool of processes, where each process creates its own matchers once.
+  # otherwise just create the matchers here
+  pool = None
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers,
+                                initializer=init_worker,
+                                initargs=init_args)
+  else:
+    init_worker(*init_args)
+  manifest = None
+  if args.manifest is not None:
+    manifest = run_manifest.RunManifest(args.manifest)
+
+  def run_pairs(image_pair_paths):
+    # compute disparity maps for a list of pairs and then save them.
+    # results come back in the order they finish, not the order of the list
+    if manifest is not None:
+      # skip over any pairs that were finished by an earlier run
+      num_pairs = len(image_pair_paths)
+      image_pair_paths, resume_state = find_remaining_pairs(
+        image_pair_paths, manifest, args)
+      print('skipping {} of {} image pairs already done'.format(
+        num_pairs - len(image_pair_paths), num_pairs))
+    if args.pipeline:
+      results = pipeline_image_pairs(image_pair_paths,
+                                     args.im_height, args.im_width,
+                                     args.read_threads, args.write_threads,
+                                     args.read_depth, args.write_depth)
+    elif pool is not None:
+      results = pool.imap_unordered(process_fn, image_pair_paths)
+    else:
+      results = map(process_fn, image_pair_paths)
+    if manifest is not None:
+      results = record_results(results, manifest, resume_state)
+    return results
+
+  if args.queue is not None:
+    # pull batches of pairs from the shared queue until it is empty
+    queue = work_queue.WorkQueue(args.queue)
+    failed_pairs = report_results(queue_results(queue, run_pairs, args), None)
+    queue.close()
+  else:
+    # open the list of paths to image pairs to iterate over
+    image_pair_paths = read_image_path_list(args.image_path_list)
+    failed_pairs = report_results(run_pairs(image_pair_paths),
+                                  len(image_pair_paths))
+  if pool is not None:
+    pool.close()
+    pool.join()
+  else:
+    close_worker()
+  if manifest is not None:
+    manifest.close()
+  return failed_pairs
+
+
+def queue_results(queue, run_pairs, args):
+  """work through batches of image pairs claimed from a shared queue
+
+  Each pair is marked as done or failed in the queue as its result comes
+  in, and the lease on the rest of the batch is renewed, so as long as we
+  keep making progress nobody else will take our work. If a lease runs out
+  anyway, the pair is left to whoever has it now.
+
+  Args:
+    queue (WorkQueue):
+      queue to claim pairs from
+    run_pairs (callable):
+      takes a list of pairs and returns (image_pair, error) results for them
+    args (object):
+      parsed cmdline args
+
+  Returns:
+    generator of (image_pair, error) tuples, until the queue is empty
+  """
+  owner = work_queue.default_owner()
+  while True:
+    batch = queue.claim(owner, args.queue_batch, args.lease_seconds)
+    if not batch:
+      break
+    # the same pair can be in the queue more than once, so keep every task
+    # for it and hand one back for each result
+    task_ids = collections.defaultdict(list)
+    for task_id, item in batch:
+      task_ids[item].append(task_id)
+    for image_pair, error in run_pairs([item for _, item in batch]):
+      if error is None:
+        marked = queue.complete(owner, task_ids[image_pair].pop())
+      else:
+        marked = queue.fail(owner, task_ids[image_pair].pop(), error)
+      if not marked:
+        print('lost the lease on {}, leaving it to whoever has it now'.format(
+          image_pair), file=sys.stderr)
+      queue.renew(owner, args.lease_seconds)
+      yield image_pair, error
+    # anything left over was skipped because the manifest says it is done
+    for pair_task_ids in task_ids.values():
+      for task_id in pair_task_ids:
+        queue.complete(owner, task_id)
+
+
+def output_params(args):
+  """params that change the disparity maps we output
+
+  Used to fingerprint a run, so if any of these change the pairs are
+  computed again.
+
+  Args:
+    args (object):
+      parsed cmdline args
+
+  Returns:
+    dict of param names and values
+  """
+  params = {name: getattr(args, name) for name in
+            ['im_height', 'im_width', 'max_disparity', 'block_size', 'p1',
+             'p2', 'lmbda', 'sigma', 'engine']}
+  if args.engine == 'pyramid':
+    params['pyramid_levels'] = args.pyramid_levels
+    params['pyramid_band'] = args.pyramid_band
+  elif args.engine == 'tiled':
+    # strip layout depends on both of these
+    params['max_memory_mb'] = args.max_memory_mb
+    params['tile_threads'] = args.tile_threads
+  elif args.engine == 'gated':
+    params['gate_threshold'] = args.gate_threshold
+  if args.grayscale:
+    params['grayscale'] = True
+  # the reduced decode is filtered differently, so isn't quite the same as
+  # decoding at full size, and maps from before it was added were all
+  # decoded at full size
+  params['decode'] = 'full' if args.full_decode else 'reduced'
+  if args.disp_store is not None:
+    # stored values are different to the JPEGs, so count as a new run
+    params['disp_dtype'] = args.disp_dtype
+  return params
+
+
+def pair_input_signature(image_pair, pack):
+  """signature of the input images for a pair, for the manifest
+
+  Args:
+    image_pair (str):
+      key, path or archive pair for the image pair
+    pack (PackedDataset):
+      pack the pair is read from, or None if reading from directories
+
+  Returns:
+    list with a signature for the left and right images, or None if either
+    of them is missing
+  """
+  signatures = []
+  for orientation in ['left', 'right']:
+    if archive_dataset.is_archive_pair(image_pair):
+      archive_path, image_key = archive_dataset.split_archive_pair(image_pair)
+      try:
+        signature = archive_dataset.open_archive(archive_path).signature(
+          image_key, orientation)
+      except (IOError, OSError):
+        signature = None
+    elif pack is not None:
+      entry = pack.index.get((image_pair, orientation))
+      signature = None if entry is None else list(entry)
+    else:
+      signature = run_manifest.file_signature(
+        os.path.join(image_pair, '{}.jpg'.format(orientation)))
+    if signature is None:
+      return None
+    signatures.append(signature)
+  return signatures
+
+
+def disparity_output(image_pair, disp_pack_dir, disp_store_dir=None):
+  """where the disparity map for a pair is written to, for the manifest"""
+  if disp_store_dir is not None:
+    return 'store:{}'.format(pair_key(image_pair))
+  if disp_pack_dir is not None:
+    return 'pack:{}'.format(pair_key(image_pair))
+  return os.path.join(pair_output_dir(image_pair), 'disp.jpg')
+
+
+def disparity_output_signature(output, disp_pack, disp_store=None):
+  """signature of a disparity map that has been written, for the manifest
+
+  For a pack or disparity store, entries are only added to the index once
+  they have been fully written, so all we need to know is that the entry is
+  there.
+
+  Args:
+    output (str):
+      where the disparity map was written, from `disparity_output`
+    disp_pack (PackedDataset):
+      pack the disparity maps were written to, or None if saved as files
+    disp_store (DisparityStore):
+      store the disparity maps were written to, or None
+
+  Returns:
+    signature of the output, or None if it is missing
+  """
+  if output.startswith('store:'):
+    if (disp_store is None) or not disp_store.has(output[len('store:'):]):
+      return None
+    return ['store']
+  if output.startswith('pack:'):
+    if (disp_pack is None) or not disp_pack.has(output[len('pack:'):], 'disp'):
+      return None
+    return ['pack']
+  return run_manifest.file_signature(output)
+
+
+def find_remaining_pairs(image_pair_paths, manifest, args):
+  """find the pairs that still need to be done for this run
+
+  Args:
+    image_pair_paths (list(str)):
+      all the pairs in this run
+    manifest (RunManifest):
+      manifest of pairs done in earlier runs
+    args (object):
+      parsed cmdline args
+
+  Returns:
+    tuple of (pairs still to do, state needed by `record_results`)
+  """
+  pack = None
+  if args.pack_dir is not None:
+    pack = pack_dataset.PackedDataset(args.pack_dir)
+  disp_pack = None
+  if args.disp_pack_dir is not None:
+    try:
+      disp_pack = pack_dataset.PackedDataset(args.disp_pack_dir)
+    except IOError:
+      # nothing written to it yet
+      disp_pack = None
+  disp_store = None
+  if args.disp_store is not None:
+    try:
+      disp_store = disparity_store.DisparityStore(args.disp_store)
+    except IOError:
+      # nothing written to it yet
+      disp_store = None
+  fingerprint = run_manifest.params_fingerprint(output_params(args))
+  output_signature_fn = functools.partial(disparity_output_signature,
+                                          disp_pack=disp_pack,
+                                          disp_store=disp_store)
+  remaining_pairs = []
+  input_signatures = {}
+  for image_pair in image_pair_paths:
+    inputs = pair_input_signature(image_pair, pack)
+    if not manifest.is_done(image_pair, inputs, fingerprint,
+                            output_signature_fn):
+      remaining_pairs.append(image_pair)
+      input_signatures[image_pair] = inputs
+  resume_state = {'fingerprint': fingerprint,
+                  'input_signatures': input_signatures,
+                  'disp_pack_dir': args.disp_pack_dir,
+                  'disp_store_dir': args.disp_store}
+  return remaining_pairs, resume_state
+
+
+def record_results(results, manifest, resume_state):
+  """add a manifest record for each pair as it finishes successfully
+
+  Pairs are only recorded once their output has been fully written, so a
+  pair that was killed part way through is done again next time.
+
+  Args:
+    results (iterable):
+      (image_pair, error) tuples, as from `process_image_pair`
+    manifest (RunManifest):
+      manifest to add records to
+    resume_state (dict):
+      state from `find_remaining_pairs`
+
+  Returns:
+    generator that passes through the same results
+  """
+  for image_pair, error in results:
+    inputs = resume_state['input_signatures'][image_pair]
+    if (error is None) and (inputs is not None):
+      output = disparity_output(image_pair, resume_state['disp_pack_dir'],
+                                resume_state['disp_store_dir'])
+      if output.startswith('store:'):
+        # is only in the store once its batch is written out, until then a
+        # rerun will see it is missing and do it again
+        output_signature = ['store']
+      elif output.startswith('pack:'):
+        output_signature = ['pack']
+      else:
+        output_signature = run_manifest.file_signature(output)
+      manifest.record(image_pair, inputs, resume_state['fingerprint'],
+                      output, output_signature)
+    yield image_pair, error
+
+
+def read_image_path_list(image_path_list):
+  """read the list of image pairs to work on
+
+  Args:
+    image_path_list (str):
+      text file with a path (or key) for an image pair on each line
+
+  Returns:
+    list of paths to image pairs
+  """
+  with open(image_path_list) as f:
+    image_pair_paths = f.readlines()
+  # going to strip and newline characters that might be hiding in there,
+  # and skip any blank lines
+  image_pair_paths = [x.rstrip() for x in image_pair_paths if x.strip()]
+  return image_pair_paths
+
+
+def report_results(results, num_pairs):
+  """print progress as results come in, and which pairs failed at the end
+
+  Args:
+    results (iterable):
+      (image_pair, error) tuples, as from `process_image_pair`
+    num_pairs (int):
+      total number of pairs we are expecting, or None if we don't know
+      (such as when pulling from a queue)
+
+  Returns:
+    list of image pairs that failed
+  """
+  failed_pairs = []
+  count = 0
+  for count, (image_pair, error) in enumerate(results, 1):
+    progress = str(count) if num_pairs is None else '{}/{}'.format(count,
+                                                                  num_pairs)
+    if error is None:
+      print('{} done: {}'.format(progress, image_pair))
+    else:
+      failed_pairs.append(image_pair)
+      print('{} failed: {}\n{}'.format(progress, image_pair, error),
+            file=sys.stderr)
+  if failed_pairs:
+    print('{} of {} image pairs failed:'.format(
+      len(failed_pairs), count if num_pairs is None else num_pairs),
+          file=sys.stderr)
+    for image_pair in failed_pairs:
+      print(image_pair, file=sys.stderr)
+  return failed_pairs
+
+
+def check_matcher_args(args):
+  """check values for the matcher and filter params are good
+
+  Is split out from `check_cmdline_args` so other scripts that create
+  matchers with the same params can check them the same way. Will also fill
+  in the suggested values for p1 and p2 if they weren't supplied.
+
+  Args:
+    args (object):
+      parsed cmdline args with the matcher and filter params
+
+  Returns:
+    NA
+
+  Raises:
+    ValueError if a param is supplied is invalid
+  """
+  if (args.max_disparity <= 0) or ((args.max_disparity % 16) != 0):
+    raise ValueError(
+      'Invalid value for max disparity, must be integer > 0 that is divisible by 16: {}'.format(
+        args.max_disparity))
+  if (args.block_size < 3) or ((args.block_size % 2) == 0):
+    raise ValueError(
+      'Invalid value for block_size, must be odd integer >= 3: {}'.format(
+        args.block_size))
+  channels = 1 if getattr(args, 'grayscale', False) else 3
+  if args.p1 is None:
+    # set to suggested value, which is
+    # 8*number_of_image_channels*blockSize*blockSize
+    args.p1 = int(8 * channels * args.block_size**2.0)
+  elif args.p1 < 0:
+    raise ValueError(
+      'Invalid value for p1, must be positive. If unsure leave as default. {}'.format(
+        args.p1))
+  if args.p2 is None:
+    # set to suggested value, which is
+    # 32*number_of_image_channels*blockSize*blockSize
+    args.p2 = int(32 * channels * args.block_size**2.0)
+  elif args.p2 < 0:
+    raise ValueError(
+      'Invalid value for p2, must be positive. If unsure leave as default. {}'.format(
+        args.p2))
+  if args.p1 > args.p2:
+    raise ValueError(
+      'Invalid value for p1 and p2, p1 must be < p2: {} {}'.format(
+        args.p1, args.p2))
+  if (args.lmbda < 0):
+    raise ValueError(
+      'Invalid value for lmbda, must be > 0: {}'.format(
+        args.lmbda))    
+  if (args.sigma < 0):
+    raise ValueError(
+      'Invalid value for sigma, must be > 0: {}'.format(
+        args.sigma))
+
+
+def check_cmdline_args(args):
+  """check values for cmdline args are good
+  
+  Our params for the stereo matcher and filtering have some certain constraints.
+  Want to check them all to make sure they are all valid before running any of
+  them.
+  
+  Args:
+    args (object):
+      essentially a struct/struct with all our parsed cmdline args
+  
+  Returns:
+    NA
+
+  Raises:
+    IOError if path for file list doesnt exist
+    ValueError if a param is supplied is invalid
+  """
+  if (args.image_path_list is None) == (args.queue is None):
+    raise ValueError('Need to give either an image path list or a queue')
+  if (args.image_path_list is not None) and (
+      not os.path.isfile(args.image_path_list)):
+    raise IOError(
+      'Value for image paths does not exist: {}'.format(args.image_path_list))
+  if (args.queue is not None) and (not os.path.isfile(args.queue)):
+    raise IOError(
+      'Value for queue does not exist: {}'.format(args.queue))
+  check_matcher_args(args)
+  if args.pack_dir is not None:
+    if not os.path.isdir(args.pack_dir):
+      raise IOError(
+        'Value for pack dir does not exist: {}'.format(args.pack_dir))
+    # there are no directories for each pair to save the disparity maps in,
+    # so they go back into the pack unless told otherwise
+    if args.disp_pack_dir is None:
+      args.disp_pack_dir = args.pack_dir
+  if (args.cache_dir is not None) and (args.pack_dir is not None):
+    raise ValueError(
+      'Image cache is only used when reading from directories, not packs: {}'.format(
+        args.pack_dir))
+  if args.core_plan is not None:
+    # workers and threads that were quickest when calibrated on this node
+    args.workers, args.cv_threads = core_planner.read_core_plan(
+      args.core_plan)
+  if (args.cv_threads is not None) and (args.cv_threads < 1):
+    raise ValueError(
+      'Invalid value for cv_threads, must be >= 1: {}'.format(
+        args.cv_threads))
+  if (args.workers < 1):
+    raise ValueError(
+      'Invalid value for workers, must be >= 1: {}'.format(
+        args.workers))
+  if args.pipeline and (args.workers > 1):
+    raise ValueError(
+      'Pipeline mode runs compute in a single process, cannot use with workers: {}'.format(
+        args.workers))
+  for name in ['read_threads', 'write_threads', 'read_depth', 'write_depth',
+               'pyramid_levels', 'pyramid_band', 'max_memory_mb',
+               'tile_threads', 'cache_size_mb', 'queue_batch',
+               'lease_seconds', 'disp_batch']:
+    if getattr(args, name) < 1:
+      raise ValueError(
+        'Invalid value for {}, must be >= 1: {}'.format(
+          name, getattr(args, name)))
+  if args.engine == 'tiled':
+    # will raise an error if the memory budget is too small, better to find
+    # out now than for every pair
+    plan_strips(args.im_height, args.im_width, args.max_disparity,
+                args.block_size, args.max_memory_mb, args.tile_threads)
+  if not (0.0 <= args.gate_threshold <= 1.0):
+    raise ValueError(
+      'Invalid value for gate_threshold, must be between 0 and 1: {}'.format(
+        args.gate_threshold))
+  if args.decode_threads < 1:
+    raise ValueError(
+      'Invalid value for decode_threads, must be >= 1: {}'.format(
+        args.decode_threads))
     
 
 if __name__ == '__main__':
@@ -281,8 +2364,8 @@ if __name__ == '__main__':
                                    formatter_class=
                                    argparse.RawDescriptionHelpFormatter)
   parser.add_argument('image_path_list',
-                      type=str,
-                      help='text file with path to images')
+                      type=str, nargs='?', default=None,
+                      help='text file with path to images, or image keys if using a pack')
   parser.add_argument('--im_height', type=int, default=1080,
                       help='height of image to be reshaped to')
   parser.add_argument('--im_width', type=int, default=1920,
@@ -297,11 +2380,87 @@ if __name__ == '__main__':
                       help='smoothness param')
   parser.add_argument('--lmbda', type=int, default=8000,
                       help='parameter for regularisation when postprocessing')
-  parser.add_argument('--sigma', type=int, default=1.2,
+  parser.add_argument('--sigma', type=float, default=1.2,
                       help='sensitivity parameter for postprocessing')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='number of processes to spread image pairs across')
+  parser.add_argument('--cv_threads', type=int, default=None,
+                      help='OpenCV threads for each worker, default shares out the cores we have been given')
+  parser.add_argument('--pin_cpus', action='store_true',
+                      help='pin each worker to its own cores, refer to core_planner.py')
+  parser.add_argument('--core_plan', type=str, default=None,
+                      help='workers and OpenCV threads from core_planner.py calibrate')
+  parser.add_argument('--pipeline', action='store_true',
+                      help='overlap reading, compute and writing using threads')
+  parser.add_argument('--read_threads', type=int, default=2,
+                      help='number of reader threads in pipeline mode')
+  parser.add_argument('--write_threads', type=int, default=2,
+                      help='number of writer threads in pipeline mode')
+  parser.add_argument('--read_depth', type=int, default=8,
+                      help='max pairs read ahead of compute in pipeline mode')
+  parser.add_argument('--write_depth', type=int, default=8,
+                      help='max results waiting to be written in pipeline mode')
+  parser.add_argument('--engine', type=str, default='sgbm',
+                      choices=['sgbm', 'pyramid', 'tiled', 'gated'],
+                      help='full range sgbm, coarse-to-fine pyramid, tiled, or gated to only refine where needed')
+  parser.add_argument('--pyramid_levels', type=int, default=2,
+                      help='number of times to halve resolution for pyramid')
+  parser.add_argument('--pyramid_band', type=int, default=4,
+                      help='pixels either side of coarse estimate to search')
+  parser.add_argument('--max_memory_mb', type=int, default=512,
+                      help='memory budget in MB for matching in tiled engine')
+  parser.add_argument('--tile_threads', type=int, default=1,
+                      help='number of strips to match at once in tiled engine')
+  parser.add_argument('--gate_threshold', type=float, default=0.02,
+                      help='fraction of low confidence pixels in a strip above which it is refined in gated engine')
+  parser.add_argument('--grayscale', action='store_true',
+                      help='decode images to grayscale and match on a single channel')
+  parser.add_argument('--full_decode', action='store_true',
+                      help='always decode JPEGs at full size, rather than at a reduced scale when resizing down')
+  parser.add_argument('--decode_threads', type=int, default=1,
+                      help='decode the left and right images at the same time on this many threads')
+  parser.add_argument('--pack_dir', type=str, default=None,
+                      help='read image pairs from this pack made by pack_dataset.py')
+  parser.add_argument('--disp_pack_dir', type=str, default=None,
+                      help='append disparity maps to this pack instead of disp.jpg')
+  parser.add_argument('--cache_dir', type=str, default=None,
+                      help='directory to cache resized images in, refer to image_cache.py')
+  parser.add_argument('--cache_size_mb', type=int, default=10240,
+                      help='size limit for the image cache in MB')
+  parser.add_argument('--archive_index_dir', type=str, default=None,
+                      help='directory to keep archive indexes in, for when the archive is read only')
+  parser.add_argument('--manifest', type=str, default=None,
+                      help='manifest of finished pairs, rerunning skips pairs already done')
+  parser.add_argument('--queue', type=str, default=None,
+                      help='pull pairs from this queue made by work_queue.py, instead of a list')
+  parser.add_argument('--queue_batch', type=int, default=8,
+                      help='number of pairs to claim from the queue at a time')
+  parser.add_argument('--lease_seconds', type=int, default=1800,
+                      help='how long claimed pairs are held before going back in the queue')
+  parser.add_argument('--disp_store', type=str, default=None,
+                      help='save raw disparity to this store instead of disp.jpg, refer to disparity_store.py')
+  parser.add_argument('--disp_dtype', type=str, default='int16',
+                      choices=sorted(disparity_store.DTYPES),
+                      help='int16 for raw 16x fixed point, or float16 for pixels')
+  parser.add_argument('--disp_codec', type=str, default='zlib',
+                      choices=disparity_store.CODECS,
+                      help='compression for the disparity store, none can be memory mapped directly')
+  parser.add_argument('--disp_batch', type=int, default=16,
+                      help='number of disparity maps to write to the store at once')
+  parser.add_argument('--disp_preview', action='store_true',
+                      help='save a JPEG preview as well as adding to the disparity store')
+  parser.add_argument('--stage_timings', action='store_true',
+                      help='print a JSON line of stage timings for each pair, refer to summarise_timings.py')
   # parse in cmdline args
   args = parser.parse_args(sys.argv[1:])
   # perform some checks on the command line arguments
   check_cmdline_args(args)
-  main(args)
+  # the workers inherit this, so they all look for the index in the same place
+  if args.archive_index_dir:
+    os.environ[archive_dataset.INDEX_DIR_ENV] = args.archive_index_dir
+  failed_pairs = main(args)
+  # exit with an error code if any of the pairs failed, so it shows up in the
+  # job status
+  if failed_pairs:
+    sys.exit(1)
 
@@ -1,15 +1,14 @@
 import os
 import sys
 import argparse
+import itertools
 import re
+import shlex
 from glob import glob
 
-def replace_string(file_lines, key_str, replace_item):
-  """replace instances of key within a file with replace_str"""
-  # make sure replacement element is a string
-  replace_str = str(replace_item)
-  new_lines = [x.replace(key_str, replace_str) for x in file_lines]
-  return new_lines
+import pbs_template
+import shard_planner
+import work_queue
 
 def save_changes(pbs_file, updated):
   """save the updated pbs file to the new path"""
@@ -17,6 +16,325 @@ def save_changes(pbs_file, updated):
     f.writelines(updated)
      
 
+def plan_balanced_shards(args):
+  """split the full pair list into balanced shards and save them
+
+  Returns:
+    tuple of (paths to the shard lists, walltime for each, memory for each)
+  """
+  with open(args.image_path_list) as f:
+    image_pair_paths = [x.rstrip() for x in f if x.strip()]
+  params = {'im_height': args.im_height, 'im_width': args.im_width,
+            'max_disparity': args.max_disparity,
+            'block_size': args.block_size}
+  costs = shard_planner.predict_costs(image_pair_paths, params, args.timings)
+  if args.nshards is not None:
+    num_shards = args.nshards
+  else:
+    h, m, sec = [int(x) for x in args.target_walltime.split(':')]
+    num_shards = shard_planner.num_shards_for_walltime(
+      costs, args.ncpus, h * 3600 + m * 60 + sec)
+  shards = shard_planner.balance_shards(image_pair_paths, costs, num_shards)
+  image_lists, walltimes, memories = [], [], []
+  for i, (total_cost, pairs) in enumerate(shards):
+    image_list = os.path.abspath(
+      os.path.join(args.outdir, 'image_{:0>2d}.txt'.format(i)))
+    with open(image_list, 'w') as f:
+      f.writelines('{}\n'.format(x) for x in pairs)
+    image_lists.append(image_list)
+    walltimes.append(shard_planner.shard_walltime(total_cost, args.ncpus))
+    memories.append(shard_planner.shard_memory(pairs, params, args.ncpus))
+    print('shard {}: {} pairs, predicted {:.0f}s, {} {}'.format(
+      i, len(pairs), total_cost / args.ncpus, walltimes[-1], memories[-1]))
+  return image_lists, walltimes, memories
+
+
+def parse_grid(grid_specs):
+  """parse params to sweep over
+
+  Each is given as `NAME=v1,v2,...`, or for a range of ints as
+  `NAME=start:stop:step` where stop is included, eg.
+  `NTREES=10000:100000:10000`. NAME is the placeholder to fill in, so
+  `<NTREES>` in the base script.
+
+  Returns:
+    list of (name, list of values)
+
+  Raises:
+    ValueError if any of the specs aren't valid
+  """
+  grid = []
+  for grid_spec in grid_specs:
+    name, _, values = grid_spec.partition('=')
+    if (not pbs_template.PLACEHOLDER_RE.fullmatch('<{}>'.format(name)) or
+        not values):
+      raise ValueError('Incorrect grid spec {}'.format(grid_spec))
+    if re.fullmatch(r'-?\d+:-?\d+:\d+', values):
+      start, stop, step = [int(x) for x in values.split(':')]
+      if step < 1:
+        raise ValueError('Incorrect grid spec {}'.format(grid_spec))
+      values = [str(x) for x in range(start, stop + 1, step)]
+    else:
+      values = values.split(',')
+    grid.append((name, values))
+  return grid
+
+
+def make_tasks(job_values, grid):
+  """one task for every job and combination of the grid values
+
+  Args:
+    job_values (list(dict)):
+      placeholder values for each job, eg. its image list
+    grid (list(tuple)):
+      params to sweep over, from `parse_grid`
+
+  Returns:
+    list of placeholder values for each task, including its INDEX
+  """
+  names = [name for name, _ in grid]
+  tasks = []
+  for job in job_values:
+    for combination in itertools.product(*[values for _, values in grid]):
+      task = dict(job)
+      task.update(zip(names, combination))
+      task['INDEX'] = len(tasks)
+      tasks.append(task)
+  return tasks
+
+
+def walltime_seconds(walltime):
+  """seconds in a HH:MM:SS walltime"""
+  h, m, sec = [int(x) for x in walltime.split(':')]
+  return h * 3600 + m * 60 + sec
+
+
+def format_walltime(seconds):
+  """HH:MM:SS walltime for some seconds"""
+  seconds = int(seconds)
+  return '{:0>2d}:{:0>2d}:{:0>2d}'.format(seconds // 3600,
+                                          (seconds // 60) % 60, seconds % 60)
+
+
+def memory_mb(memory):
+  """megabytes in a memory spec like 500MB or 2GB"""
+  return int(memory[:-2]) * (1024 if memory.endswith('GB') else 1)
+
+
+def split_directives(base_text):
+  """split a job script into its `#PBS` directives and the rest
+
+  Returns:
+    tuple of (text up to and including the last `#PBS` line, the rest)
+
+  Raises:
+    ValueError if there aren't any `#PBS` lines
+  """
+  lines = base_text.splitlines(True)
+  directive_lines = [i for i, x in enumerate(lines) if x.startswith('#PBS')]
+  if not directive_lines:
+    raise ValueError('base script has no #PBS directives')
+  last = directive_lines[-1] + 1
+  return ''.join(lines[:last]), ''.join(lines[last:])
+
+
+def split_varying(tasks, common):
+  """work out which placeholder values change between tasks
+
+  Returns:
+    tuple of (sorted names of the values that change, dict of the values
+    that are the same for every task, including the common ones)
+  """
+  varying = sorted(name for name in tasks[0] if name != 'INDEX' and
+                   len(set(x[name] for x in tasks)) > 1)
+  constant = dict(common)
+  constant.update({name: value for name, value in tasks[0].items()
+                   if name not in varying and name != 'INDEX'})
+  return varying, constant
+
+
+def plan_bundles(tasks, num_bundles, slots):
+  """share tasks between bundles so they finish about the same time
+
+  Longest tasks go first, each to whichever slot in any bundle frees up
+  soonest. `task_bundle.py` starts tasks in order as slots free up, so
+  writing them out in this order gets the same schedule.
+
+  Args:
+    tasks (list(dict)):
+      tasks from `make_tasks`, with a WALLTIME for each
+    num_bundles (int):
+      number of bundled jobs
+    slots (int):
+      number of tasks each bundle runs at once
+
+  Returns:
+    list of (predicted seconds, tasks) for each bundle that got any tasks
+  """
+  loads = [[0] * slots for _ in range(num_bundles)]
+  bundles = [[] for _ in range(num_bundles)]
+  for task in sorted(tasks, key=lambda x: -walltime_seconds(x['WALLTIME'])):
+    bundle, slot = min(((i, j) for i in range(num_bundles)
+                        for j in range(slots)),
+                       key=lambda x: (loads[x[0]][x[1]], len(bundles[x[0]])))
+    loads[bundle][slot] += walltime_seconds(task['WALLTIME'])
+    bundles[bundle].append(task)
+  return [(max(load), bundle) for load, bundle in zip(loads, bundles)
+          if bundle]
+
+
+def write_job_scripts(base_text, tasks, common, outdir, strict):
+  """write a separate `run_XX.sh` job script for each task
+
+  Returns:
+    list of paths to the job scripts
+  """
+  template = pbs_template.Template(base_text)
+  pbs_files = []
+  for task in tasks:
+    values = dict(common)
+    values.update(task)
+    print(task['INDEX'])
+    print(task.get('IMAGELIST', ''))
+    pbs_file = os.path.join(outdir, 'run_{:0>2d}.sh'.format(task['INDEX']))
+    save_changes(pbs_file, template.render(values, strict))
+    pbs_files.append(pbs_file)
+  return pbs_files
+
+
+def write_array_script(base_text, tasks, common, outdir, strict):
+  """write a single job array script that runs every task
+
+  Each subjob picks out its values with `$PBS_ARRAY_INDEX`. Any placeholder
+  whose value is different between tasks is written into a bash array at
+  the top of the script, and the placeholder is replaced with a lookup into
+  that array. `#PBS` lines are read by the scheduler, not bash, so can only
+  use values that are the same for every task, and `<INDEX>`, which becomes
+  `^array_index^`. The whole array shares one walltime and memory request,
+  so the biggest of these is used.
+
+  Returns:
+    path to the job array script
+
+  Raises:
+    ValueError if a `#PBS` line uses a value that changes between tasks
+  """
+  tasks = [dict(x) for x in tasks]
+  walltime = max((x['WALLTIME'] for x in tasks), key=walltime_seconds)
+  memory = max((x['MEMORY'] for x in tasks), key=memory_mb)
+  for task in tasks:
+    task['WALLTIME'] = walltime
+    task['MEMORY'] = memory
+  varying, constant = split_varying(tasks, common)
+  header_text, body_text = split_directives(base_text)
+  header = pbs_template.Template(header_text)
+  body = pbs_template.Template(body_text)
+  bad = sorted(header.placeholders & set(varying))
+  if bad:
+    raise ValueError(
+      'these change between array tasks so cannot be in #PBS lines: {}'.format(
+        header.describe(bad)))
+  header_values = dict(constant)
+  header_values['INDEX'] = '^array_index^'
+  body_values = dict(constant)
+  body_values['INDEX'] = '${PBS_ARRAY_INDEX}'
+  for name in varying:
+    body_values[name] = '${{{}_VALUES[$PBS_ARRAY_INDEX]}}'.format(name)
+  lines = [header.render(header_values, strict),
+           '#PBS -J 0-{}\n'.format(len(tasks) - 1),
+           '\n# values for each task in the job array, picked out with '
+           '$PBS_ARRAY_INDEX\n']
+  for name in varying:
+    lines.append('{}_VALUES=(\n'.format(name))
+    lines.extend('    {}\n'.format(shlex.quote(str(x[name]))) for x in tasks)
+    lines.append(')\n')
+  lines.append(body.render(body_values, strict))
+  pbs_file = os.path.join(outdir, 'run_array.sh')
+  save_changes(pbs_file, lines)
+  # keep a record of what each index is, handy when looking at the logs
+  with open(os.path.join(outdir, 'array_tasks.tsv'), 'w') as f:
+    f.write('\t'.join(['INDEX'] + varying) + '\n')
+    for task in tasks:
+      f.write('\t'.join(str(task[x]) for x in ['INDEX'] + varying) + '\n')
+  return pbs_file
+
+
+def write_bundle_scripts(base_text, tasks, common, outdir, strict,
+                         bundle_cpus, num_bundles, python='python'):
+  """write job scripts that each run a bundle of tasks with `task_bundle.py`
+
+  The line of the base script that changes between tasks (eg. the line
+  running `create_depth_map.py <IMAGELIST>` or `Rscript ... <NTREES>`) is
+  filled in for every task and written to `bundle_XX_tasks.txt`, and is
+  replaced in the job script with a call to `task_bundle.py` to run them,
+  so everything else in the script (loading modules etc.) is only done once.
+  Each bundle asks for `bundle_cpus` cores, and runs as many tasks at once
+  as fit in that with `<NCPUS>` cores each. Walltime is from running the
+  tasks' walltimes over those slots, and memory is enough for the
+  biggest tasks to be running together.
+
+  Returns:
+    list of paths to the job scripts
+
+  Raises:
+    ValueError if no single line of the base script is different between
+    the tasks, or the tasks don't fit in `bundle_cpus`
+  """
+  slots = bundle_cpus // common['NCPUS']
+  if slots < 1:
+    raise ValueError('tasks need {} cores, bundles only have {}'.format(
+      common['NCPUS'], bundle_cpus))
+  varying, constant = split_varying(tasks, common)
+  for name in ['WALLTIME', 'MEMORY']:
+    if name in varying:
+      varying.remove(name)
+  header_text, body_text = split_directives(base_text)
+  header = pbs_template.Template(header_text)
+  if 'NCPUS' not in header.placeholders:
+    raise ValueError('base script needs <NCPUS> in its #PBS lines to bundle')
+  body_lines = body_text.splitlines(True)
+  task_lines = [i for i, x in enumerate(body_lines)
+                if pbs_template.Template(x).placeholders & set(varying)]
+  if len(task_lines) != 1:
+    raise ValueError(
+      'need exactly one line in the base script that changes between tasks '
+      'to bundle, found {}'.format(len(task_lines)))
+  task_line = pbs_template.Template(body_lines[task_lines[0]])
+  task_bundle = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'task_bundle.py')
+  indent = body_lines[task_lines[0]][:-len(body_lines[task_lines[0]].lstrip())]
+  pbs_files = []
+  for i, (seconds, bundle) in enumerate(
+      plan_bundles(tasks, num_bundles, slots)):
+    tasks_path = os.path.join(outdir, 'bundle_{:0>2d}_tasks.txt'.format(i))
+    with open(tasks_path, 'w') as f:
+      for task in bundle:
+        values = dict(constant)
+        values.update(task)
+        f.write(task_line.render(values, strict).strip() + '\n')
+    values = dict(constant)
+    values['INDEX'] = i
+    values['WALLTIME'] = format_walltime(seconds)
+    memories = sorted((memory_mb(x['MEMORY']) for x in bundle), reverse=True)
+    values['MEMORY'] = '{}MB'.format(sum(memories[:slots]))
+    values['NCPUS'] = bundle_cpus
+    lines = [header.render(values, strict)]
+    values['NCPUS'] = common['NCPUS']
+    for j, line in enumerate(body_lines):
+      if j == task_lines[0]:
+        line = '{}{} {} run {} --cores {} --cores_per_task {}\n'.format(
+          indent, python, task_bundle, tasks_path, bundle_cpus,
+          common['NCPUS'])
+      lines.append(pbs_template.Template(line).render(values, strict))
+    pbs_file = os.path.join(outdir, 'run_bundle_{:0>2d}.sh'.format(i))
+    save_changes(pbs_file, lines)
+    print('bundle {}: {} tasks, {} at a time, {} {}'.format(
+      i, len(bundle), min(slots, len(bundle)), values['WALLTIME'],
+      values['MEMORY']))
+    pbs_files.append(pbs_file)
+  return pbs_files
+
+
 def main(args):
   """
   Creates the qsub scripts to run each individual job.
@@ -24,38 +342,97 @@ def main(args):
   the output directory, the data set, the path to the base
   run script and whether you want to plot the output of running
   each script, then you ware good to go.
+
+  If a queue is given, rather than one job for each `image_xx.txt` file,
+  will put all the pairs from `--image_path_list` into a shared queue and
+  make `--njobs` jobs that each keep pulling pairs from it until it is
+  empty. Refer to `work_queue.py`.
+
+  If `--balance` is given, will split the pairs from `--image_path_list` into
+  shards with about the same predicted cost, write them to `image_xx.txt`
+  files in the output directory, and give each job its own walltime and
+  memory from its predicted cost. Refer to `shard_planner.py`.
+
+  `--grid` gives params to sweep over, and there is a job for every
+  combination of these with each image list (or just one for each
+  combination if there are no image lists), eg. for the bt_examples
+    create_pbs.py /abs/bt_examples/bt.base /abs/bt_examples --array
+      --grid NTREES=10000:100000:10000
+
+  With `--array`, rather than a script for each job, a single job array
+  script `run_array.sh` is written, so there is only one submission for the
+  scheduler to deal with. Submit it with `qsub run_array.sh`.
+
+  With `--bundle_cpus`, the jobs are instead bundled into `--nbundles` job
+  scripts `run_bundle_XX.sh` that each ask for that many cores once, and
+  run their jobs as tasks with `task_bundle.py`, so lots of small jobs don't
+  each have to wait in the queue and load modules. Refer to
+  `task_bundle.py`.
+
+  Placeholders in the base script like `<NCPUS>` are filled in, and any
+  that don't have a value are reported as an error.
   """
-  # get a list of all the image_xx.txt files
-  image_lists = glob('./image_*.txt')
-  # convert to absolute path
-  image_lists = [os.path.abspath(x) for x in image_lists]
+  grid = parse_grid(args.grid)
   # read in the base file
   with open(args.base, 'r') as f:
-    base_file = f.readlines()
-  for i in range(len(image_lists)):
-    print(i)
-    print(image_lists[i])
-    # now copy the base script over to the new run location
-    #pbs_file = os.path.join(args.outdir, 'run_{:0>2d}.sh'.format(i))
-    # now replace the necessary characters in that
-    # pbs batch submission file to send everything
-    # to the correct directories
-    # for the config file, use absolute path and also need to escape
-    # special characters so can be used by `sed`
-    # my_cmd("sed -i \'s/<INDEX>/{}/g\' {}".format(i, pbs_file))
-    # my_cmd("sed -i \'s/<IMAGELIST>/{}/g\' {}".format(image_lists[i], pbs_file))
-    # my_cmd("sed -i \'s/<WALLTIME>/{}/g\' {}".format(args.walltime, pbs_file))
-    # my_cmd("sed -i \'s/<MEMORY>/{}/g\' {}".format(args.mem, pbs_file))
-    # my_cmd("sed -i \'s/<NCPUS>/{}/g\' {}".format(args.ncpus, pbs_file))
-    updated = replace_string(base_file, '<INDEX>', i)
-    updated = replace_string(updated, '<IMAGELIST>', image_lists[i])
-    updated = replace_string(updated, '<WALLTIME>', args.walltime)
-    updated = replace_string(updated, '<MEMORY>', args.mem)
-    updated = replace_string(updated, '<NCPUS>', args.ncpus)
-    # now save the updated changes in a new file
-    pbs_file = os.path.join(args.outdir, 'run_{:0>2d}.sh'.format(i))
-    save_changes(pbs_file, updated)
-
+    base_text = f.read()
+  template = pbs_template.Template(base_text)
+  # a grid param that isn't in the base script is almost certainly a typo
+  unused = [name for name, _ in grid if name not in template.placeholders]
+  if unused:
+    raise ValueError('grid params not used in base script: {}'.format(
+      ', '.join(unused)))
+  # walltime and memory for each job, the same for all of them unless we
+  # are balancing shards
+  walltimes = None
+  memories = None
+  if args.queue is not None:
+    # put everything in the queue if it hasn't been made already
+    if not os.path.exists(args.queue):
+      with open(args.image_path_list) as f:
+        items = [x.rstrip() for x in f if x.strip()]
+      num_items = work_queue.create_queue(args.queue, items)
+      print('created queue {} with {} items'.format(args.queue, num_items))
+    # every job gets the same queue in place of an image list
+    image_lists = ['--queue {}'.format(args.queue)] * args.njobs
+  elif args.balance:
+    image_lists, walltimes, memories = plan_balanced_shards(args)
+  else:
+    # get a list of all the image_xx.txt files
+    image_lists = glob('./image_*.txt')
+    # convert to absolute path
+    image_lists = [os.path.abspath(x) for x in image_lists]
+  if walltimes is None:
+    walltimes = [args.walltime] * len(image_lists)
+    memories = [args.mem] * len(image_lists)
+  job_values = [{'IMAGELIST': image_list, 'WALLTIME': walltime,
+                 'MEMORY': memory}
+                for image_list, walltime, memory in zip(image_lists, walltimes,
+                                                        memories)]
+  if not job_values:
+    if not grid:
+      print('no image lists found, no jobs to make')
+      return
+    # just sweeping over params, so one job for each combination
+    job_values = [{'WALLTIME': args.walltime, 'MEMORY': args.mem}]
+  tasks = make_tasks(job_values, grid)
+  common = {'NCPUS': args.ncpus, 'OUTDIR': args.outdir}
+  unfilled = template.unfilled(set(common) | set(tasks[0]))
+  if unfilled and args.allow_unfilled:
+    print('WARNING: leaving unfilled placeholders: {}'.format(
+      template.describe(unfilled)))
+  if args.bundle_cpus is not None and len(tasks) > 1:
+    write_bundle_scripts(base_text, tasks, common, args.outdir,
+                         not args.allow_unfilled, args.bundle_cpus,
+                         args.nbundles, args.bundle_python)
+  elif args.array and len(tasks) > 1:
+    pbs_file = write_array_script(base_text, tasks, common, args.outdir,
+                                  not args.allow_unfilled)
+    print('wrote job array of {} tasks to {}'.format(len(tasks), pbs_file))
+  else:
+    write_job_scripts(base_text, tasks, common, args.outdir,
+                      not args.allow_unfilled)
+
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(prog='pbs_batch',
@@ -72,6 +449,42 @@ if __name__ == "__main__":
                       help="Max runtime in HH:MM:SS format")
   parser.add_argument("--mem", type=str, default="1GB",
                       help="Memory required, eg. 32GB, 500MB etc.")
+  parser.add_argument("--queue", type=str, default=None,
+                      help="path to a shared work queue to pull pairs from")
+  parser.add_argument("--image_path_list", type=str, default=None,
+                      help="pairs to put in the queue if it doesn't exist yet")
+  parser.add_argument("--njobs", type=int, default=1,
+                      help="number of jobs pulling from the queue")
+  parser.add_argument("--balance", action="store_true",
+                      help="split --image_path_list into balanced shards")
+  parser.add_argument("--nshards", type=int, default=None,
+                      help="number of balanced shards, default is from --target_walltime")
+  parser.add_argument("--target_walltime", type=str, default="01:00:00",
+                      help="walltime to aim for with each balanced shard")
+  parser.add_argument("--array", action="store_true",
+                      help="write a single job array script instead of a script per job")
+  parser.add_argument("--grid", type=str, nargs='+', default=[],
+                      help="params to sweep over, eg. NTREES=10000,20000 or NTREES=10000:100000:10000")
+  parser.add_argument("--bundle_cpus", type=int, default=None,
+                      help="bundle jobs into jobs with this many cores, that run them with task_bundle.py")
+  parser.add_argument("--nbundles", type=int, default=1,
+                      help="number of bundled jobs to share the tasks between")
+  parser.add_argument("--bundle_python", type=str, default="python",
+                      help="python to run task_bundle.py with in the bundled jobs")
+  parser.add_argument("--allow_unfilled", action="store_true",
+                      help="leave placeholders without a value instead of raising an error")
+  parser.add_argument("--timings", type=str, default=None,
+                      help="JSON lines timings from previous runs to fit cost model")
+  # params the jobs will be run with, these need to match the ones in the
+  # base script, as they are only used for predicting the cost
+  parser.add_argument("--im_height", type=int, default=1080,
+                      help="height images are resized to in the jobs")
+  parser.add_argument("--im_width", type=int, default=1920,
+                      help="width images are resized to in the jobs")
+  parser.add_argument("--max_disparity", type=int, default=160,
+                      help="max disparity used in the jobs")
+  parser.add_argument("--block_size", type=int, default=15,
+                      help="block size used in the jobs")
   args = parser.parse_args(sys.argv[1:])
   # check that the absolute path is given for the config file path
   # and the output directory location. Is safer and easier to manage
@@ -86,6 +499,31 @@ if __name__ == "__main__":
   walltime = re.compile('.*:.*:.*')
   if(walltime.match(args.walltime) is None):
     raise(ValueError('Incorrect walltime spec {}'.format(args.walltime)))
+  # the queue is shared between jobs on different nodes, so needs to be an
+  # absolute path on the shared filesystem
+  if(args.queue is not None):
+    if(args.queue[0] not in ['~', '/']):
+      raise(ValueError('need to specify abs path, error {}'.format(args.queue)))
+    if(not os.path.exists(args.queue) and args.image_path_list is None):
+      raise(ValueError('need an image path list to create the queue'))
+    if(args.njobs < 1):
+      raise(ValueError('Incorrect number of jobs {}'.format(args.njobs)))
+  if(args.balance):
+    if(args.queue is not None):
+      raise(ValueError('can only use one of --balance and --queue'))
+    if(args.image_path_list is None):
+      raise(ValueError('need an image path list to balance'))
+    if(args.nshards is not None and args.nshards < 1):
+      raise(ValueError('Incorrect number of shards {}'.format(args.nshards)))
+    if(walltime.match(args.target_walltime) is None):
+      raise(ValueError('Incorrect walltime spec {}'.format(args.target_walltime)))
+
+  if(args.bundle_cpus is not None):
+    if(args.array):
+      raise(ValueError('can only use one of --bundle_cpus and --array'))
+    if(args.bundle_cpus < 1 or args.nbundles < 1):
+      raise(ValueError('Incorrect bundle spec {} {}'.format(
+        args.bundle_cpus, args.nbundles)))
 
   #run the main program with these arguments parsed
   main(args)
@@ -0,0 +1,194 @@
+"""depth_map_engine.py
+
+Library interface for computing disparity maps, for using from other Python
+code rather than running `create_depth_map.py` as a script.
+
+`DepthMapEngine` owns the matchers and WLS filter for a fixed image size,
+along with all the buffers needed for a pair (the resized images, left and
+right disparity, filtered disparity and the uint8 output). The buffers are
+made once and reused for every pair, so once it is running the only memory
+allocated for each pair is what OpenCV uses to decode the JPEGs.
+
+Eg.
+
+  from depth_map_engine import DepthMapEngine
+
+  engine = DepthMapEngine(1080, 1920, max_disparity=160, block_size=15)
+  for image_pair, disp in engine.run(image_pair_paths):
+    ...
+
+Each pair can be a path to a directory with `left.jpg` and `right.jpg` (the
+same as in the image lists for `create_depth_map.py`), or a tuple of
+(left image, right image) arrays that have already been loaded.
+
+NOTE: disparity maps are returned in the engine's own buffers, which are
+reused. There are `num_buffers` of them used in turn, so a result stays
+valid until that many more pairs have been computed. Copy it if you need to
+keep it for longer.
+"""
+import numpy as np
+import argparse
+import os
+
+import cv2
+
+import create_depth_map
+
+
+class DepthMapEngine(object):
+  """computes filtered disparity maps for pairs of a fixed size"""
+
+  def __init__(self, im_height, im_width, max_disparity=160, block_size=15,
+               p1=None, p2=None, lmbda=8000, sigma=1.2, output='uint8',
+               num_buffers=2):
+    """create the matchers, filter and buffers
+
+    Args:
+      im_height (int):
+        height images are resized to
+      im_width (int):
+        width images are resized to
+      max_disparity (int):
+        max disparity for the matcher, must be divisible by 16
+      block_size (int):
+        block size for the matcher, must be odd
+      p1 (int):
+        smoothness param, if None uses the suggested value
+      p2 (int):
+        smoothness param, if None uses the suggested value
+      lmbda (float):
+        regularisation for the WLS filter
+      sigma (float):
+        sensitivity for the WLS filter
+      output (str):
+        `uint8` for the same output as `disp.jpg` from `create_depth_map.py`,
+        or `int16` for the raw 16x fixed point filtered disparity
+      num_buffers (int):
+        number of output buffers to use in turn
+
+    Raises:
+      ValueError if any of the params are invalid
+    """
+    if output not in ['uint8', 'int16']:
+      raise ValueError('Invalid output, must be uint8 or int16: {}'.format(
+        output))
+    if (im_height < 1) or (im_width < 1) or (num_buffers < 1):
+      raise ValueError('Invalid image size or number of buffers: {} {} {}'.format(
+        im_height, im_width, num_buffers))
+    # same checks as the script, fills in p1 and p2 if needed
+    params = argparse.Namespace(max_disparity=max_disparity,
+                                block_size=block_size, p1=p1, p2=p2,
+                                lmbda=lmbda, sigma=sigma)
+    create_depth_map.check_matcher_args(params)
+    self.params = params
+    self.im_height = im_height
+    self.im_width = im_width
+    self.output = output
+    self.left_matcher, self.right_matcher = create_depth_map.create_matchers(
+      params.max_disparity, params.block_size, params.p1, params.p2)
+    self.wls_filter = create_depth_map.create_wls_filter(
+      self.left_matcher, params.lmbda, params.sigma)
+    shape = (im_height, im_width)
+    # resized images are only needed until the pair is filtered, so one set
+    # is enough
+    self._left_im = np.empty(shape + (3,), dtype=np.uint8)
+    self._right_im = np.empty(shape + (3,), dtype=np.uint8)
+    self._displ = np.empty(shape, dtype=np.int16)
+    self._dispr = np.empty(shape, dtype=np.int16)
+    # outputs are handed back to the caller, so have a few to go around
+    self._filtered = [np.empty(shape, dtype=np.int16)
+                      for _ in range(num_buffers)]
+    self._outputs = [np.empty(shape, dtype=np.uint8)
+                     for _ in range(num_buffers)]
+    self._next_buffer = 0
+
+  def load(self, image_pair):
+    """load and resize a pair into the engine's image buffers
+
+    Args:
+      image_pair (str or tuple):
+        path to a directory with `left.jpg` and `right.jpg`, or a tuple of
+        (left image, right image) arrays
+
+    Returns:
+      tuple of (left image, right image), which are the engine's buffers
+
+    Raises:
+      IOError if an image can't be read
+    """
+    if isinstance(image_pair, (str, bytes, os.PathLike)):
+      images = [os.path.join(image_pair, '{}.jpg'.format(x))
+                for x in ['left', 'right']]
+    else:
+      images = image_pair
+    for image, buffer in zip(images, [self._left_im, self._right_im]):
+      if not isinstance(image, np.ndarray):
+        path = image
+        # decode at a reduced scale when the image is big enough, refer to
+        # `create_depth_map.decode_flags`
+        image = None
+        if os.path.isfile(path):
+          data = np.fromfile(path, dtype=np.uint8)
+          if len(data) > 0:
+            image = cv2.imdecode(data, create_depth_map.decode_flags(
+              data, self.im_height, self.im_width))
+        if image is None:
+          raise IOError('unable to read image: {}'.format(path))
+      if image.shape == buffer.shape:
+        np.copyto(buffer, image)
+      else:
+        cv2.resize(image, (self.im_width, self.im_height), buffer)
+    return self._left_im, self._right_im
+
+  def compute(self, left_im, right_im):
+    """compute the filtered disparity for a pair already at the right size
+
+    Args:
+      left_im (array):
+        left image, (im_height, im_width, 3) uint8
+      right_im (array):
+        right image, (im_height, im_width, 3) uint8
+
+    Returns:
+      filtered disparity in one of the engine's output buffers, either uint8
+      or int16 depending on `output`
+    """
+    i = self._next_buffer
+    self._next_buffer = (i + 1) % len(self._outputs)
+    self.left_matcher.compute(left_im, right_im, self._displ)
+    self.right_matcher.compute(right_im, left_im, self._dispr)
+    filtered = self.wls_filter.filter(self._displ, left_im, self._filtered[i],
+                                      self._dispr)
+    if self.output == 'int16':
+      return filtered
+    # same wrap around as `np.uint8` in `create_depth_map.py`, but into the
+    # buffer we already have
+    np.copyto(self._outputs[i], filtered, casting='unsafe')
+    return self._outputs[i]
+
+  def compute_pair(self, image_pair):
+    """load a pair and compute its filtered disparity
+
+    Args:
+      image_pair (str or tuple):
+        refer to `load`
+
+    Returns:
+      filtered disparity, refer to `compute`
+    """
+    left_im, right_im = self.load(image_pair)
+    return self.compute(left_im, right_im)
+
+  def run(self, image_pairs):
+    """compute the filtered disparity for every pair
+
+    Args:
+      image_pairs (iterable):
+        pairs, each a path or tuple of images, refer to `load`
+
+    Returns:
+      generator of (image_pair, filtered disparity) tuples, in the same
+      order as the pairs
+    """
+    for image_pair in image_pairs:
+      yield image_pair, self.compute_pair(image_pair)
@@ -0,0 +1,338 @@
+"""depth_map_service.py
+
+Long running service that keeps the depth map worker warm.
+
+Each run of `create_depth_map.py` has to import OpenCV and build the
+matchers and WLS filter before it can do anything, which for a job that
+only has a handful of pairs can take longer than the pairs themselves.
+Instead, the service does all of that once, and then waits on a local Unix
+socket for batches of pairs to compute, eg. from the same job script or an
+interactive session,
+
+  python depth_map_service.py serve --socket $TMPDIR/depth.sock &
+  python depth_map_service.py run pairs_a.txt --socket $TMPDIR/depth.sock --wait 60
+  python depth_map_service.py run pairs_b.txt --socket $TMPDIR/depth.sock
+  python depth_map_service.py stop --socket $TMPDIR/depth.sock
+
+Disparity maps are saved as `disp.jpg` in each pair's directory, the same as
+`create_depth_map.py`, and the matcher params are given to `serve` using the
+same names. With `--workers` the service keeps a pool of processes warm,
+each with its own matchers.
+
+The client commands (`run`, `status` and `stop`) only use the standard
+library, and OpenCV is only imported by `serve`, so the client starts
+straight away. Requests are a single JSON line, and the service sends back a
+JSON line for each pair as it finishes followed by one saying the batch is
+done. Batches are worked through one at a time, in the order they arrive.
+
+The service exits after `--idle_timeout` seconds without a request, so one
+left running in the background won't hold onto a job's cores.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+
+def send_request(socket_path, request, wait=0):
+  """send a request to the service and read back what it sends
+
+  Args:
+    socket_path (str):
+      path to the service's socket
+    request (dict):
+      request to send
+    wait (float):
+      seconds to wait for the service to start listening, eg. if it was
+      only just started in the background
+
+  Returns:
+    generator of dicts for each line the service sends back
+
+  Raises:
+    IOError if the service isn't running
+  """
+  deadline = time.time() + wait
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  while True:
+    try:
+      client.connect(socket_path)
+      break
+    except (FileNotFoundError, ConnectionRefusedError):
+      if time.time() >= deadline:
+        client.close()
+        raise IOError('depth map service is not running: {}'.format(
+          socket_path))
+      time.sleep(0.1)
+  with client, client.makefile('rwb') as f:
+    f.write(json.dumps(request).encode() + b'\n')
+    f.flush()
+    for line in f:
+      yield json.loads(line)
+
+
+def serve(args):
+  """build the matchers once and then compute pairs sent to the socket
+
+  Returns:
+    NA
+
+  Raises:
+    IOError if another service is already listening on the socket
+  """
+  # only the service needs OpenCV, so it isn't imported for the client
+  import functools
+  import multiprocessing
+  import socketserver
+  import create_depth_map
+  import core_planner
+
+  if os.path.exists(args.socket):
+    try:
+      list(send_request(args.socket, {'command': 'status'}))
+    except IOError:
+      # left behind by a service that didn't exit cleanly
+      os.remove(args.socket)
+    else:
+      raise IOError('depth map service already running: {}'.format(
+        args.socket))
+  create_depth_map.check_matcher_args(args)
+  allowance = core_planner.cpu_allowance()
+  core_plan = core_planner.plan_cores(args.workers, args.cv_threads,
+                                      args.pin_cpus, allowance)
+  print(core_planner.describe_plan(core_plan, allowance))
+  init_kwargs = {'engine': args.engine,
+                 'pyramid_levels': args.pyramid_levels,
+                 'pyramid_band': args.pyramid_band,
+                 'max_memory_mb': args.max_memory_mb,
+                 'tile_threads': args.tile_threads,
+                 'gate_threshold': args.gate_threshold,
+                 'grayscale': args.grayscale,
+                 'stage_timings': args.stage_timings,
+                 'im_height': args.im_height, 'im_width': args.im_width,
+                 'cv_threads': core_plan.cv_threads,
+                 'cpu_sets': core_plan.cpu_sets}
+  init_args = (args.max_disparity, args.block_size, args.p1, args.p2,
+               args.lmbda, args.sigma)
+  process_fn = functools.partial(create_depth_map.process_image_pair,
+                                 im_height=args.im_height,
+                                 im_width=args.im_width)
+  pool = None
+  if args.workers > 1:
+    pool = multiprocessing.Pool(
+      args.workers, initializer=functools.partial(
+        create_depth_map.init_worker, **init_kwargs),
+      initargs=init_args)
+  else:
+    create_depth_map.init_worker(*init_args, **init_kwargs)
+  params = {'im_height': args.im_height, 'im_width': args.im_width,
+            'max_disparity': args.max_disparity,
+            'block_size': args.block_size, 'p1': args.p1, 'p2': args.p2,
+            'lmbda': args.lmbda, 'sigma': args.sigma, 'engine': args.engine,
+            'grayscale': args.grayscale, 'workers': args.workers}
+  status = {'pid': os.getpid(), 'host': socket.gethostname(),
+            'start_time': time.time(), 'batches': 0, 'pairs': 0,
+            'failed': 0, 'params': params}
+  state = {'stopping': False, 'last_active': time.time()}
+
+  class Handler(socketserver.StreamRequestHandler):
+    """handles a single request from a client"""
+
+    def send(self, reply):
+      self.wfile.write(json.dumps(reply).encode() + b'\n')
+      self.wfile.flush()
+
+    def handle(self):
+      try:
+        self.handle_request()
+      finally:
+        state['last_active'] = time.time()
+
+    def handle_request(self):
+      try:
+        request = json.loads(self.rfile.readline())
+      except ValueError:
+        self.send({'error': 'request is not valid JSON'})
+        return
+      command = request.get('command')
+      if command == 'status':
+        self.send(dict(status, uptime=time.time() - status['start_time']))
+      elif command == 'stop':
+        state['stopping'] = True
+        self.send({'stopping': True})
+      elif command == 'run':
+        start = time.time()
+        pairs = request.get('pairs', [])
+        if pool is not None:
+          results = pool.imap_unordered(process_fn, pairs)
+        else:
+          results = map(process_fn, pairs)
+        failed = 0
+        for image_pair, error in results:
+          failed += error is not None
+          try:
+            self.send({'pair': image_pair, 'error': error})
+          except OSError:
+            # client has gone, keep going so the batch is still finished
+            pass
+        status['batches'] += 1
+        status['pairs'] += len(pairs)
+        status['failed'] += failed
+        try:
+          self.send({'done': True, 'pairs': len(pairs), 'failed': failed,
+                     'seconds': time.time() - start})
+        except OSError:
+          pass
+      else:
+        self.send({'error': 'unknown command: {}'.format(command)})
+
+  server = socketserver.UnixStreamServer(args.socket, Handler)
+  # wake up every so often to check if we have been idle for too long
+  server.timeout = min(args.idle_timeout, 10)
+  print('depth map service listening on {}'.format(args.socket))
+  sys.stdout.flush()
+  try:
+    while not state['stopping']:
+      if time.time() - state['last_active'] > args.idle_timeout:
+        print('no requests for {}s, stopping'.format(args.idle_timeout))
+        break
+      server.handle_request()
+  finally:
+    server.server_close()
+    os.remove(args.socket)
+    if pool is not None:
+      pool.close()
+      pool.join()
+    else:
+      create_depth_map.close_worker()
+  print('served {} batches, {} pairs, {} failed'.format(
+    status['batches'], status['pairs'], status['failed']))
+
+
+def run(args):
+  """send a list of pairs to the service and wait for them to finish
+
+  Returns:
+    number of pairs that failed
+  """
+  with open(args.image_path_list) as f:
+    # the service doesn't run from our directory
+    pairs = [os.path.abspath(x.strip()) for x in f if x.strip()]
+  failed = 0
+  count = 0
+  for reply in send_request(args.socket, {'command': 'run', 'pairs': pairs},
+                            args.wait):
+    if 'error' in reply and 'pair' not in reply:
+      raise ValueError(reply['error'])
+    if reply.get('done'):
+      print('{} pairs in {:.2f}s, {} failed'.format(
+        reply['pairs'], reply['seconds'], reply['failed']))
+      continue
+    count += 1
+    if reply['error'] is None:
+      print('{}/{} done: {}'.format(count, len(pairs), reply['pair']))
+    else:
+      failed += 1
+      print('{}/{} failed: {}\n{}'.format(count, len(pairs), reply['pair'],
+                                          reply['error']), file=sys.stderr)
+  return failed
+
+
+def main(args):
+  """run the service, or send it a request"""
+  if args.command == 'serve':
+    serve(args)
+    return 0
+  if args.command == 'run':
+    return 1 if run(args) else 0
+  for reply in send_request(args.socket, {'command': args.command},
+                            args.wait):
+    print(json.dumps(reply, indent=2, sort_keys=True))
+  return 0
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='depth_map_service',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  serve_parser = subparsers.add_parser('serve', help='run the service')
+  run_parser = subparsers.add_parser(
+    'run', help='compute the pairs in a list and wait for them')
+  run_parser.add_argument('image_path_list', type=str,
+                          help='text file with path to images')
+  status_parser = subparsers.add_parser('status',
+                                        help='print what the service is up to')
+  stop_parser = subparsers.add_parser('stop', help='stop the service')
+  for sub_parser in [serve_parser, run_parser, status_parser, stop_parser]:
+    sub_parser.add_argument('--socket', type=str, default='depth_map.sock',
+                            help='path to the socket for the service')
+  for sub_parser in [run_parser, status_parser, stop_parser]:
+    sub_parser.add_argument('--wait', type=float, default=0,
+                            help='seconds to wait for the service to start')
+  serve_parser.add_argument('--im_height', type=int, default=1080,
+                            help='height of image to be reshaped to')
+  serve_parser.add_argument('--im_width', type=int, default=1920,
+                            help='width of image to be reshaped to')
+  serve_parser.add_argument('--max_disparity', type=int, default=160,
+                            help='maximum disparity for matcher to search to')
+  serve_parser.add_argument('--block_size', type=int, default=15,
+                            help='block size for disparity matcher')
+  serve_parser.add_argument('--p1', type=int, default=None,
+                            help='smoothness param')
+  serve_parser.add_argument('--p2', type=int, default=None,
+                            help='smoothness param')
+  serve_parser.add_argument('--lmbda', type=int, default=8000,
+                            help='parameter for regularisation when postprocessing')
+  serve_parser.add_argument('--sigma', type=float, default=1.2,
+                            help='sensitivity parameter for postprocessing')
+  serve_parser.add_argument('--engine', type=str, default='sgbm',
+                            choices=['sgbm', 'pyramid', 'tiled', 'gated'],
+                            help='full range sgbm, coarse-to-fine pyramid, tiled, or gated to only refine where needed')
+  serve_parser.add_argument('--pyramid_levels', type=int, default=2,
+                            help='number of times to halve resolution for pyramid engine')
+  serve_parser.add_argument('--pyramid_band', type=int, default=4,
+                            help='pixels either side of coarse estimate to search in pyramid engine')
+  serve_parser.add_argument('--max_memory_mb', type=int, default=512,
+                            help='memory budget in MB for matching in tiled engine')
+  serve_parser.add_argument('--tile_threads', type=int, default=1,
+                            help='number of strips to match at once in tiled engine')
+  serve_parser.add_argument('--gate_threshold', type=float, default=0.02,
+                            help='fraction of low confidence pixels in a strip above which it is refined in gated engine')
+  serve_parser.add_argument('--grayscale', action='store_true',
+                            help='decode images to grayscale and match on a single channel')
+  serve_parser.add_argument('--workers', type=int, default=1,
+                            help='number of processes to keep warm')
+  serve_parser.add_argument('--cv_threads', type=int, default=None,
+                            help='OpenCV threads for each worker, default shares out the cores')
+  serve_parser.add_argument('--pin_cpus', action='store_true',
+                            help='pin each worker to its own cores')
+  serve_parser.add_argument('--idle_timeout', type=float, default=600,
+                            help='seconds without a request before the service exits')
+  serve_parser.add_argument('--stage_timings', action='store_true',
+                            help='print a JSON line of stage timings for each pair')
+  args = parser.parse_args(sys.argv[1:])
+  if (args.command == 'serve'):
+    for name in ['workers', 'pyramid_levels', 'pyramid_band',
+                 'max_memory_mb', 'tile_threads']:
+      if getattr(args, name) < 1:
+        raise ValueError('Invalid value for {}, must be >= 1: {}'.format(
+          name, getattr(args, name)))
+    if (args.cv_threads is not None) and (args.cv_threads < 1):
+      raise ValueError('Invalid value for cv_threads, must be >= 1: {}'.format(
+        args.cv_threads))
+    if not (0.0 <= args.gate_threshold <= 1.0):
+      raise ValueError(
+        'Invalid value for gate_threshold, must be between 0 and 1: {}'.format(
+          args.gate_threshold))
+    if (args.idle_timeout <= 0):
+      raise ValueError('Invalid value for idle_timeout, must be > 0: {}'.format(
+        args.idle_timeout))
+  if (args.command == 'run') and (not os.path.isfile(args.image_path_list)):
+    raise IOError('Value for image paths does not exist: {}'.format(
+      args.image_path_list))
+  sys.exit(main(args))
@@ -0,0 +1,445 @@
+"""disparity_store.py
+
+Lossless store for the raw disparity maps from `create_depth_map.py`.
+
+Saving disparity maps as `disp.jpg` casts the filtered disparity to uint8
+and then JPEG compresses it, so we lose the 16x fixed point precision from
+the matcher and pay for a JPEG encode on every pair. This store keeps the
+disparity as either
+  int16: the raw 16x fixed point values from the WLS filter
+  float16: disparity in pixels
+
+Each disparity map is split into chunks of rows, and each chunk is
+compressed on its own, so reading a few rows only decompresses the chunks
+they are in. Before compressing, the high and low bytes of each value are
+split apart (a byte shuffle), which compresses a lot better than the raw
+values. Chunks are compressed with zlib at its fastest level by default,
+or with zstd if the `zstandard` package is installed, which is usually
+quicker for about the same size. With `codec='none'` chunks are stored as is, and
+reads are just a view onto the memory mapped shard with no copy at all.
+
+The layout follows `pack_dataset.py`,
+└── store_dir
+    ├── <prefix>_index.tsv
+    ├── <prefix>_00000.bin
+    └── ...
+
+where each process writes its own shards and index (named with the host and
+process id by default). Each line of the index is
+`<key>\t<shard>\t<offset>\t<height>\t<width>\t<dtype>\t<codec>\t<chunk rows>\t<chunk lengths>`
+where chunk lengths is a comma separated list of the compressed size of each
+chunk, which are stored one after the other from offset.
+
+Writes are batched, so a few pairs are written to the shard and added to
+the index in one go. An entry only shows up in the index once its data has
+been written, so if a job dies it just won't be there (and a rerun with
+`--manifest` will do it again).
+
+Reading, eg.
+
+  store = DisparityStore('/path/to/store')
+  disp = store.read('-LZzVudZ9Opy4fS11OBT')
+  top_rows = store.read('-LZzVudZ9Opy4fS11OBT', rows=slice(0, 100))
+  disp_pixels = store.read_pixels('-LZzVudZ9Opy4fS11OBT')
+"""
+import numpy as np
+import argparse
+import mmap
+import os
+import socket
+import sys
+import threading
+import zlib
+from glob import glob
+
+import cv2
+
+# zstd is quicker than zlib, but isn't always installed on the cluster
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+
+# how each dtype is stored, and what a value of 1 means in pixels
+DTYPES = {'int16': (np.int16, 1.0 / 16.0),
+          'float16': (np.float16, 1.0)}
+CODECS = ['zlib', 'zstd', 'none']
+
+
+def convert_disparity(filtered_disp, dtype):
+  """convert filtered disparity from the WLS filter to the stored dtype
+
+  Args:
+    filtered_disp (array):
+      filtered disparity in 16x fixed point
+    dtype (str):
+      `int16` to keep the fixed point values, or `float16` for pixels
+
+  Returns:
+    array to store
+  """
+  if dtype == 'int16':
+    return np.asarray(filtered_disp, dtype=np.int16)
+  return (filtered_disp.astype(np.float32) / 16.0).astype(np.float16)
+
+
+def encode_chunk(chunk, codec, level):
+  """encode a chunk of rows
+
+  Returns:
+    bytes to store
+  """
+  if codec == 'none':
+    return np.ascontiguousarray(chunk).tobytes()
+  # shuffle so all the high bytes are together and all the low bytes are
+  # together, then compress
+  shuffled = np.ascontiguousarray(chunk).view(np.uint8).reshape(
+    -1, chunk.dtype.itemsize).T
+  shuffled = np.ascontiguousarray(shuffled).tobytes()
+  if codec == 'zstd':
+    return zstandard.ZstdCompressor(level=level).compress(shuffled)
+  return zlib.compress(shuffled, level)
+
+
+def decode_chunk(data, codec, dtype, rows, width):
+  """decode a chunk of rows from `encode_chunk`
+
+  Returns:
+    array of shape (rows, width). For `codec='none'` this is a read only
+    view onto `data`
+  """
+  if codec == 'none':
+    return np.frombuffer(data, dtype=dtype).reshape(rows, width)
+  itemsize = np.dtype(dtype).itemsize
+  if codec == 'zstd':
+    data = zstandard.ZstdDecompressor().decompress(data)
+  else:
+    data = zlib.decompress(data)
+  shuffled = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1)
+  return np.ascontiguousarray(shuffled.T).view(dtype).reshape(rows, width)
+
+
+class DisparityStoreWriter(object):
+  """append disparity maps to a store, a batch at a time
+
+  Chunks are compressed in whatever thread calls `append`, so compression
+  is spread across the writer threads, and only writing the batch out is
+  done under the lock. Is safe to use from multiple threads.
+  """
+
+  def __init__(self, store_dir, dtype='int16', codec='zlib', level=1,
+               chunk_rows=64, batch_size=16, prefix=None, shard_size_mb=1024):
+    """start a new set of shards in a store
+
+    Args:
+      store_dir (str):
+        directory with the shards and index files, is created if it doesn't
+        exist
+      dtype (str):
+        `int16` or `float16`, refer to `convert_disparity`
+      codec (str):
+        `zlib`, `zstd` or `none`
+      level (int):
+        compression level, 1 is the fastest
+      chunk_rows (int):
+        number of rows in each chunk
+      batch_size (int):
+        number of disparity maps to buffer before writing them out
+      prefix (str):
+        prefix for the shard and index files. If None, will use one based on
+        the host and process id, so multiple jobs can add to the same store
+      shard_size_mb (int):
+        start a new shard once the current one gets bigger than this
+
+    Raises:
+      ValueError if the dtype or codec isn't valid
+      ImportError if asking for zstd and it isn't installed
+    """
+    if dtype not in DTYPES:
+      raise ValueError('Invalid dtype for disparity store: {}'.format(dtype))
+    if codec not in CODECS:
+      raise ValueError('Invalid codec for disparity store: {}'.format(codec))
+    if (codec == 'zstd') and (zstandard is None):
+      raise ImportError('zstd codec needs the zstandard package installed')
+    if prefix is None:
+      prefix = 'disp_{}_{}'.format(socket.gethostname(), os.getpid())
+    if not os.path.isdir(store_dir):
+      os.makedirs(store_dir, exist_ok=True)
+    self.store_dir = store_dir
+    self.dtype = dtype
+    self.codec = codec
+    self.level = level
+    self.chunk_rows = chunk_rows
+    self.batch_size = batch_size
+    self.prefix = prefix
+    self.shard_size = shard_size_mb * 1024 * 1024
+    self._lock = threading.Lock()
+    self._batch = []
+    self._shard_count = 0
+    self._shard = None
+    self._shard_name = None
+    self._index = open(os.path.join(store_dir, '{}_index.tsv'.format(prefix)),
+                       'a')
+
+  def append(self, key, filtered_disp):
+    """add a disparity map to the store
+
+    Args:
+      key (str):
+        image key
+      filtered_disp (array):
+        filtered disparity from the WLS filter, in 16x fixed point
+
+    Returns:
+      NA
+    """
+    disp = convert_disparity(filtered_disp, self.dtype)
+    height, width = disp.shape
+    chunks = [encode_chunk(disp[y:y + self.chunk_rows], self.codec,
+                           self.level)
+              for y in range(0, height, self.chunk_rows)]
+    with self._lock:
+      self._batch.append((key, height, width, chunks))
+      if len(self._batch) >= self.batch_size:
+        self._write_batch()
+
+  def _write_batch(self):
+    """write out all the buffered disparity maps, needs the lock held"""
+    if not self._batch:
+      return
+    if (self._shard is None) or (self._shard.tell() > self.shard_size):
+      self._next_shard()
+    lines = []
+    offset = self._shard.tell()
+    for key, height, width, chunks in self._batch:
+      lengths = [len(x) for x in chunks]
+      lines.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+        key, self._shard_name, offset, height, width, self.dtype, self.codec,
+        self.chunk_rows, ','.join(str(x) for x in lengths)))
+      offset += sum(lengths)
+    self._shard.write(b''.join(x for entry in self._batch for x in entry[3]))
+    self._shard.flush()
+    # index only once the data is there
+    self._index.write(''.join(lines))
+    self._index.flush()
+    self._batch = []
+
+  def flush(self):
+    """write out any buffered disparity maps"""
+    with self._lock:
+      self._write_batch()
+
+  def _next_shard(self):
+    """close the current shard and start a new one"""
+    if self._shard is not None:
+      self._shard.close()
+    # don't want to clobber shards left over from an earlier run with the
+    # same prefix
+    while True:
+      self._shard_name = '{}_{:0>5d}.bin'.format(self.prefix, self._shard_count)
+      self._shard_count += 1
+      if not os.path.exists(os.path.join(self.store_dir, self._shard_name)):
+        break
+    self._shard = open(os.path.join(self.store_dir, self._shard_name), 'wb')
+
+  def close(self):
+    """write out anything buffered and close the shard and index"""
+    with self._lock:
+      self._write_batch()
+      if self._shard is not None:
+        self._shard.close()
+        self._shard = None
+      self._index.close()
+
+
+class DisparityStore(object):
+  """read only view of a disparity store
+
+  Shards are memory mapped the first time they are needed, so only the
+  pages for the rows we actually read get pulled in.
+  """
+
+  def __init__(self, store_dir):
+    """load the index for the store
+
+    Args:
+      store_dir (str):
+        directory with the shards and index files
+
+    Raises:
+      IOError if there are no index files in the directory
+    """
+    self.store_dir = store_dir
+    self.index = {}
+    self._maps = {}
+    self._lock = threading.Lock()
+    index_paths = sorted(glob(os.path.join(store_dir, '*_index.tsv')))
+    if not index_paths:
+      raise IOError('no index files found in store: {}'.format(store_dir))
+    for index_path in index_paths:
+      self.index.update(read_index(index_path))
+
+  def keys(self):
+    """list of all keys in the store, in sorted order"""
+    return sorted(self.index)
+
+  def has(self, key):
+    """whether the store has a disparity map for this key"""
+    return key in self.index
+
+  def shape(self, key):
+    """(height, width) of the disparity map for a key"""
+    return self.index[key]['height'], self.index[key]['width']
+
+  def read(self, key, rows=None):
+    """read a disparity map, or some of its rows
+
+    Args:
+      key (str):
+        image key
+      rows (slice):
+        rows to read, eg. `slice(100, 200)`. If None, reads them all. Only
+        the chunks these rows are in are decoded
+
+    Returns:
+      array of the stored dtype. For `codec='none'` this is a read only view
+      onto the memory mapped shard
+
+    Raises:
+      KeyError if the key isn't in the store
+    """
+    entry = self.index[key]
+    height, width = entry['height'], entry['width']
+    dtype = DTYPES[entry['dtype']][0]
+    row_range = range(*(rows or slice(None)).indices(height))
+    if not row_range:
+      return np.empty((0, width), dtype=dtype)
+    if row_range.step != 1:
+      # read the rows it spans, then pick out the ones asked for
+      first, last = min(row_range), max(row_range)
+      disp = self.read(key, slice(first, last + 1))
+      return disp[row_range.start - first::row_range.step][:len(row_range)]
+    start, stop = row_range.start, row_range.stop
+    chunk_rows = entry['chunk_rows']
+    shard_map = self._map(entry['shard'])
+    if entry['codec'] == 'none':
+      # no need to go chunk by chunk, is all one array in the shard
+      disp = np.frombuffer(shard_map, dtype=dtype, count=height * width,
+                           offset=entry['offset']).reshape(height, width)
+      return disp[start:stop]
+    first_chunk = start // chunk_rows
+    last_chunk = max(first_chunk, (stop - 1) // chunk_rows)
+    pieces = []
+    for i in range(first_chunk, last_chunk + 1):
+      chunk_offset, length = entry['chunks'][i]
+      num_rows = min(chunk_rows, height - i * chunk_rows)
+      pieces.append(decode_chunk(shard_map[chunk_offset:chunk_offset + length],
+                                 entry['codec'], dtype, num_rows, width))
+    disp = np.concatenate(pieces) if len(pieces) > 1 else pieces[0]
+    offset = first_chunk * chunk_rows
+    return disp[start - offset:stop - offset]
+
+  def read_pixels(self, key, rows=None):
+    """read a disparity map as float32 disparity in pixels"""
+    entry = self.index[key]
+    disp = self.read(key, rows).astype(np.float32)
+    disp *= DTYPES[entry['dtype']][1]
+    return disp
+
+  def _map(self, shard):
+    """memory map a shard, or get the one we already have"""
+    with self._lock:
+      if shard not in self._maps:
+        with open(os.path.join(self.store_dir, shard), 'rb') as f:
+          self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      return self._maps[shard]
+
+  def close(self):
+    """close all the memory mapped shards"""
+    with self._lock:
+      for shard_map in self._maps.values():
+        shard_map.close()
+      self._maps = {}
+
+
+def read_index(index_path):
+  """read an index file for a store
+
+  Args:
+    index_path (str):
+      path to the index file
+
+  Returns:
+    dict mapping key to a dict with the shard, offset, shape, dtype, codec,
+    chunk rows and the (offset, length) of each chunk
+  """
+  index = {}
+  with open(index_path) as f:
+    for line in f:
+      fields = line.rstrip('\n').split('\t')
+      # a line that was only partly written when a job died, skip it
+      if len(fields) != 9:
+        continue
+      key, shard, offset, height, width, dtype, codec, chunk_rows, lengths = (
+        fields)
+      chunks = []
+      chunk_offset = int(offset)
+      for length in lengths.split(','):
+        chunks.append((chunk_offset, int(length)))
+        chunk_offset += int(length)
+      index[key] = {'shard': shard, 'offset': int(offset),
+                    'height': int(height), 'width': int(width),
+                    'dtype': dtype, 'codec': codec,
+                    'chunk_rows': int(chunk_rows), 'chunks': chunks}
+  return index
+
+
+def main(args):
+  """list the keys in a store, or export a preview of a disparity map"""
+  store = DisparityStore(args.store_dir)
+  if args.command == 'list':
+    for key in store.keys():
+      height, width = store.shape(key)
+      print('{}\t{}x{}\t{}\t{}'.format(key, height, width,
+                                       store.index[key]['dtype'],
+                                       store.index[key]['codec']))
+  elif args.command == 'preview':
+    # scale to the full range of a uint8 image so it is easy to look at
+    disp = store.read_pixels(args.key)
+    disp = np.clip(disp, 0, None)
+    disp = np.uint8(255.0 * disp / max(float(disp.max()), 1e-6))
+    if not cv2.imwrite(args.out_path, disp):
+      raise IOError('unable to write preview: {}'.format(args.out_path))
+
+
+if __name__ == '__main__':
+  """Loading in command line arguments.
+
+  Has two commands,
+    list: print the keys in a store with their shape, dtype and codec
+    preview: save a disparity map from the store as an image
+
+  Keys start with a hyphen, so put a `--` before them so they aren't read
+  as options, eg.
+    python disparity_store.py preview store_dir -- -LZzVudZ9Opy4fS11OBT disp.png
+  """
+  parser = argparse.ArgumentParser(prog='disparity_store',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  list_parser = subparsers.add_parser('list', help='list keys in a store')
+  list_parser.add_argument('store_dir', type=str,
+                           help='directory with the store')
+  preview_parser = subparsers.add_parser('preview',
+                                         help='save a disparity map as an image')
+  preview_parser.add_argument('store_dir', type=str,
+                              help='directory with the store')
+  preview_parser.add_argument('key', type=str,
+                              help='key of the disparity map')
+  preview_parser.add_argument('out_path', type=str,
+                              help='path to save the image to, eg. disp.png')
+  args = parser.parse_args(sys.argv[1:])
+  main(args)
@@ -0,0 +1,252 @@
+"""image_cache.py
+
+On disk cache of images that have already been decoded and resized.
+
+When sweeping over matcher or filter params we end up decoding the same
+JPEGs and resizing them to the same size over and over. Instead, the first
+time an image is loaded the resized array is saved as a `.npy` file, and
+every run after that just memory maps it.
+
+Each entry is keyed by the absolute path of the source image, its
+modification time and size, and the size it was resized to, so if the
+source changes or we ask for a different size (or for grayscale rather than
+colour, or for a reduced scale decode rather than a full one) we get a new
+entry. The cache has a size limit, and once it goes
+over, the least recently used entries are thrown away. Each time an entry
+is used its modification time is updated, so that is what we use to tell
+how recently it was used.
+
+Is fine to have multiple processes (or multiple jobs) using the same cache,
+entries are written to a temp file and then renamed into place.
+
+Reading from a cache on local SSD is a lot quicker than from the shared
+filesystem. `stage` will copy a cache from one place to another, so can be
+used in the `copy_in` hook of a job script to pull a cache onto local disk,
+and in `run_clean` (which runs after the program, unlike `copy_out`) to push
+new entries back, eg.
+
+  copy_in(){
+      python image_cache.py stage /work/<user>/image_cache $TMPDIR/image_cache
+  }
+  run_clean(){
+      python image_cache.py stage $TMPDIR/image_cache /work/<user>/image_cache
+  }
+
+and then pass `--cache_dir $TMPDIR/image_cache` to `create_depth_map.py`.
+"""
+import numpy as np
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+
+class ImageCache(object):
+  """size limited LRU cache of resized images stored as `.npy` files"""
+
+  def __init__(self, cache_dir, max_size_mb):
+    """open a cache, creating the directory if needed
+
+    Args:
+      cache_dir (str):
+        directory holding the cache entries
+      max_size_mb (int):
+        once the cache gets bigger than this, least recently used entries
+        are removed
+    """
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir, exist_ok=True)
+    self.cache_dir = cache_dir
+    self.max_size = max_size_mb * 1024 * 1024
+    self._lock = threading.Lock()
+    # only a running total for this process, other processes may be adding
+    # entries as well so is recounted properly whenever we evict
+    self._size = sum(size for _, size, _ in self._entries())
+
+  def get(self, image_path, im_height, im_width, load_fn, grayscale=False,
+          reduced=False):
+    """get a resized image from the cache, or load it and add it
+
+    Args:
+      image_path (str):
+        path to the source image
+      im_height (int):
+        height the image is resized to
+      im_width (int):
+        width the image is resized to
+      load_fn (callable):
+        called as `load_fn(image_path, im_height, im_width)` to load and
+        resize the image if it isn't in the cache
+      grayscale (bool):
+        whether `load_fn` decodes to grayscale, so it gets its own entry
+      reduced (bool):
+        whether `load_fn` decodes at a reduced scale, which gives slightly
+        different pixels to a full decode, so it gets its own entry
+
+    Returns:
+      resized image. If it came from the cache it is a read only memory
+      mapped array
+
+    Raises:
+      OSError if the source image doesn't exist
+    """
+    entry_path = self.entry_path(image_path, im_height, im_width, grayscale,
+                                 reduced)
+    try:
+      image = np.load(entry_path, mmap_mode='r')
+      # mark it as recently used
+      os.utime(entry_path, None)
+      return image
+    except (IOError, OSError, ValueError):
+      # not in the cache, or removed by someone else while we were
+      # opening it, either way load it again
+      pass
+    image = load_fn(image_path, im_height, im_width)
+    self._put(entry_path, image)
+    return image
+
+  def entry_path(self, image_path, im_height, im_width, grayscale=False,
+                 reduced=False):
+    """path of the cache entry for an image
+
+    Raises:
+      OSError if the source image doesn't exist
+    """
+    image_path = os.path.abspath(image_path)
+    stat = os.stat(image_path)
+    key = '{}|{}|{}|{}x{}'.format(image_path, stat.st_mtime_ns, stat.st_size,
+                                  im_height, im_width)
+    if grayscale:
+      # colour entries keep the key they always had
+      key += '|gray'
+    if reduced:
+      # same again, entries from full decodes keep the key they always had
+      key += '|reduced'
+    return os.path.join(self.cache_dir, '{}.npy'.format(
+      hashlib.sha1(key.encode()).hexdigest()))
+
+  def _put(self, entry_path, image):
+    """save an entry, then evict old ones if we are over the limit"""
+    # write to a temp file in the same directory and rename it into place,
+    # so nobody ever sees a half written entry
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        np.save(f, np.ascontiguousarray(image))
+      os.replace(tmp_path, entry_path)
+    except BaseException:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
+    with self._lock:
+      self._size += os.path.getsize(entry_path)
+      if self._size > self.max_size:
+        self._evict()
+
+  def _entries(self):
+    """list of (path, size, last used time) for every entry in the cache"""
+    entries = []
+    for entry in os.scandir(self.cache_dir):
+      if not entry.name.endswith('.npy'):
+        continue
+      try:
+        stat = entry.stat()
+      except OSError:
+        # removed by another process
+        continue
+      entries.append((entry.path, stat.st_size, stat.st_mtime))
+    return entries
+
+  def _evict(self):
+    """remove least recently used entries until we are under the limit"""
+    entries = sorted(self._entries(), key=lambda x: x[2])
+    self._size = sum(size for _, size, _ in entries)
+    for entry_path, size, _ in entries:
+      if self._size <= self.max_size:
+        break
+      try:
+        os.remove(entry_path)
+      except OSError:
+        pass
+      self._size -= size
+
+
+def stage_cache(src_dir, dst_dir):
+  """copy cache entries from one directory to another
+
+  Only copies entries that aren't already in the destination, so is cheap
+  to run again. Modification times are kept so the LRU order carries over.
+
+  Args:
+    src_dir (str):
+      cache to copy from. If it doesn't exist, nothing is copied
+    dst_dir (str):
+      cache to copy to, is created if it doesn't exist
+
+  Returns:
+    number of entries copied
+  """
+  if not os.path.isdir(dst_dir):
+    os.makedirs(dst_dir, exist_ok=True)
+  if not os.path.isdir(src_dir):
+    return 0
+  num_copied = 0
+  for entry in os.scandir(src_dir):
+    if not entry.name.endswith('.npy'):
+      continue
+    dst_path = os.path.join(dst_dir, entry.name)
+    if os.path.exists(dst_path):
+      continue
+    # copy to a temp name then rename, same as when adding entries. The
+    # name is per process, as several jobs can stage to a shared cache at once
+    tmp_path = '{}.{}.tmp'.format(dst_path, os.getpid())
+    try:
+      shutil.copy2(entry.path, tmp_path)
+      os.replace(tmp_path, dst_path)
+    except BaseException:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
+    num_copied += 1
+  return num_copied
+
+
+def main(args):
+  """stage a cache somewhere else, or print info about a cache"""
+  if args.command == 'stage':
+    num_copied = stage_cache(args.src_dir, args.dst_dir)
+    print('copied {} cache entries to {}'.format(num_copied, args.dst_dir))
+  elif args.command == 'info':
+    cache = ImageCache(args.cache_dir, 0)
+    entries = cache._entries()
+    print('entries: {}'.format(len(entries)))
+    print('size:    {:.1f}MB'.format(
+      sum(size for _, size, _ in entries) / 1024.0**2))
+
+
+if __name__ == '__main__':
+  """Loading in command line arguments.
+
+  Has two commands,
+    stage: copy a cache to somewhere else (eg. local SSD)
+    info: print how many entries are in a cache and how big it is
+  """
+  parser = argparse.ArgumentParser(prog='image_cache',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  stage_parser = subparsers.add_parser('stage', help='copy a cache')
+  stage_parser.add_argument('src_dir', type=str,
+                            help='cache directory to copy from')
+  stage_parser.add_argument('dst_dir', type=str,
+                            help='cache directory to copy to')
+  info_parser = subparsers.add_parser('info', help='info about a cache')
+  info_parser.add_argument('cache_dir', type=str,
+                           help='cache directory')
+  args = parser.parse_args(sys.argv[1:])
+  main(args)
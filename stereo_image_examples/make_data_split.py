@@ -3,18 +3,62 @@
 Makes a random split of data from the Holopix50 [1] dataset
 so we can run some small demos on it.
 
+Keys are never all loaded into memory. The `left` directory is streamed,
+and as each key goes past we check it has both a left and right image.
+Which split a key goes in is decided from a hash of the key, so is the same
+every time it is run, and when new data lands the keys that were already
+there stay in the same split. Splits are given as names and fractions, eg.
+
+  --splits train:0.8 val:0.1 test:0.1 --shards 4
+
+writes `train_00.txt` ... `test_03.txt` with the keys for each split and
+shard. Fractions don't need to add up to one, any keys left over aren't put
+in a split. The small sample for demos (`--num_samples`) is the keys with
+the smallest hashes, so is also the same every run.
+
+The source can also be a tar or zip of the data, which is read without
+extracting it, refer to `archive_dataset.py`. The split files then have
+`<archive>::<image_key>` for each pair so can be given straight to
+`create_depth_map.py`, and only the pairs in the sample are extracted.
+
 # REFERENCES:
 [1] Hua, Yiwen, et al. "Holopix50k: A Large-Scale In-the-wild Stereo
     Image Dataset." arXiv preprint arXiv:2003.11172 (2020).
 """
 import os
-from glob import glob
 import argparse
-import random
+import collections
+import hashlib
+import heapq
+import itertools
 import sys
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
-def find_image_keys(source_dir):
+import archive_dataset
+
+
+# a single file to stage, where action is one of
+#   skip: already at the destination and matches the source
+#   link: hardlink the source into place
+#   copy: copy the source into place
+StageTask = collections.namedtuple('StageTask', ['src', 'dst', 'action', 'size'])
+
+
+def check_source_dir(source_dir):
+  """check the source directory is valid
+
+  if it is valid, it should have two subdirectories named `left` and `right`
+
+  Raises:
+    IOError if the source directory is not valid
+  """
+  if not (os.path.isdir(os.path.join(source_dir, 'left')) and
+          os.path.isdir(os.path.join(source_dir, 'right'))):
+    raise IOError('invalid source directory supplied: {}'.format(source_dir))
+
+
+def iter_image_keys(source_dir):
   """Extract all the image keys from the filenames.
 
   Each image is stored as
@@ -29,36 +73,423 @@ def find_image_keys(source_dir):
   I just want to extract the image keys from here, as there
   should be an left and right image for each key.
 
+  The directory is only read the once with `os.scandir`, and only the names
+  are used so nothing is stat'd, which matters with tens of thousands of
+  files on the shared filesystem.
+
+  If the source is an archive, the keys come from its index instead, in the
+  order they are stored in the archive.
+
   Args:
     source_dir (str):
-      source directory with all the data
+      source directory with all the data, or an archive of it
   
   Returns:
-    list of all image keys
+    generator of image keys, in whatever order the directory lists them
 
   Raises:
     IOError if the source directory is not valid
   """
-  # check the source directory is valid
-  # if it is valid, it should have two subdirectories named
-  # `left` and `right`
-  sub_dirs = os.listdir(source_dir)
-  if ('left' not in sub_dirs) or ('right' not in sub_dirs):
-    raise IOError('invalid source directory supplied: {}'.format(source_dir))
+  if os.path.isfile(source_dir):
+    archive = archive_dataset.open_archive(source_dir)
+    for key, name in sorted(archive.index, key=archive.index.get):
+      if name == 'left':
+        yield key
+    return
+  check_source_dir(source_dir)
   # now lets find the image keys
   # they are the same across both left and right directories, so lets just
   # choose one
-  abs_image_paths = glob('{}'.format(os.path.join(source_dir, 'left', '*.jpg')))
-  # now lets get just the image key by getting rid of the absolute path info,
-  # and then stripping the `left` suffix and file
+  # now lets get just the image key by stripping the `left` suffix and file
   # extension and throw them away.
   # can do this by just getting rid of the last nine characters which
   # containt "_left.jpg"
-  image_keys = [os.path.basename(x)[0:-9] for x in abs_image_paths]
-  return image_keys
+  with os.scandir(os.path.join(source_dir, 'left')) as entries:
+    for entry in entries:
+      if entry.name.endswith('_left.jpg'):
+        yield entry.name[0:-9]
+
+
+def find_image_keys(source_dir):
+  """list of all image keys, refer to `iter_image_keys`"""
+  return list(iter_image_keys(source_dir))
+
+
+def check_image_pair(source_dir, image_key):
+  """check a key has both its left and right image
+
+  Returns:
+    None if the pair is fine, otherwise a string with what is wrong
+  """
+  for orientation in ['left', 'right']:
+    try:
+      if os.path.isfile(source_dir):
+        size = archive_dataset.open_archive(source_dir).index[
+          (image_key, orientation)][1]
+      else:
+        size = os.stat(source_path(source_dir, image_key, orientation)).st_size
+    except (KeyError, OSError):
+      return 'missing {} image'.format(orientation)
+    if size == 0:
+      return 'empty {} image'.format(orientation)
+  return None
+
+
+def iter_valid_keys(source_dir, invalid_fn, threads=16, batch_size=1024):
+  """stream the image keys that have both a left and right image
+
+  Keys are checked a batch at a time across a pool of threads, so only a
+  batch is ever held in memory.
+
+  Args:
+    source_dir (str):
+      source directory with all the data
+    invalid_fn (callable):
+      called as `invalid_fn(image_key, reason)` for each key that is missing
+      an image
+    threads (int):
+      number of threads to check keys with
+    batch_size (int):
+      number of keys to check at a time
+
+  Returns:
+    generator of valid image keys
+  """
+  image_keys = iter_image_keys(source_dir)
+  with ThreadPoolExecutor(threads) as executor:
+    while True:
+      batch = list(itertools.islice(image_keys, batch_size))
+      if not batch:
+        return
+      reasons = executor.map(lambda x: check_image_pair(source_dir, x), batch)
+      for image_key, reason in zip(batch, reasons):
+        if reason is None:
+          yield image_key
+        else:
+          invalid_fn(image_key, reason)
+
+
+def key_hash(image_key, salt):
+  """stable hash of a key
+
+  Returns:
+    tuple of (value in [0, 1) used to pick the split, int used to pick the
+    shard)
+  """
+  digest = hashlib.sha1('{}|{}'.format(salt, image_key).encode()).digest()
+  return (int.from_bytes(digest[:8], 'big') / 2.0**64,
+          int.from_bytes(digest[8:16], 'big'))
+
+
+def parse_splits(split_specs):
+  """parse splits given as `name:fraction`
+
+  Args:
+    split_specs (list(str)):
+      eg. ['train:0.8', 'val:0.1', 'test:0.1']
+
+  Returns:
+    list of (name, upper edge) where a key goes in the first split whose
+    upper edge is above its hash
+
+  Raises:
+    ValueError if any of the specs aren't valid, or the fractions add up to
+    more than one
+  """
+  splits = []
+  total = 0.0
+  for split_spec in split_specs:
+    try:
+      name, fraction = split_spec.rsplit(':', 1)
+      fraction = float(fraction)
+    except ValueError:
+      raise ValueError(
+        'Invalid split, must be name:fraction: {}'.format(split_spec))
+    if (not name) or (os.sep in name) or (fraction <= 0):
+      raise ValueError(
+        'Invalid split, need a name and fraction > 0: {}'.format(split_spec))
+    if name in [x[0] for x in splits]:
+      raise ValueError('Split given more than once: {}'.format(name))
+    total += fraction
+    splits.append((name, total))
+  if total > 1.0 + 1e-9:
+    raise ValueError(
+      'Split fractions add up to more than one: {}'.format(total))
+  return splits
+
+
+def assign_split(split_value, splits):
+  """name of the split for a key, or None if it isn't in any"""
+  for name, upper_edge in splits:
+    if split_value < upper_edge:
+      return name
+  return None
+
+
+class SplitWriter(object):
+  """writes keys out to a text file for each split and shard as they come"""
+
+  def __init__(self, split_dir, num_shards):
+    """
+    Args:
+      split_dir (str):
+        directory to write the split files to
+      num_shards (int):
+        number of shards for each split, if 1 the files are just
+        `<split>.txt`, otherwise `<split>_<shard>.txt`
+    """
+    if not os.path.isdir(split_dir):
+      os.makedirs(split_dir, exist_ok=True)
+    self.split_dir = split_dir
+    self.num_shards = num_shards
+    self.counts = collections.Counter()
+    self._files = {}
+
+  def split_path(self, name, shard):
+    """path to the file for a split and shard"""
+    if self.num_shards == 1:
+      return os.path.join(self.split_dir, '{}.txt'.format(name))
+    return os.path.join(self.split_dir, '{}_{:0>2d}.txt'.format(name, shard))
+
+  def write(self, name, shard_value, image_key):
+    """add a key to a split"""
+    shard = shard_value % self.num_shards
+    f = self._files.get((name, shard))
+    if f is None:
+      # written to a temp file and renamed on close, so an interrupted run
+      # doesn't leave half a split behind
+      f = open(self.split_path(name, shard) + '.tmp', 'w')
+      self._files[(name, shard)] = f
+    f.write(image_key + '\n')
+    self.counts[name] += 1
+
+  def close(self):
+    """finish writing all the split files"""
+    for (name, shard), f in self._files.items():
+      f.close()
+      os.replace(f.name, self.split_path(name, shard))
+
+
+def source_path(source_dir, image_key, orientation):
+  """path to the left or right image for a key in the original data"""
+  return os.path.join(source_dir, orientation,
+                      '{}_{}.jpg'.format(image_key, orientation))
+
+
+def file_checksum(path):
+  """sha1 of the contents of a file"""
+  checksum = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      checksum.update(chunk)
+  return checksum.hexdigest()
+
+
+def same_filesystem(source_dir, out_dir):
+  """check if two directories are on the same filesystem, so can hardlink"""
+  return os.stat(source_dir).st_dev == os.stat(out_dir).st_dev
+
+
+def plan_file(src_path, dst_path, link, verify):
+  """work out what needs to be done to stage a single file
+
+  Args:
+    src_path (str):
+      path to the original image
+    dst_path (str):
+      where it should end up
+    link (bool):
+      whether to hardlink rather than copy
+    verify (str):
+      how to check if a file already at the destination matches, either
+      `size` or `checksum`
+
+  Returns:
+    StageTask for the file
+
+  Raises:
+    OSError if the source file doesn't exist
+  """
+  src_stat = os.stat(src_path)
+  action = 'link' if link else 'copy'
+  try:
+    dst_stat = os.stat(dst_path)
+  except OSError:
+    return StageTask(src_path, dst_path, action, src_stat.st_size)
+  if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+    # already hardlinked, has to be the same
+    return StageTask(src_path, dst_path, 'skip', src_stat.st_size)
+  if dst_stat.st_size == src_stat.st_size:
+    if (verify != 'checksum') or (file_checksum(src_path) ==
+                                  file_checksum(dst_path)):
+      return StageTask(src_path, dst_path, 'skip', src_stat.st_size)
+  return StageTask(src_path, dst_path, action, src_stat.st_size)
 
 
-def copy_data(image_keys, source_dir, out_dir):
+def plan_staging(image_keys, source_dir, out_dir, link='auto', verify='size',
+                 threads=16):
+  """work out what needs to be done to stage the images for some keys
+
+  Anything that is already at the destination and matches the source is
+  skipped, so if staging was interrupted, running it again only transfers
+  what is missing. Stat'ing files on the shared filesystem is slow, so is
+  spread across a few threads.
+
+  Args:
+    image_keys (list(str)):
+      image keys of images we want
+    source_dir (str):
+      path to the original data
+    out_dir (str):
+      path that will hold all the subdirectories
+    link (str):
+      `auto` to hardlink when the source and output are on the same
+      filesystem, or `never` to always copy
+    verify (str):
+      how to check if files already staged match, either `size` or
+      `checksum`
+    threads (int):
+      number of threads to stat files with
+
+  Returns:
+    list of StageTask for every file
+
+  Raises:
+    IOError if the source or out directory aren't valid
+    OSError if some of the images don't exist
+  """
+  check_source_dir(source_dir)
+  # check the output dir exists
+  if not os.path.isdir(out_dir):
+    raise IOError('out directory supplied does not exist: {}'.format(out_dir))
+  use_link = (link == 'auto') and same_filesystem(source_dir, out_dir)
+  paths = [(source_path(source_dir, image_key, orientation),
+            os.path.join(out_dir, image_key, '{}.jpg'.format(orientation)))
+           for image_key in image_keys
+           for orientation in ['left', 'right']]
+  with ThreadPoolExecutor(threads) as executor:
+    return list(executor.map(
+      lambda x: plan_file(x[0], x[1], use_link, verify), paths))
+
+
+def copy_file(src_path, dst_path):
+  """copy a file, letting the filesystem do the copy if it can
+
+  `os.copy_file_range` lets filesystems like NFS 4.2 and Lustre copy on the
+  server without the data coming through this node. If that isn't
+  supported we fall back to `shutil.copyfile`, which uses `sendfile`.
+  """
+  try:
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+      remaining = os.fstat(src.fileno()).st_size
+      while remaining > 0:
+        copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+        if copied == 0:
+          break
+        remaining -= copied
+    if remaining > 0:
+      raise OSError('copy_file_range stopped early')
+  except (AttributeError, OSError):
+    shutil.copyfile(src_path, dst_path)
+  shutil.copymode(src_path, dst_path)
+
+
+def stage_file(task):
+  """stage a single file
+
+  Is linked or copied to a temp name next to the destination and then
+  renamed into place, so a partly copied file is never mistaken for a
+  staged one.
+
+  Returns:
+    tuple of (destination, error), where error is None if it went fine
+  """
+  try:
+    os.makedirs(os.path.dirname(task.dst), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(task.dst, os.getpid())
+    if task.action == 'link':
+      try:
+        os.link(task.src, tmp_path)
+      except OSError:
+        # some filesystems don't allow hardlinks, or the file is across a
+        # mount point, so just copy it instead
+        copy_file(task.src, tmp_path)
+    else:
+      copy_file(task.src, tmp_path)
+    os.replace(tmp_path, task.dst)
+  except OSError as e:
+    return task.dst, str(e)
+  return task.dst, None
+
+
+def stage_files(plan, threads=16):
+  """link or copy every file in the plan that isn't already there
+
+  Args:
+    plan (list(StageTask)):
+      plan from `plan_staging`
+    threads (int):
+      number of files to stage at once
+
+  Returns:
+    list of (destination, error) for any files that failed
+  """
+  tasks = [x for x in plan if x.action != 'skip']
+  with ThreadPoolExecutor(threads) as executor:
+    results = executor.map(stage_file, tasks)
+    return [(dst, error) for dst, error in results if error is not None]
+
+
+def verify_file(task, verify):
+  """check a staged file matches its source
+
+  Returns:
+    tuple of (destination, error), where error is None if it matches
+  """
+  try:
+    if os.path.getsize(task.dst) != task.size:
+      return task.dst, 'size is {} not {}'.format(os.path.getsize(task.dst),
+                                                  task.size)
+    if (verify == 'checksum') and (file_checksum(task.src) !=
+                                   file_checksum(task.dst)):
+      return task.dst, 'checksum does not match'
+  except OSError as e:
+    return task.dst, str(e)
+  return task.dst, None
+
+
+def verify_staging(plan, verify='size', threads=16):
+  """check every file in the plan made it to the destination intact
+
+  Args:
+    plan (list(StageTask)):
+      plan from `plan_staging`
+    verify (str):
+      either `size` or `checksum`
+    threads (int):
+      number of files to check at once
+
+  Returns:
+    list of (destination, error) for any files that don't match
+  """
+  with ThreadPoolExecutor(threads) as executor:
+    results = executor.map(lambda x: verify_file(x, verify), plan)
+    return [(dst, error) for dst, error in results if error is not None]
+
+
+def print_plan(plan, verbose):
+  """print how many files and bytes each action in the plan covers"""
+  for action in ['skip', 'link', 'copy']:
+    tasks = [x for x in plan if x.action == action]
+    print('{:<5s} {:>8d} files {:>10.1f}MB'.format(
+      action, len(tasks), sum(x.size for x in tasks) / 1024.0**2))
+    if verbose and (action != 'skip'):
+      for task in tasks:
+        print('  {} {} -> {}'.format(action, task.src, task.dst))
+
+
+def copy_data(image_keys, source_dir, out_dir, link='auto', verify='size',
+              threads=16, dry_run=False):
   """copy the selected images to new directories.
   
   am going to make the new directory structure be
@@ -66,6 +497,11 @@ def copy_data(image_keys, source_dir, out_dir):
     ├── left.jpg
     └── right.jpg
 
+  Files are hardlinked if the output is on the same filesystem as the
+  source, otherwise copied, across a pool of threads. Anything already
+  staged is skipped, and once done every file is checked against the
+  source. Refer to `plan_staging` for the details.
+
   Args:
     image_keys (list(str)):
       image keys of images we want
@@ -73,57 +509,164 @@ def copy_data(image_keys, source_dir, out_dir):
       path to the original data
     out_dir (str):
       path that will hold all the subdirectories
+    link (str):
+      `auto` to hardlink when possible, or `never` to always copy
+    verify (str):
+      how to check files match, either `size` or `checksum`
+    threads (int):
+      number of files to work on at once
+    dry_run (bool):
+      if True, just print what would be done
   
   Returns:
-    NA
+    list of (destination, error) for any files that failed to stage or
+    didn't match after staging
 
   Raises:
     IOError if either:
       1) source_dir doesn't exist (should actually be possible if we made it
       this far, but really in any function we should be running checks on 
       all the input arguments. 
-     2) source_dir doesn't exist
+     2) out_dir doesn't exist
      3) If some of the images don't exist (I won't raise this explicitly, this 
         will be raised by the `os` module if the corresponding images aren't
         valid
   """
-  # check the source directory is valid
-  # if it is valid, it should have two subdirectories named
-  # `left` and `right`
-  sub_dirs = os.listdir(source_dir)
-  if ('left' not in sub_dirs) or ('right' not in sub_dirs):
-    raise IOError('invalid source directory supplied: {}'.format(source_dir))
-  # check the output dir exists
+  plan = plan_staging(image_keys, source_dir, out_dir, link, verify, threads)
+  print_plan(plan, verbose=dry_run)
+  if dry_run:
+    return []
+  failed = stage_files(plan, threads)
+  failed_dsts = set(dst for dst, _ in failed)
+  # no point checking the ones we already know failed
+  failed.extend(verify_staging([x for x in plan if x.dst not in failed_dsts],
+                               verify, threads))
+  return failed
+      
+
+def extract_file(archive, image_key, orientation, dst_path):
+  """extract a single image from an archive, if it isn't already there
+
+  Returns:
+    tuple of (destination, error), where error is None if it went fine
+  """
+  try:
+    data = archive.read_bytes(image_key, orientation)
+    if (os.path.isfile(dst_path) and
+        (os.path.getsize(dst_path) == data.nbytes)):
+      return dst_path, None
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(dst_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      f.write(data.tobytes())
+    os.replace(tmp_path, dst_path)
+  except (KeyError, OSError) as e:
+    return dst_path, str(e)
+  return dst_path, None
+
+
+def extract_data(image_keys, archive_path, out_dir, threads=16,
+                 dry_run=False):
+  """extract the selected images from an archive to new directories
+
+  Uses the same layout as `copy_data`. Images already extracted with the
+  right size are skipped.
+
+  Args:
+    image_keys (list(str)):
+      image keys of images we want
+    archive_path (str):
+      path to the archive of the original data
+    out_dir (str):
+      path that will hold all the subdirectories
+    threads (int):
+      number of files to work on at once
+    dry_run (bool):
+      if True, just print what would be done
+
+  Returns:
+    list of (destination, error) for any files that failed
+
+  Raises:
+    IOError if out_dir doesn't exist
+  """
   if not os.path.isdir(out_dir):
     raise IOError('out directory supplied does not exist: {}'.format(out_dir))
-  # now lets copy the data for the samples we will work on
-  for image_key in image_keys:
-    # create the corresponding sub directory
-    os.mkdir(os.path.join(out_dir, image_key))
-    # copy across
-    for orientation in ['left', 'right']:
-      src_path = os.path.join(source_dir,
-                              orientation,
-                              '{}_{}.jpg'.format(image_key, orientation))
-      out_path = os.path.join(out_dir, image_key, '{}.jpg'.format(orientation))
-      shutil.copy(src_path, out_path)
-      
+  archive = archive_dataset.open_archive(archive_path)
+  tasks = [(image_key, orientation,
+            os.path.join(out_dir, image_key, '{}.jpg'.format(orientation)))
+           for image_key in image_keys
+           for orientation in ['left', 'right']]
+  print('extract {:>8d} files'.format(len(tasks)))
+  if dry_run:
+    for image_key, orientation, dst_path in tasks:
+      print('  extract {}{}{} {} -> {}'.format(
+        archive_path, archive_dataset.ARCHIVE_SEPARATOR, image_key,
+        orientation, dst_path))
+    return []
+  with ThreadPoolExecutor(threads) as executor:
+    results = executor.map(lambda x: extract_file(archive, *x), tasks)
+    return [(dst, error) for dst, error in results if error is not None]
+
 
 def main(args):
-  # setting a random seed
-  random.seed(1189998819991197253)
   # there are stereo images here, and the left and right images are
   # stored in two different subdirectories, but they have a common
   # key that is stored in the filename to link them.
-  # Im going to find extract all the image keys and return it as a
-  # list
-  image_keys = find_image_keys(args.source_dir)
-  # now lets get a random subsample of them
-  subset_image_keys = random.sample(image_keys, args.num_samples)
-  # now need to copy data to the a new directory
-  copy_data(subset_image_keys, args.source_dir, args.out_dir)
-  print(image_keys)
-  print(subset_image_keys)
+  # Im going to stream through the image keys, and deal with each one as
+  # it goes past rather than keeping a list of them all
+  splits = parse_splits(args.splits)
+  writer = None
+  if splits:
+    writer = SplitWriter(args.split_dir or args.out_dir, args.shards)
+  invalid_counts = collections.Counter()
+
+  def invalid_fn(image_key, reason):
+    invalid_counts[reason] += 1
+    print('INVALID: {}: {}'.format(image_key, reason))
+
+  # the sample for the demo is the keys with the smallest hashes, keep them
+  # in a heap as we go. Is stored negated so the biggest is on top
+  sample = []
+  num_keys = 0
+  # keys in the split files for an archive say which archive they are in
+  split_prefix = ''
+  if os.path.isfile(args.source_dir):
+    split_prefix = os.path.abspath(
+      args.source_dir) + archive_dataset.ARCHIVE_SEPARATOR
+  for image_key in iter_valid_keys(args.source_dir, invalid_fn, args.threads):
+    num_keys += 1
+    split_value, shard_value = key_hash(image_key, args.salt)
+    if writer is not None:
+      name = assign_split(split_value, splits)
+      if name is not None:
+        writer.write(name, shard_value, split_prefix + image_key)
+    if args.num_samples > 0:
+      heapq.heappush(sample, (-split_value, image_key))
+      if len(sample) > args.num_samples:
+        heapq.heappop(sample)
+  print('valid keys:   {}'.format(num_keys))
+  print('invalid keys: {}'.format(sum(invalid_counts.values())))
+  if writer is not None:
+    writer.close()
+    for name, _ in splits:
+      print('split {:<10s} {}'.format(name, writer.counts[name]))
+  failed = []
+  if args.num_samples > 0:
+    if len(sample) < args.num_samples:
+      raise ValueError('Asked for {} samples but only have {} keys'.format(
+        args.num_samples, len(sample)))
+    subset_image_keys = sorted(x[1] for x in sample)
+    # now need to copy data to the a new directory
+    if split_prefix:
+      failed = extract_data(subset_image_keys, args.source_dir, args.out_dir,
+                            args.threads, args.dry_run)
+    else:
+      failed = copy_data(subset_image_keys, args.source_dir, args.out_dir,
+                         args.link, args.verify, args.threads, args.dry_run)
+  for dst, error in failed:
+    print('FAILED: {}: {}'.format(dst, error))
+  return failed
   
   
 if __name__ == '__main__':
@@ -141,12 +684,43 @@ if __name__ == '__main__':
   default_source_dir = '/work/SAIVT/hpc_guide_data/stereo_images/holopix50k/data/val/Holopix50k/val/'
   default_out_dir = '/work/SAIVT/hpc_guide_data/stereo_images/holopix50k/data/small/'
   parser.add_argument('--source_dir', type=str, default=default_source_dir,
-                      help='path to directory with the original data')
+                      help='path to directory with the original data, or a tar or zip of it')
+  parser.add_argument('--archive_index_dir', type=str, default=None,
+                      help='directory to keep archive indexes in, for when the archive is read only')
   parser.add_argument('--out_dir', type=str, default=default_out_dir,
                       help='path to directory with the output has been written')
   parser.add_argument('--num_samples', type=int, default=20,
-                      help='number of samples to use')
+                      help='number of samples to copy to out_dir, 0 to not copy any')
+  parser.add_argument('--splits', type=str, nargs='+', default=[],
+                      help='splits to write key lists for, eg. train:0.8 val:0.1 test:0.1')
+  parser.add_argument('--shards', type=int, default=1,
+                      help='number of shards to break each split into')
+  parser.add_argument('--split_dir', type=str, default=None,
+                      help='directory to write split key lists to, default is out_dir')
+  parser.add_argument('--salt', type=str, default='1189998819991197253',
+                      help='salt for hashing keys, change for a different random split')
+  parser.add_argument('--threads', type=int, default=16,
+                      help='number of files to stage at once')
+  parser.add_argument('--link', type=str, default='auto',
+                      choices=['auto', 'never'],
+                      help='hardlink instead of copying when on the same filesystem')
+  parser.add_argument('--verify', type=str, default='size',
+                      choices=['size', 'checksum'],
+                      help='how to check staged files match the originals')
+  parser.add_argument('--dry_run', action='store_true',
+                      help='print what would be staged without doing anything')
   # parse in cmdline args
   args = parser.parse_args(sys.argv[1:])
-  main(args)
+  if args.archive_index_dir:
+    os.environ[archive_dataset.INDEX_DIR_ENV] = args.archive_index_dir
+  for name in ['threads', 'shards']:
+    if getattr(args, name) < 1:
+      raise ValueError('Invalid value for {}, must be >= 1: {}'.format(
+        name, getattr(args, name)))
+  if args.num_samples < 0:
+    raise ValueError('Invalid value for num_samples, must be >= 0: {}'.format(
+      args.num_samples))
+  failed = main(args)
+  if failed:
+    sys.exit(1)
 
@@ -0,0 +1,318 @@
+"""pack_dataset.py
+
+Packs a split of stereo images made by `make_data_split.py` into a few large
+shard files, so we aren't hitting the cluster filesystem with millions of
+small file opens.
+
+The split is stored as
+└── image_key
+    ├── left.jpg
+    └── right.jpg
+
+and once packed will look like
+└── pack_dir
+    ├── shard_index.tsv
+    ├── shard_00000.bin
+    ├── shard_00001.bin
+    └── ...
+
+Each shard is just the original encoded images one after the other, and
+the index has a line for each image with
+`<image_key>\t<name>\t<shard file>\t<offset>\t<length>`
+where name is `left` or `right`. Images are read back by memory mapping the
+shard and decoding straight from that, so nothing has to be extracted.
+
+Other outputs (like disparity maps) can be added to a pack later on. Each
+process that adds to a pack writes its own shards and index file (named with
+the host and process id) so they never step on each other. When a pack is
+opened every `*_index.tsv` file is read, and if the same key and name shows
+up more than once the last one wins.
+"""
+import numpy as np
+import cv2
+import argparse
+import mmap
+import os
+import socket
+import sys
+import threading
+from glob import glob
+
+
+class PackedDataset(object):
+  """read only view of a packed dataset
+
+  Shards are memory mapped the first time they are needed, so only the
+  pages for images we actually read get pulled in. Memory maps are not
+  shared between processes, so each worker should open its own.
+  """
+
+  def __init__(self, pack_dir):
+    """load the index for the pack
+
+    Args:
+      pack_dir (str):
+        directory with the shards and index files
+
+    Raises:
+      IOError if there are no index files in the directory
+    """
+    self.pack_dir = pack_dir
+    self.index = {}
+    self._maps = {}
+    self._lock = threading.Lock()
+    index_paths = sorted(glob(os.path.join(pack_dir, '*_index.tsv')))
+    # want the packed shards read first, so any outputs added later on take
+    # precedence if they happen to share a name
+    index_paths.sort(key=lambda x: os.path.basename(x) != 'shard_index.tsv')
+    if not index_paths:
+      raise IOError('no index files found in pack: {}'.format(pack_dir))
+    for index_path in index_paths:
+      self.index.update(read_index(index_path))
+
+  def keys(self):
+    """list of all image keys in the pack, in sorted order"""
+    return sorted(set(key for key, _ in self.index))
+
+  def has(self, key, name):
+    """whether the pack has an entry for this key and name"""
+    return (key, name) in self.index
+
+  def read_bytes(self, key, name):
+    """get the encoded bytes for an entry without copying them
+
+    Args:
+      key (str):
+        image key
+      name (str):
+        name of the entry, eg. `left`, `right` or `disp`
+
+    Returns:
+      read only uint8 array that is a view onto the memory mapped shard
+
+    Raises:
+      KeyError if the entry isn't in the pack
+    """
+    shard, offset, length = self.index[(key, name)]
+    return np.frombuffer(self._map(shard), dtype=np.uint8,
+                         count=length, offset=offset)
+
+  def read_image(self, key, name, flags=cv2.IMREAD_COLOR):
+    """decode an image straight from the memory mapped shard
+
+    Args:
+      key (str):
+        image key
+      name (str):
+        name of the entry, eg. `left`, `right` or `disp`
+      flags (int):
+        flags for `cv2.imdecode`
+
+    Returns:
+      decoded image
+
+    Raises:
+      KeyError if the entry isn't in the pack
+      IOError if the image couldn't be decoded
+    """
+    image = cv2.imdecode(self.read_bytes(key, name), flags)
+    if image is None:
+      raise IOError('unable to decode {} image for key: {}'.format(name, key))
+    return image
+
+  def _map(self, shard):
+    """memory map a shard, or get the one we already have"""
+    with self._lock:
+      if shard not in self._maps:
+        with open(os.path.join(self.pack_dir, shard), 'rb') as f:
+          self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      return self._maps[shard]
+
+  def close(self):
+    """close all the memory mapped shards"""
+    with self._lock:
+      for shard_map in self._maps.values():
+        shard_map.close()
+      self._maps = {}
+
+
+class PackWriter(object):
+  """append entries to a pack
+
+  Each entry is written to the current shard, and a new shard is started
+  once it gets over the size limit. The data is flushed to the shard before
+  its line is added to the index, so if we crash part way through an entry
+  it just won't show up in the index. Is safe to use from multiple threads.
+  """
+
+  def __init__(self, pack_dir, prefix=None, shard_size_mb=1024):
+    """start a new set of shards in a pack
+
+    Args:
+      pack_dir (str):
+        directory with the shards and index files, is created if it doesn't
+        exist
+      prefix (str):
+        prefix for the shard and index files. If None, will use one based on
+        the host and process id, so multiple jobs can add to the same pack
+      shard_size_mb (int):
+        start a new shard once the current one gets bigger than this
+    """
+    if prefix is None:
+      prefix = 'disp_{}_{}'.format(socket.gethostname(), os.getpid())
+    if not os.path.isdir(pack_dir):
+      os.makedirs(pack_dir)
+    self.pack_dir = pack_dir
+    self.prefix = prefix
+    self.shard_size = shard_size_mb * 1024 * 1024
+    self._lock = threading.Lock()
+    self._shard_count = 0
+    self._shard = None
+    self._shard_name = None
+    self._index = open(os.path.join(pack_dir, '{}_index.tsv'.format(prefix)),
+                       'a')
+
+  def append(self, key, name, data):
+    """add an entry to the pack
+
+    Args:
+      key (str):
+        image key
+      name (str):
+        name of the entry, eg. `left`, `right` or `disp`
+      data (bytes or array):
+        encoded bytes to store
+
+    Returns:
+      NA
+    """
+    data = memoryview(data)
+    with self._lock:
+      if (self._shard is None) or (self._shard.tell() > self.shard_size):
+        self._next_shard()
+      offset = self._shard.tell()
+      self._shard.write(data)
+      self._shard.flush()
+      self._index.write('{}\t{}\t{}\t{}\t{}\n'.format(
+        key, name, self._shard_name, offset, data.nbytes))
+      self._index.flush()
+
+  def _next_shard(self):
+    """close the current shard and start a new one"""
+    if self._shard is not None:
+      self._shard.close()
+    # don't want to clobber shards left over from an earlier run with the
+    # same prefix
+    while True:
+      self._shard_name = '{}_{:0>5d}.bin'.format(self.prefix, self._shard_count)
+      self._shard_count += 1
+      if not os.path.exists(os.path.join(self.pack_dir, self._shard_name)):
+        break
+    self._shard = open(os.path.join(self.pack_dir, self._shard_name), 'wb')
+
+  def close(self):
+    """close the current shard and the index"""
+    with self._lock:
+      if self._shard is not None:
+        self._shard.close()
+        self._shard = None
+      self._index.close()
+
+
+def read_index(index_path):
+  """read an index file for a pack
+
+  Args:
+    index_path (str):
+      path to the index file
+
+  Returns:
+    dict mapping (image_key, name) to (shard file, offset, length)
+  """
+  index = {}
+  with open(index_path) as f:
+    for line in f:
+      fields = line.rstrip('\n').split('\t')
+      # a line that was only partly written when a job died, skip it
+      if len(fields) != 5:
+        continue
+      key, name, shard, offset, length = fields
+      index[(key, name)] = (shard, int(offset), int(length))
+  return index
+
+
+def pack_split(split_dir, pack_dir, shard_size_mb):
+  """pack all the image pairs in a split into shards
+
+  Args:
+    split_dir (str):
+      directory with a subdirectory for each image key, each containing
+      `left.jpg` and `right.jpg`
+    pack_dir (str):
+      directory to write the pack to
+    shard_size_mb (int):
+      start a new shard once the current one gets bigger than this
+
+  Returns:
+    number of image pairs packed
+
+  Raises:
+    IOError if the split directory doesn't exist, or if the pack directory
+    already has a packed split in it
+  """
+  if not os.path.isdir(split_dir):
+    raise IOError('split directory does not exist: {}'.format(split_dir))
+  if os.path.exists(os.path.join(pack_dir, 'shard_index.tsv')):
+    raise IOError('pack directory already has a split in it: {}'.format(
+      pack_dir))
+  writer = PackWriter(pack_dir, prefix='shard', shard_size_mb=shard_size_mb)
+  num_packed = 0
+  # scandir gives us whether each entry is a directory without another stat
+  for entry in sorted(os.scandir(split_dir), key=lambda x: x.name):
+    if not entry.is_dir():
+      continue
+    for name in ['left', 'right']:
+      with open(os.path.join(entry.path, '{}.jpg'.format(name)), 'rb') as f:
+        writer.append(entry.name, name, f.read())
+    num_packed += 1
+  writer.close()
+  return num_packed
+
+
+def main(args):
+  """pack a split, or list the keys in a pack"""
+  if args.command == 'pack':
+    num_packed = pack_split(args.split_dir, args.pack_dir, args.shard_size_mb)
+    print('packed {} image pairs into {}'.format(num_packed, args.pack_dir))
+  elif args.command == 'list':
+    # print one key per line, can be redirected to make an image list for
+    # `create_depth_map.py --pack_dir`
+    for key in PackedDataset(args.pack_dir).keys():
+      print(key)
+
+
+if __name__ == '__main__':
+  """Loading in command line arguments.
+
+  Has two commands,
+    pack: pack a split directory into a new pack
+    list: print the image keys in a pack
+  """
+  parser = argparse.ArgumentParser(prog='pack_dataset',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  pack_parser = subparsers.add_parser('pack', help='pack a split')
+  pack_parser.add_argument('split_dir', type=str,
+                           help='directory with a subdirectory for each pair')
+  pack_parser.add_argument('pack_dir', type=str,
+                           help='directory to write the pack to')
+  pack_parser.add_argument('--shard_size_mb', type=int, default=1024,
+                           help='size to start a new shard at in MB')
+  list_parser = subparsers.add_parser('list', help='list keys in a pack')
+  list_parser.add_argument('pack_dir', type=str,
+                           help='directory with the pack')
+  args = parser.parse_args(sys.argv[1:])
+  main(args)
@@ -0,0 +1,89 @@
+"""pbs_template.py
+
+Simple templates for job scripts, used by `create_pbs.py`.
+
+Placeholders in a template are names in capitals inside angle brackets, eg.
+`<IMAGELIST>` or `<NCPUS>`. A template is split up into its literal text and
+placeholders once when it is made, so filling it in for each job is a single
+join rather than a pass over the whole file for every placeholder.
+
+Any placeholders that don't have a value are reported along with the lines
+they are on, rather than being left in the job script for PBS or bash to
+trip over later on.
+"""
+import re
+
+
+# names in capitals inside angle brackets, eg. <IMAGELIST>
+PLACEHOLDER_RE = re.compile(r'<([A-Z][A-Z0-9_]*)>')
+
+
+class Template(object):
+  """template compiled into literal text and placeholders"""
+
+  def __init__(self, text):
+    """compile a template
+
+    Args:
+      text (str):
+        text of the template
+    """
+    self.text = text
+    # split gives literal text at even indices and placeholder names at odd
+    parts = PLACEHOLDER_RE.split(text)
+    self._literals = parts[0::2]
+    self._names = parts[1::2]
+    self.placeholders = set(self._names)
+    # line numbers each placeholder is on, for reporting
+    self.lines = {}
+    for match in PLACEHOLDER_RE.finditer(text):
+      line = text.count('\n', 0, match.start()) + 1
+      self.lines.setdefault(match.group(1), []).append(line)
+
+  def unfilled(self, values):
+    """placeholders in the template that don't have a value
+
+    Returns:
+      sorted list of placeholder names
+    """
+    return sorted(self.placeholders - set(values))
+
+  def unused(self, values):
+    """values that don't have a placeholder in the template
+
+    Returns:
+      sorted list of value names
+    """
+    return sorted(set(values) - self.placeholders)
+
+  def describe(self, names):
+    """describe some placeholders and where they are, for error messages"""
+    return ', '.join('<{}> (line {})'.format(
+      x, ', '.join(str(y) for y in self.lines[x])) for x in names)
+
+  def render(self, values, strict=True):
+    """fill in the template
+
+    Args:
+      values (dict):
+        value for each placeholder, are converted to strings
+      strict (bool):
+        if True, raise an error for any placeholders without a value.
+        Otherwise they are left as they are
+
+    Returns:
+      filled in text
+
+    Raises:
+      ValueError if strict and any placeholders don't have a value
+    """
+    unfilled = self.unfilled(values)
+    if unfilled and strict:
+      raise ValueError('unfilled placeholders in template: {}'.format(
+        self.describe(unfilled)))
+    filled = ['<{}>'.format(x) if x in unfilled else str(values[x])
+              for x in self._names]
+    parts = [None] * (len(self._literals) + len(filled))
+    parts[0::2] = self._literals
+    parts[1::2] = filled
+    return ''.join(parts)
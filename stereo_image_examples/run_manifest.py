@@ -0,0 +1,139 @@
+"""run_manifest.py
+
+Manifest of image pairs that have already been processed, so if a job runs
+out of walltime it can be run again and pick up where it left off.
+
+The manifest is a JSON lines file with a record for each pair once its
+output has been fully written, with
+  pair: path (or key) for the image pair
+  inputs: signature of the input images (eg. their mtime and size)
+  params: fingerprint of the params used to make the output
+  output: where the output was written
+  output_signature: signature of the output when it was written
+
+A pair is only counted as done if there is a record for it where the inputs
+and params are the same as now, and the output is still there and hasn't
+changed. Records are only ever appended, so if a pair is run again the last
+record for it wins. If a job is killed part way through writing a record,
+that half written line is just ignored.
+"""
+import hashlib
+import json
+import os
+
+
+def params_fingerprint(params):
+  """fingerprint for a set of params
+
+  Args:
+    params (dict):
+      param names and values that change the output
+
+  Returns:
+    hex string that changes if any of the params change
+  """
+  encoded = json.dumps(params, sort_keys=True).encode()
+  return hashlib.sha1(encoded).hexdigest()
+
+
+def file_signature(path):
+  """cheap signature of a file from its mtime and size
+
+  Args:
+    path (str):
+      path to the file
+
+  Returns:
+    [mtime in ns, size in bytes], or None if the file doesn't exist
+  """
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return [stat.st_mtime_ns, stat.st_size]
+
+
+class RunManifest(object):
+  """append only manifest of completed image pairs"""
+
+  def __init__(self, manifest_path):
+    """load any records already in the manifest
+
+    Args:
+      manifest_path (str):
+        path to the manifest file, is created if it doesn't exist
+    """
+    self.manifest_path = manifest_path
+    self.records = {}
+    complete = True
+    if os.path.isfile(manifest_path):
+      with open(manifest_path) as f:
+        for line in f:
+          complete = line.endswith('\n')
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # partly written line from a job that was killed
+            continue
+          self.records[record['pair']] = record
+    self._file = open(manifest_path, 'a')
+    if not complete:
+      # finish off the partly written line, otherwise the first record we
+      # add would be glued onto it and lost along with it
+      self._file.write('\n')
+      self._file.flush()
+
+  def is_done(self, pair, inputs, params, output_signature_fn):
+    """check if a pair has already been done with the same inputs and params
+
+    Args:
+      pair (str):
+        path (or key) for the image pair
+      inputs (list):
+        signature of the input images as they are now. If None, the pair is
+        never counted as done
+      params (str):
+        fingerprint of the params being used now
+      output_signature_fn (callable):
+        called with the output recorded for this pair, should return the
+        signature of that output as it is now, or None if it is missing
+
+    Returns:
+      True if the pair can be skipped
+    """
+    record = self.records.get(pair)
+    if (record is None) or (inputs is None):
+      return False
+    if (record['inputs'] != inputs) or (record['params'] != params):
+      return False
+    output_signature = output_signature_fn(record['output'])
+    return ((output_signature is not None) and
+            (output_signature == record['output_signature']))
+
+  def record(self, pair, inputs, params, output, output_signature):
+    """add a record for a pair whose output has been fully written
+
+    Args:
+      pair (str):
+        path (or key) for the image pair
+      inputs (list):
+        signature of the input images
+      params (str):
+        fingerprint of the params used
+      output (str):
+        where the output was written
+      output_signature (list):
+        signature of the output
+
+    Returns:
+      NA
+    """
+    record = {'pair': pair, 'inputs': inputs, 'params': params,
+              'output': output, 'output_signature': output_signature}
+    self.records[pair] = record
+    self._file.write(json.dumps(record) + '\n')
+    self._file.flush()
+
+  def close(self):
+    """close the manifest file"""
+    self._file.close()
@@ -0,0 +1,263 @@
+"""shard_planner.py
+
+Splits a full list of image pairs into balanced shards for
+`create_pbs.py`, and works out how much walltime and memory each shard's
+job should ask for.
+
+Cost of each pair is predicted with a simple model,
+  seconds = scale * (DECODE_RATE * source pixels
+                     + MATCH_RATE * height * width * max_disparity
+                                  * (1 + block_size**2 / 256))
+where source pixels is the size of the original left and right images
+(read from the JPEG headers, so nothing is decoded), and height/width are
+what the images are resized to. The match term is there twice over for the
+left and right matchers, which is folded into MATCH_RATE.
+
+The default rates are rough numbers from a single core on a laptop. If we
+have timings from previous runs (JSON lines with at least `pair` and
+`seconds` keys, and optionally the params used for that run), `scale` is
+fit so the model matches what was actually recorded.
+
+Pairs are then assigned to shards largest first, each going to the shard
+with the least predicted work so far, which keeps the slowest shard close
+to the average.
+"""
+import heapq
+import json
+import math
+import os
+
+
+# seconds per source pixel to decode a JPEG
+DECODE_RATE = 1.0e-8
+# seconds per pixel x disparity for left and right matching plus filtering
+MATCH_RATE = 3.5e-9
+# fixed cost for each job to start up, load modules etc. in seconds
+JOB_OVERHEAD = 120.0
+# how much extra walltime and memory to ask for on top of the prediction
+SAFETY_FACTOR = 1.5
+# memory for the interpreter, OpenCV etc. before any images in MB
+BASE_MEMORY_MB = 512
+
+
+# how much of a JPEG to read at first when looking for its size, enough to
+# get past the EXIF and ICC segments most cameras write before the frame
+HEADER_BYTES = 64 * 1024
+
+
+def parse_jpeg_size(data):
+  """find the size of a JPEG from the start of its encoded bytes
+
+  Walks the marker segments up to the start of frame, so nothing is decoded.
+
+  Args:
+    data (bytes or array):
+      encoded bytes, or at least the start of them
+
+  Returns:
+    (height, width), or None if it isn't a JPEG, or the start of frame isn't
+    in `data`
+  """
+  data = memoryview(data).cast('B')
+  if bytes(data[:2]) != b'\xff\xd8':
+    return None
+  i = 2
+  while i + 9 <= len(data):
+    if data[i] != 0xff:
+      return None
+    marker = data[i + 1]
+    if marker == 0xff:
+      # fill byte before a marker
+      i += 1
+      continue
+    # start of frame markers, other than DHT, JPG and DAC
+    if (0xc0 <= marker <= 0xcf) and marker not in (0xc4, 0xc8, 0xcc):
+      return (int.from_bytes(data[i + 5:i + 7], 'big'),
+              int.from_bytes(data[i + 7:i + 9], 'big'))
+    i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+  return None
+
+
+def jpeg_size(image_path):
+  """read the height and width of a JPEG from its header
+
+  Only reads the start of the file, unless the header is bigger than
+  HEADER_BYTES, so is cheap even for big images.
+
+  Args:
+    image_path (str):
+      path to the JPEG
+
+  Returns:
+    (height, width), or None if the file can't be read or isn't a JPEG
+  """
+  try:
+    with open(image_path, 'rb') as f:
+      data = f.read(HEADER_BYTES)
+      size = parse_jpeg_size(data)
+      if (size is None) and (len(data) == HEADER_BYTES) and \
+         data.startswith(b'\xff\xd8'):
+        # a big header, read the rest and try again
+        size = parse_jpeg_size(data + f.read())
+      return size
+  except (IOError, OSError):
+    return None
+
+
+def source_pixels(image_pair, im_height, im_width):
+  """number of pixels in the original left and right images of a pair
+
+  If the size can't be read from the headers (eg. the pair is a key in a
+  pack), assumes they are already the size they will be resized to.
+  """
+  total = 0
+  for orientation in ['left', 'right']:
+    size = jpeg_size(os.path.join(image_pair, '{}.jpg'.format(orientation)))
+    if size is None:
+      size = (im_height, im_width)
+    total += size[0] * size[1]
+  return total
+
+
+def model_seconds(src_pixels, im_height, im_width, max_disparity, block_size):
+  """predicted seconds for a pair before any scaling from previous runs"""
+  match_units = (im_height * im_width * max_disparity *
+                 (1.0 + block_size**2 / 256.0))
+  return DECODE_RATE * src_pixels + MATCH_RATE * match_units
+
+
+def fit_scale(timings_path, params):
+  """fit the scale of the cost model to timings from previous runs
+
+  Args:
+    timings_path (str):
+      JSON lines file with `pair` and `seconds` for each pair, and
+      optionally `im_height`, `im_width`, `max_disparity` and `block_size`
+      for the params it was run with. If None, no scaling is done
+    params (dict):
+      params to assume for any records that don't say what they used
+
+  Returns:
+    tuple of (scale, dict of observed seconds for each pair)
+  """
+  if timings_path is None:
+    return 1.0, {}
+  observed_total = 0.0
+  predicted_total = 0.0
+  observed = {}
+  with open(timings_path) as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+        seconds = float(record['seconds'])
+        pair = record['pair']
+      except (ValueError, KeyError, TypeError):
+        continue
+      record_params = dict(params)
+      record_params.update({k: record[k] for k in params if k in record})
+      observed_total += seconds
+      predicted_total += model_seconds(
+        source_pixels(pair, record_params['im_height'],
+                      record_params['im_width']),
+        record_params['im_height'], record_params['im_width'],
+        record_params['max_disparity'], record_params['block_size'])
+      # only reuse timings directly if they were made with the same params
+      if all(record_params[k] == params[k] for k in params):
+        observed[pair] = seconds
+  if predicted_total <= 0:
+    return 1.0, observed
+  return observed_total / predicted_total, observed
+
+
+def predict_costs(image_pair_paths, params, timings_path=None):
+  """predict how many seconds each pair will take on a single core
+
+  Pairs that were timed in a previous run with the same params use that
+  time, everything else uses the scaled cost model.
+
+  Args:
+    image_pair_paths (list(str)):
+      paths to the image pairs
+    params (dict):
+      `im_height`, `im_width`, `max_disparity` and `block_size` the jobs
+      will run with
+    timings_path (str):
+      timings from previous runs, or None
+
+  Returns:
+    list of predicted seconds for each pair
+  """
+  scale, observed = fit_scale(timings_path, params)
+  costs = []
+  for image_pair in image_pair_paths:
+    if image_pair in observed:
+      costs.append(observed[image_pair])
+    else:
+      costs.append(scale * model_seconds(
+        source_pixels(image_pair, params['im_height'], params['im_width']),
+        params['im_height'], params['im_width'], params['max_disparity'],
+        params['block_size']))
+  return costs
+
+
+def balance_shards(image_pair_paths, costs, num_shards):
+  """split pairs into shards with about the same total cost
+
+  Uses the longest processing time first rule: pairs are taken from most
+  to least expensive, and each goes into the shard with the least work.
+
+  Args:
+    image_pair_paths (list(str)):
+      paths to the image pairs
+    costs (list(float)):
+      predicted cost for each pair
+    num_shards (int):
+      number of shards to make
+
+  Returns:
+    list of (total cost, list of pairs) for each shard
+  """
+  shards = [(0.0, i, []) for i in range(num_shards)]
+  heapq.heapify(shards)
+  for cost, image_pair in sorted(zip(costs, image_pair_paths), reverse=True):
+    total, i, pairs = heapq.heappop(shards)
+    pairs.append(image_pair)
+    heapq.heappush(shards, (total + cost, i, pairs))
+  # keep the shards in a stable order, and drop any that ended up empty
+  shards = sorted(shards, key=lambda x: x[1])
+  return [(total, pairs) for total, _, pairs in shards if pairs]
+
+
+def num_shards_for_walltime(costs, ncpus, target_seconds):
+  """how many shards we need so each fits in the target walltime"""
+  usable = max(target_seconds / SAFETY_FACTOR - JOB_OVERHEAD, 1.0)
+  return max(1, int(math.ceil(sum(costs) / (ncpus * usable))))
+
+
+def shard_walltime(total_cost, ncpus):
+  """walltime to ask for a shard, as HH:MM:SS
+
+  Assumes the work is spread evenly across the cores, rounded up to the
+  next minute, and never less than five minutes.
+  """
+  seconds = SAFETY_FACTOR * (total_cost / float(ncpus) + JOB_OVERHEAD)
+  minutes = max(5, int(math.ceil(seconds / 60.0)))
+  return '{:0>2d}:{:0>2d}:00'.format(minutes // 60, minutes % 60)
+
+
+def shard_memory(image_pair_paths, params, ncpus):
+  """memory to ask for a shard, eg. `1400MB`
+
+  Each worker holds the largest decoded source pair in the shard, the
+  resized pair, the disparity maps and the matcher buffers, which for
+  SGBM_3WAY scale with the width x max disparity for a few rows at a time.
+  """
+  largest_source = max(source_pixels(x, params['im_height'],
+                                     params['im_width'])
+                       for x in image_pair_paths)
+  resized = params['im_height'] * params['im_width']
+  worker_bytes = (3 * largest_source + 6 * resized + 8 * resized +
+                  64 * params['im_width'] * params['max_disparity'])
+  megabytes = BASE_MEMORY_MB + SAFETY_FACTOR * ncpus * worker_bytes / 1024.0**2
+  # round up to the next 100MB
+  return '{}MB'.format(int(math.ceil(megabytes / 100.0)) * 100)
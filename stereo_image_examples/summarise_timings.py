@@ -0,0 +1,153 @@
+"""summarise_timings.py
+
+Summarises the stage timings printed by `create_depth_map.py
+--stage_timings` across all the jobs of a run.
+
+Each job writes its stdout to `stdout_<INDEX>.out`, and with
+`--stage_timings` every pair gets a JSON line in there with how long it
+took in each stage (decode, resize, matching, WLS filter, encode, write
+etc.) and the peak RSS of the process. Any other lines in the logs are
+ignored, so this can be run straight on the job logs, eg.
+
+  python summarise_timings.py stdout_*.out
+
+which prints
+  - number of pairs, and throughput in pairs per second over the span from
+    the first pair starting to the last one finishing
+  - p50 and p95 latency of a pair
+  - mean seconds in each stage and what fraction of the total that is
+  - peak RSS of any worker
+
+`--timings_out` also writes all the records to a single JSON lines file,
+which can be passed to `create_pbs.py --timings` to balance the next run
+using what was actually measured.
+"""
+import argparse
+import json
+import math
+import sys
+
+
+def read_timing_records(log_paths):
+  """read the timing records out of job logs
+
+  Args:
+    log_paths (list(str)):
+      paths to the job logs
+
+  Returns:
+    list of timing records (dicts)
+  """
+  records = []
+  for log_path in log_paths:
+    with open(log_path) as f:
+      for line in f:
+        if not line.startswith('{'):
+          continue
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # job was killed part way through writing a line
+          continue
+        if ('pair' in record) and ('stages' in record):
+          records.append(record)
+  return records
+
+
+def percentile(values, fraction):
+  """nearest rank percentile of a sorted list"""
+  rank = max(1, int(math.ceil(fraction * len(values))))
+  return values[rank - 1]
+
+
+def summarise(records):
+  """work out throughput, latency and stage breakdown for some records
+
+  Args:
+    records (list(dict)):
+      timing records from `read_timing_records`
+
+  Returns:
+    dict with the summary
+  """
+  latencies = sorted(x['seconds'] for x in records)
+  span = (max(x['end_time'] for x in records) -
+          min(x['start_time'] for x in records))
+  stage_totals = {}
+  for record in records:
+    for stage, seconds in record['stages'].items():
+      stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+  total_seconds = sum(latencies)
+  # time between stages, eg. waiting for a slot in the pipeline queues
+  stage_totals['other'] = max(0.0, total_seconds - sum(stage_totals.values()))
+  summary = {'pairs': len(records),
+             'span_seconds': span,
+             'pairs_per_second': len(records) / max(span, 1e-9),
+             'p50_seconds': percentile(latencies, 0.5),
+             'p95_seconds': percentile(latencies, 0.95),
+             'stage_mean_seconds': {k: v / len(records)
+                                    for k, v in stage_totals.items()},
+             'stage_fraction': {k: v / max(total_seconds, 1e-9)
+                                for k, v in stage_totals.items()},
+             'max_rss_mb': max(x.get('max_rss_mb', 0.0) for x in records),
+             'hosts': len(set(x.get('host') for x in records))}
+  # fraction of rows the gated engine didn't need to refine
+  gate_skipped = [x['gate_skipped'] for x in records if 'gate_skipped' in x]
+  if gate_skipped:
+    summary['gate_skipped'] = sum(gate_skipped) / len(gate_skipped)
+  return summary
+
+
+def print_summary(summary):
+  """print a summary from `summarise`"""
+  print('pairs:      {}'.format(summary['pairs']))
+  print('hosts:      {}'.format(summary['hosts']))
+  print('span:       {:.2f}s'.format(summary['span_seconds']))
+  print('throughput: {:.3f} pairs/s'.format(summary['pairs_per_second']))
+  print('latency:    p50 {:.3f}s  p95 {:.3f}s'.format(
+    summary['p50_seconds'], summary['p95_seconds']))
+  print('peak RSS:   {:.1f}MB'.format(summary['max_rss_mb']))
+  if 'gate_skipped' in summary:
+    print('gated:      {:.1%} of rows not refined'.format(
+      summary['gate_skipped']))
+  print('stages (mean seconds per pair, fraction of pair time):')
+  # slowest stages first
+  for stage in sorted(summary['stage_mean_seconds'],
+                      key=lambda x: -summary['stage_mean_seconds'][x]):
+    print('  {:<14s} {:8.4f}s  {:6.1%}'.format(
+      stage, summary['stage_mean_seconds'][stage],
+      summary['stage_fraction'][stage]))
+
+
+def main(args):
+  """summarise the timings in a bunch of job logs"""
+  records = read_timing_records(args.logs)
+  if not records:
+    print('no timing records found, was create_depth_map.py run with '
+          '--stage_timings?')
+    return 1
+  summary = summarise(records)
+  if args.json:
+    print(json.dumps(summary, indent=2, sort_keys=True))
+  else:
+    print_summary(summary)
+  if args.timings_out is not None:
+    with open(args.timings_out, 'w') as f:
+      for record in records:
+        f.write(json.dumps(record) + '\n')
+  return 0
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='summarise_timings',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('logs', type=str, nargs='+',
+                      help='job logs to read, eg. stdout_*.out')
+  parser.add_argument('--json', action='store_true',
+                      help='print the summary as JSON')
+  parser.add_argument('--timings_out', type=str, default=None,
+                      help='write all the timing records here, for create_pbs.py --timings')
+  args = parser.parse_args(sys.argv[1:])
+  sys.exit(main(args))
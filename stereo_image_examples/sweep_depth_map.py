@@ -0,0 +1,251 @@
+"""sweep_depth_map.py
+
+Runs a sweep over a grid of matcher and filter params for
+`create_depth_map.py`, without having to run the whole script again for
+every combination.
+
+Each image pair is only read once for the whole sweep. The raw left and
+right disparity maps only depend on the matcher params (max_disparity,
+block_size, p1, p2), so are only computed once for each of those, and then
+every lmbda/sigma WLS filter is applied to the same raw disparities.
+A sweep of N matcher configs by M filter configs is then N matcher passes
+rather than N x M.
+
+Each config gets a name from its params, eg.
+`md64_bs5_p1600_p22400_l8000.0_s1.2`, and the outputs are saved as
+└── out_dir
+    ├── configs.tsv
+    └── <config name>
+        └── image_key
+            └── disp.jpg
+
+where `configs.tsv` lists the params for each config name.
+"""
+import numpy as np
+import argparse
+import functools
+import itertools
+import multiprocessing
+import os
+import sys
+import traceback
+
+import cv2
+
+import create_depth_map
+
+
+# matchers and filters for every config in the sweep, built once per worker
+# process in `init_sweep_worker`
+_sweep_state = {}
+
+
+def make_grid(max_disparities, block_sizes, p1s, p2s, lmbdas, sigmas):
+  """make the grid of matcher and filter configs
+
+  Each matcher config is checked with `create_depth_map.check_matcher_args`,
+  which also fills in the suggested p1 and p2 if they are None.
+
+  Args:
+    max_disparities (list(int)):
+      values for max disparity
+    block_sizes (list(int)):
+      values for block size
+    p1s (list(int)):
+      values for p1, None to use the suggested value for the block size
+    p2s (list(int)):
+      values for p2, None to use the suggested value for the block size
+    lmbdas (list(float)):
+      values for lmbda
+    sigmas (list(float)):
+      values for sigma
+
+  Returns:
+    tuple of (matcher configs, filter configs), where each matcher config is
+    a tuple of (max_disparity, block_size, p1, p2) and each filter config is
+    a tuple of (lmbda, sigma)
+
+  Raises:
+    ValueError if any of the configs aren't valid
+  """
+  matcher_configs = []
+  for max_disparity, block_size, p1, p2 in itertools.product(
+      max_disparities, block_sizes, p1s, p2s):
+    config = argparse.Namespace(max_disparity=max_disparity,
+                                block_size=block_size, p1=p1, p2=p2,
+                                lmbda=0, sigma=0)
+    create_depth_map.check_matcher_args(config)
+    matcher_config = (config.max_disparity, config.block_size,
+                      config.p1, config.p2)
+    # suggested values for p1 and p2 can make some configs the same
+    if matcher_config not in matcher_configs:
+      matcher_configs.append(matcher_config)
+  filter_configs = []
+  for lmbda, sigma in itertools.product(lmbdas, sigmas):
+    if (lmbda < 0) or (sigma < 0):
+      raise ValueError(
+        'Invalid value for lmbda or sigma, must be > 0: {} {}'.format(
+          lmbda, sigma))
+    filter_configs.append((lmbda, sigma))
+  return matcher_configs, filter_configs
+
+
+def config_name(matcher_config, filter_config):
+  """name for the output directory of a config"""
+  return 'md{}_bs{}_p1{}_p2{}_l{}_s{}'.format(*(matcher_config + filter_config))
+
+
+def init_sweep_worker(matcher_configs, filter_configs):
+  """create the matchers and filters for every config in the sweep
+
+  Args:
+    matcher_configs (list(tuple)):
+      (max_disparity, block_size, p1, p2) for each matcher config
+    filter_configs (list(tuple)):
+      (lmbda, sigma) for each filter config
+
+  Returns:
+    NA
+  """
+  sweep = []
+  for matcher_config in matcher_configs:
+    left_matcher, right_matcher = create_depth_map.create_matchers(
+      *matcher_config)
+    wls_filters = [create_depth_map.create_wls_filter(left_matcher, *x)
+                   for x in filter_configs]
+    sweep.append((matcher_config, left_matcher, right_matcher, wls_filters))
+  _sweep_state['sweep'] = sweep
+  _sweep_state['filter_configs'] = filter_configs
+
+
+def sweep_image_pair(image_pair, im_height, im_width, out_dir):
+  """run every config in the sweep on a single image pair
+
+  Args:
+    image_pair (str):
+      path to directory containing the two original images
+    im_height (int):
+      height of image to be resized to
+    im_width (int):
+      width of image to be resized to
+    out_dir (str):
+      directory to save the outputs for each config in
+
+  Returns:
+    tuple of (image_pair, error), where error is None if everything went
+    fine, otherwise is a string with the traceback for this pair
+  """
+  try:
+    # only read the pair the one time
+    left_im, right_im = create_depth_map.read_resize_images(
+      image_pair, im_height, im_width)
+    image_key = os.path.basename(os.path.normpath(image_pair))
+    for matcher_config, left_matcher, right_matcher, wls_filters in (
+        _sweep_state['sweep']):
+      # raw disparities only depend on the matcher config, so compute once
+      # and then reuse for every filter config
+      displ = left_matcher.compute(left_im, right_im)
+      dispr = right_matcher.compute(right_im, left_im)
+      for filter_config, wls_filter in zip(_sweep_state['filter_configs'],
+                                           wls_filters):
+        filtered_im = wls_filter.filter(displ, left_im,
+                                        disparity_map_right=dispr)
+        filtered_im = np.uint8(filtered_im)
+        result_dir = os.path.join(out_dir,
+                                  config_name(matcher_config, filter_config),
+                                  image_key)
+        os.makedirs(result_dir, exist_ok=True)
+        cv2.imwrite(os.path.join(result_dir, 'disp.jpg'), filtered_im)
+  except Exception:
+    return image_pair, traceback.format_exc()
+  return image_pair, None
+
+
+def write_configs(out_dir, matcher_configs, filter_configs):
+  """write the params for each config name to `configs.tsv`"""
+  with open(os.path.join(out_dir, 'configs.tsv'), 'w') as f:
+    f.write('name\tmax_disparity\tblock_size\tp1\tp2\tlmbda\tsigma\n')
+    for matcher_config in matcher_configs:
+      for filter_config in filter_configs:
+        params = matcher_config + filter_config
+        f.write('{}\t{}\n'.format(config_name(matcher_config, filter_config),
+                                  '\t'.join(str(x) for x in params)))
+
+
+def main(args):
+  """run a sweep of matcher and filter params over a list of image pairs"""
+  matcher_configs, filter_configs = make_grid(
+    args.max_disparity, args.block_size, args.p1, args.p2,
+    args.lmbda, args.sigma)
+  print('sweeping {} matcher configs x {} filter configs'.format(
+    len(matcher_configs), len(filter_configs)))
+  os.makedirs(args.out_dir, exist_ok=True)
+  write_configs(args.out_dir, matcher_configs, filter_configs)
+  image_pair_paths = create_depth_map.read_image_path_list(
+    args.image_path_list)
+  process_fn = functools.partial(sweep_image_pair,
+                                 im_height=args.im_height,
+                                 im_width=args.im_width,
+                                 out_dir=args.out_dir)
+  init_args = (matcher_configs, filter_configs)
+  pool = None
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers,
+                                initializer=init_sweep_worker,
+                                initargs=init_args)
+    results = pool.imap_unordered(process_fn, image_pair_paths)
+  else:
+    init_sweep_worker(*init_args)
+    results = map(process_fn, image_pair_paths)
+  failed_pairs = create_depth_map.report_results(results,
+                                                 len(image_pair_paths))
+  if pool is not None:
+    pool.close()
+    pool.join()
+  return failed_pairs
+
+
+if __name__ == '__main__':
+  """Loading in command line arguments.
+
+  Each of the matcher and filter params can be given a list of values, and
+  every combination of them is run.
+  """
+  parser = argparse.ArgumentParser(prog='sweep_depth_map',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('image_path_list',
+                      type=str,
+                      help='text file with path to images')
+  parser.add_argument('out_dir',
+                      type=str,
+                      help='directory to save the outputs for each config')
+  parser.add_argument('--im_height', type=int, default=1080,
+                      help='height of image to be reshaped to')
+  parser.add_argument('--im_width', type=int, default=1920,
+                      help='width of image to be reshaped to')
+  parser.add_argument('--max_disparity', type=int, nargs='+', default=[160],
+                      help='values of max disparity to sweep over')
+  parser.add_argument('--block_size', type=int, nargs='+', default=[15],
+                      help='values of block size to sweep over')
+  parser.add_argument('--p1', type=int, nargs='+', default=[None],
+                      help='values of p1 to sweep over, default is suggested value')
+  parser.add_argument('--p2', type=int, nargs='+', default=[None],
+                      help='values of p2 to sweep over, default is suggested value')
+  parser.add_argument('--lmbda', type=float, nargs='+', default=[8000],
+                      help='values of lmbda to sweep over')
+  parser.add_argument('--sigma', type=float, nargs='+', default=[1.2],
+                      help='values of sigma to sweep over')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='number of processes to spread image pairs across')
+  args = parser.parse_args(sys.argv[1:])
+  if not os.path.isfile(args.image_path_list):
+    raise IOError(
+      'Value for image paths does not exist: {}'.format(args.image_path_list))
+  if args.workers < 1:
+    raise ValueError(
+      'Invalid value for workers, must be >= 1: {}'.format(args.workers))
+  failed_pairs = main(args)
+  if failed_pairs:
+    sys.exit(1)
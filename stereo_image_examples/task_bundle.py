@@ -0,0 +1,299 @@
+"""task_bundle.py
+
+Runs a bundle of small tasks inside a single job.
+
+Lots of small jobs (eg. one for each number of trees in the bt_examples, or
+one for each image shard) each spend longer waiting in the queue and loading
+modules than they do running. Instead, a single job can ask for N cores
+once, and run all the tasks with this executor, keeping up to N cores busy
+until they are all done.
+
+Tasks are read from a text file with one shell command per line, which are
+run with bash from the current directory. Each task gets
+  - its stdout and stderr in `task_XX.out` and `task_XX.err` in the log
+    directory
+  - a JSON line in the results file with its exit code, host, start and end
+    times, and how long it ran for
+
+with the results written as each task finishes, so they are kept if the job
+is killed part way through. Tasks also get `TASK_INDEX` set in their
+environment, and `OMP_NUM_THREADS` set to the cores for each task so
+threaded libraries don't each try and use the whole node.
+
+The number of cores defaults to `NCPUS` from PBS, otherwise the cores this
+process is allowed to run on, so it runs the same way locally as in a job,
+eg.
+  python task_bundle.py run tasks.txt --log_dir logs --results results.jsonl
+
+If the job hits its walltime, running tasks are stopped and recorded as
+killed. Running again with `--resume` skips tasks that already finished
+successfully. `summary` prints how a bundle went from its results file.
+
+`create_pbs.py --bundle_cpus` makes job scripts that run this.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def available_cpus():
+  """number of cores to use, from PBS if in a job otherwise the affinity"""
+  if os.environ.get('NCPUS', '').isdigit():
+    return int(os.environ['NCPUS'])
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+def read_tasks(tasks_path):
+  """read the commands for a bundle, skipping blank lines and comments
+
+  Returns:
+    list of commands
+  """
+  with open(tasks_path) as f:
+    lines = [x.strip() for x in f]
+  return [x for x in lines if x and not x.startswith('#')]
+
+
+def read_results(results_path):
+  """read the results for a bundle
+
+  Returns:
+    dict mapping task index to its latest result
+  """
+  results = {}
+  if not os.path.exists(results_path):
+    return results
+  with open(results_path) as f:
+    for line in f:
+      try:
+        result = json.loads(line)
+      except ValueError:
+        # killed part way through writing a line
+        continue
+      results[result['index']] = result
+  return results
+
+
+class TaskBundle(object):
+  """runs a list of commands concurrently, recording how each went"""
+
+  def __init__(self, commands, log_dir, results_path, cores_per_task=1):
+    """set up a bundle
+
+    Args:
+      commands (list(str)):
+        shell command for each task
+      log_dir (str):
+        directory for the stdout and stderr of each task
+      results_path (str):
+        JSON lines file each task's result is appended to
+      cores_per_task (int):
+        cores each task uses, for `OMP_NUM_THREADS`
+    """
+    self.commands = commands
+    self.log_dir = log_dir
+    self.results_path = results_path
+    self.cores_per_task = cores_per_task
+    self._lock = threading.Lock()
+    self._running = {}
+    self._stopping = False
+
+  def _log_path(self, index, stream):
+    """path to the log for one of a task's streams"""
+    return os.path.join(self.log_dir, 'task_{:0>2d}.{}'.format(index, stream))
+
+  def _record(self, result):
+    """append a result, one line at a time so it is kept if we are killed"""
+    with self._lock:
+      with open(self.results_path, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+  def run_task(self, index):
+    """run a single task and record its result
+
+    Returns:
+      result dict for the task
+    """
+    result = {'index': index, 'command': self.commands[index],
+              'host': socket.gethostname(), 'start_time': time.time()}
+    env = dict(os.environ)
+    env['TASK_INDEX'] = str(index)
+    env['OMP_NUM_THREADS'] = str(self.cores_per_task)
+    with self._lock:
+      # check before opening the logs, so a task that never starts doesn't
+      # wipe the logs from an earlier run of it
+      if self._stopping:
+        return None
+      # the task gets its own copies of the log files, so ours can be
+      # closed as soon as it has started
+      with open(self._log_path(index, 'out'), 'w') as out, \
+           open(self._log_path(index, 'err'), 'w') as err:
+        proc = subprocess.Popen(['bash', '-c', self.commands[index]],
+                                stdout=out, stderr=err, env=env)
+      self._running[index] = proc
+    returncode = proc.wait()
+    with self._lock:
+      del self._running[index]
+      killed = self._stopping
+    result['end_time'] = time.time()
+    result['seconds'] = result['end_time'] - result['start_time']
+    result['returncode'] = returncode
+    result['killed'] = killed
+    self._record(result)
+    return result
+
+  def stop(self, *_):
+    """stop running tasks and don't start any more, eg. on SIGTERM"""
+    with self._lock:
+      self._stopping = True
+      for proc in self._running.values():
+        proc.terminate()
+
+  def run(self, workers, indices=None):
+    """run the tasks, up to `workers` at a time
+
+    Args:
+      workers (int):
+        max number of tasks running at once
+      indices (list(int)):
+        tasks to run, defaults to all of them
+
+    Returns:
+      list of results for the tasks that were run, in order of index
+    """
+    if indices is None:
+      indices = range(len(self.commands))
+    os.makedirs(self.log_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(self.run_task, indices))
+    return [x for x in results if x is not None]
+
+
+def summarise_results(results, workers=None):
+  """work out how a bundle went
+
+  Args:
+    results (list(dict)):
+      task results, eg. from `read_results`
+    workers (int):
+      number of tasks run at once, to work out how busy the cores were
+
+  Returns:
+    dict with the summary
+  """
+  task_seconds = sum(x['seconds'] for x in results)
+  span = (max(x['end_time'] for x in results) -
+          min(x['start_time'] for x in results))
+  summary = {'tasks': len(results),
+             'succeeded': sum(1 for x in results if x['returncode'] == 0),
+             'killed': sum(1 for x in results if x.get('killed')),
+             'span_seconds': span,
+             'task_seconds': task_seconds,
+             'max_task_seconds': max(x['seconds'] for x in results)}
+  summary['failed'] = summary['tasks'] - summary['succeeded']
+  if workers is not None:
+    slots = min(workers, len(results))
+    summary['utilisation'] = task_seconds / max(span * slots, 1e-9)
+  return summary
+
+
+def print_summary(summary, results):
+  """print a summary from `summarise_results` along with any failures"""
+  print('tasks:      {} ({} succeeded, {} failed, {} killed)'.format(
+    summary['tasks'], summary['succeeded'], summary['failed'],
+    summary['killed']))
+  print('span:       {:.2f}s'.format(summary['span_seconds']))
+  print('task time:  {:.2f}s total, longest {:.2f}s'.format(
+    summary['task_seconds'], summary['max_task_seconds']))
+  if 'utilisation' in summary:
+    print('utilisation: {:.1%}'.format(summary['utilisation']))
+  for result in sorted(results, key=lambda x: x['index']):
+    if result['returncode'] != 0:
+      print('  task {} exited with {}: {}'.format(
+        result['index'], result['returncode'], result['command']))
+
+
+def main(args):
+  """run a bundle of tasks, or summarise how one went"""
+  if args.command == 'summary':
+    results = list(read_results(args.results).values())
+    if not results:
+      print('no results in {}'.format(args.results))
+      return 1
+    summary = summarise_results(results)
+    print_summary(summary, results)
+    return 0 if summary['failed'] == 0 else 1
+  commands = read_tasks(args.tasks)
+  cores = available_cpus() if args.cores is None else args.cores
+  workers = max(1, cores // args.cores_per_task)
+  log_dir = args.log_dir
+  if log_dir is None:
+    log_dir = os.path.splitext(args.tasks)[0] + '_logs'
+  results_path = args.results
+  if results_path is None:
+    results_path = os.path.join(log_dir, 'results.jsonl')
+  indices = list(range(len(commands)))
+  if args.resume:
+    # only counts as done if it was the same command, in case the tasks
+    # have been changed since
+    done = set(index for index, result in read_results(results_path).items()
+               if (result['returncode'] == 0) and (index < len(commands)) and
+               (result['command'] == commands[index]))
+    indices = [x for x in indices if x not in done]
+    print('skipping {} tasks already done'.format(len(done)))
+  bundle = TaskBundle(commands, log_dir, results_path, args.cores_per_task)
+  # PBS sends SIGTERM when the walltime is up, stop the tasks cleanly so
+  # they are recorded as killed
+  signal.signal(signal.SIGTERM, bundle.stop)
+  print('running {} tasks, {} at a time on {} cores'.format(
+    len(indices), workers, cores))
+  results = bundle.run(workers, indices)
+  if not results:
+    return 0
+  summary = summarise_results(results, workers)
+  print_summary(summary, results)
+  print(json.dumps(summary, sort_keys=True))
+  return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='task_bundle',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  run_parser = subparsers.add_parser('run', help='run a bundle of tasks')
+  run_parser.add_argument('tasks', type=str,
+                          help='text file with a command for each task')
+  run_parser.add_argument('--cores', type=int, default=None,
+                          help='cores to use, default is NCPUS or the cores we can run on')
+  run_parser.add_argument('--cores_per_task', type=int, default=1,
+                          help='cores each task uses')
+  run_parser.add_argument('--log_dir', type=str, default=None,
+                          help='where to put the logs for each task, default is <tasks>_logs')
+  run_parser.add_argument('--results', type=str, default=None,
+                          help='JSON lines file for the results, default is in the log dir')
+  run_parser.add_argument('--resume', action='store_true',
+                          help='skip tasks that already succeeded')
+  summary_parser = subparsers.add_parser('summary',
+                                         help='summarise a bundle')
+  summary_parser.add_argument('results', type=str,
+                              help='JSON lines results for the bundle')
+  args = parser.parse_args(sys.argv[1:])
+  if (args.command == 'run'):
+    for name in ['cores', 'cores_per_task']:
+      value = getattr(args, name)
+      if (value is not None) and (value < 1):
+        raise ValueError('Invalid value for {}, must be >= 1: {}'.format(
+          name, value))
+  sys.exit(main(args))
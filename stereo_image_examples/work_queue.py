@@ -0,0 +1,290 @@
+"""work_queue.py
+
+Shared queue of work for a bunch of jobs to pull from.
+
+Rather than splitting the image pairs up into a fixed list for each job
+(where the slowest job decides when everything is finished), all the pairs
+go into a single queue, and each job keeps claiming a batch of pairs until
+the queue is empty. Jobs that finish early just take more work.
+
+The queue is an SQLite database on the shared filesystem, and SQLite's file
+locking keeps jobs from claiming the same work. Claimed work is leased to
+the job for a while, and the job renews the lease as it makes progress. If a
+job dies (eg. is killed by the scheduler), its lease runs out and the work
+goes back in the queue for someone else. Work that keeps getting its lease
+expired is eventually marked as failed, so one bad pair can't keep taking
+down jobs forever.
+
+NOTE: the default rollback journal is used rather than WAL, as WAL needs
+shared memory which doesn't work across nodes on a network filesystem.
+
+Can also be run as a script,
+  create: make a queue from a list of image pairs
+  status: print how much work is in each state
+  retry: put failed work back in the queue
+  local: run a few copies of a command locally to work through a queue,
+         handy for testing without PBS
+"""
+import argparse
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+
+class WorkQueue(object):
+  """queue of work items stored in SQLite with leases"""
+
+  def __init__(self, db_path, max_attempts=3, timeout=600):
+    """open an existing queue
+
+    Args:
+      db_path (str):
+        path to the queue database
+      max_attempts (int):
+        number of times an item can be leased before it is marked as failed
+      timeout (float):
+        seconds to wait for another job to let go of the lock
+
+    Raises:
+      IOError if the queue doesn't exist
+    """
+    if not os.path.isfile(db_path):
+      raise IOError('queue does not exist: {}'.format(db_path))
+    self.db_path = db_path
+    self.max_attempts = max_attempts
+    # manage transactions ourselves, so claiming is a single locked step
+    self._conn = sqlite3.connect(db_path, timeout=timeout,
+                                 isolation_level=None)
+
+  def _transaction(self):
+    """start a transaction that takes the write lock straight away"""
+    self._conn.execute('BEGIN IMMEDIATE')
+
+  def claim(self, owner, batch_size, lease_seconds):
+    """claim a batch of pending work
+
+    Any leases that have run out are sorted out first, so work held by
+    dead jobs is handed out again.
+
+    Args:
+      owner (str):
+        name of whoever is claiming the work
+      batch_size (int):
+        max number of items to claim
+      lease_seconds (float):
+        how long the lease lasts before the work goes back in the queue
+
+    Returns:
+      list of (id, item) tuples, empty once there is nothing left to claim
+    """
+    now = time.time()
+    self._transaction()
+    try:
+      self._expire_leases(now)
+      rows = self._conn.execute(
+        "SELECT id, item FROM tasks WHERE state = 'pending' "
+        "ORDER BY id LIMIT ?", (batch_size,)).fetchall()
+      self._conn.executemany(
+        "UPDATE tasks SET state = 'leased', owner = ?, lease_expiry = ?, "
+        "attempts = attempts + 1 WHERE id = ?",
+        [(owner, now + lease_seconds, task_id) for task_id, _ in rows])
+      self._conn.execute('COMMIT')
+    except BaseException:
+      self._conn.execute('ROLLBACK')
+      raise
+    return rows
+
+  def _expire_leases(self, now):
+    """put work with expired leases back in the queue, or fail it"""
+    self._conn.execute(
+      "UPDATE tasks SET state = 'failed', owner = NULL, "
+      "error = 'lease expired too many times' "
+      "WHERE state = 'leased' AND lease_expiry < ? AND attempts >= ?",
+      (now, self.max_attempts))
+    self._conn.execute(
+      "UPDATE tasks SET state = 'pending', owner = NULL "
+      "WHERE state = 'leased' AND lease_expiry < ?", (now,))
+
+  def renew(self, owner, lease_seconds):
+    """extend the lease on all work held by an owner"""
+    self._conn.execute(
+      "UPDATE tasks SET lease_expiry = ? WHERE state = 'leased' AND owner = ?",
+      (time.time() + lease_seconds, owner))
+
+  def complete(self, owner, task_id):
+    """mark an item as done
+
+    Only if the owner still holds the lease on it. If the lease ran out the
+    item may have been handed to someone else, who could already have
+    finished it, so it is left alone.
+
+    Returns:
+      True if it was marked, False if the owner lost the lease
+    """
+    cursor = self._conn.execute(
+      "UPDATE tasks SET state = 'done', owner = NULL "
+      "WHERE id = ? AND owner = ? AND state = 'leased'", (task_id, owner))
+    return cursor.rowcount > 0
+
+  def fail(self, owner, task_id, error):
+    """mark an item as failed, with the error for why
+
+    Same as `complete`, only if the owner still holds the lease on it.
+
+    Returns:
+      True if it was marked, False if the owner lost the lease
+    """
+    cursor = self._conn.execute(
+      "UPDATE tasks SET state = 'failed', owner = NULL, error = ? "
+      "WHERE id = ? AND owner = ? AND state = 'leased'",
+      (error, task_id, owner))
+    return cursor.rowcount > 0
+
+  def retry_failed(self):
+    """put all failed work back in the queue
+
+    Returns:
+      number of items put back
+    """
+    cursor = self._conn.execute(
+      "UPDATE tasks SET state = 'pending', attempts = 0, error = NULL "
+      "WHERE state = 'failed'")
+    return cursor.rowcount
+
+  def counts(self):
+    """number of items in each state
+
+    Returns:
+      dict mapping state to count
+    """
+    rows = self._conn.execute(
+      'SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall()
+    counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+    counts.update(dict(rows))
+    return counts
+
+  def close(self):
+    """close the connection to the queue"""
+    self._conn.close()
+
+
+def create_queue(db_path, items):
+  """make a new queue filled with work items
+
+  Args:
+    db_path (str):
+      path to create the queue database at
+    items (iterable(str)):
+      work items, eg. paths to image pairs
+
+  Returns:
+    number of items added
+
+  Raises:
+    IOError if the queue already exists
+  """
+  if os.path.exists(db_path):
+    raise IOError('queue already exists: {}'.format(db_path))
+  conn = sqlite3.connect(db_path)
+  with conn:
+    conn.execute(
+      'CREATE TABLE tasks ('
+      'id INTEGER PRIMARY KEY, '
+      'item TEXT NOT NULL, '
+      "state TEXT NOT NULL DEFAULT 'pending', "
+      'owner TEXT, '
+      'lease_expiry REAL, '
+      'attempts INTEGER NOT NULL DEFAULT 0, '
+      'error TEXT)')
+    conn.execute('CREATE INDEX tasks_state ON tasks (state)')
+    conn.executemany('INSERT INTO tasks (item) VALUES (?)',
+                     ((item,) for item in items))
+    num_items = conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+  conn.close()
+  return num_items
+
+
+def default_owner():
+  """name for this process when claiming work, from the host and pid"""
+  return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def run_local(command, num_jobs):
+  """run a few copies of a command at once, as a stand-in for PBS jobs
+
+  Args:
+    command (list(str)):
+      command to run for each job
+    num_jobs (int):
+      number of copies to run at once
+
+  Returns:
+    list of exit codes for each job
+  """
+  jobs = [subprocess.Popen(command) for _ in range(num_jobs)]
+  return [job.wait() for job in jobs]
+
+
+def main(args):
+  """create, check on, or work through a queue"""
+  if args.command == 'create':
+    with open(args.image_path_list) as f:
+      items = [x.rstrip() for x in f if x.strip()]
+    num_items = create_queue(args.queue, items)
+    print('created queue {} with {} items'.format(args.queue, num_items))
+  elif args.command == 'status':
+    queue = WorkQueue(args.queue)
+    for state, count in sorted(queue.counts().items()):
+      print('{:<8s} {}'.format(state, count))
+  elif args.command == 'retry':
+    queue = WorkQueue(args.queue)
+    print('put {} failed items back in the queue'.format(queue.retry_failed()))
+  elif args.command == 'local':
+    exit_codes = run_local(args.job_command, args.jobs)
+    print('local job exit codes: {}'.format(exit_codes))
+    queue = WorkQueue(args.queue)
+    for state, count in sorted(queue.counts().items()):
+      print('{:<8s} {}'.format(state, count))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='work_queue',
+                                   epilog=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+  create_parser = subparsers.add_parser('create', help='create a queue')
+  create_parser.add_argument('queue', type=str,
+                             help='path to the queue database')
+  create_parser.add_argument('image_path_list', type=str,
+                             help='text file with path to images')
+  status_parser = subparsers.add_parser('status', help='status of a queue')
+  status_parser.add_argument('queue', type=str,
+                             help='path to the queue database')
+  retry_parser = subparsers.add_parser('retry', help='retry failed work')
+  retry_parser.add_argument('queue', type=str,
+                            help='path to the queue database')
+  local_parser = subparsers.add_parser('local',
+                                       help='run local jobs on a queue')
+  local_parser.add_argument('queue', type=str,
+                            help='path to the queue database')
+  local_parser.add_argument('--jobs', type=int, default=2,
+                            help='number of local jobs to run at once')
+  # eg. work_queue.py local queue.db --jobs 4 -- python create_depth_map.py
+  #       --queue queue.db
+  # the command for local jobs comes after a `--`, split it off first so
+  # argparse doesn't try to parse its options as our own
+  argv = sys.argv[1:]
+  job_command = []
+  if '--' in argv:
+    job_command = argv[argv.index('--') + 1:]
+    argv = argv[:argv.index('--')]
+  args = parser.parse_args(argv)
+  args.job_command = job_command
+  if (args.command == 'local') and not args.job_command:
+    raise ValueError('need a command to run for local jobs after a --')
+  main(args)